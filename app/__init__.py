@@ -16,13 +16,24 @@ else:
     from flask_debugtoolbar import DebugToolbarExtension
     toolbar = DebugToolbarExtension(app)
 
-# Setup the database
+# Setup the database, reads of GET requests can go to a read replica (see app/replica.py)
 from flask_sqlalchemy import SQLAlchemy
-db = SQLAlchemy(app)
+from app.replica import RoutingSession
+db = SQLAlchemy(app, session_options={'class_': RoutingSession})
 
 # Setup caching
 from flask_caching import Cache
 cache = Cache(app)
 
+# Cache compiled templates on disk
+if app.config.get('JINJA_BYTECODE_CACHE'):
+    from jinja2 import FileSystemBytecodeCache
+    bytecode_dir = app.config.get('JINJA_BYTECODE_CACHE_DIR') or os.path.join(app.instance_path, 'jinja')
+    os.makedirs(bytecode_dir, exist_ok=True)
+    app.jinja_env.bytecode_cache = FileSystemBytecodeCache(bytecode_dir)
+
 # Import the views
 from app.views import main, error
+
+# Setup the opt-in request profiler
+from app import profiler
@@ -0,0 +1,233 @@
+'''
+alerts.py evaluates alert rules on what each poll of a license server saw.
+read_licenses builds a Snapshot while it parses lmstat (seats in use and
+issued per product, the checkouts on full polls, the server status and its
+consecutive failures) and calls evaluate(), so the rules add no queries.
+Rules are configured in ALERT_RULES:
+        - seats:        share of seats in use, fires at 'above' and clears below
+                        'below' (hysteresis). above=1.0 is a saturated product.
+        - server_down:  fires after 'failures' consecutive failed polls, clears
+                        when the server is UP again
+        - long_session: a checkout held for more than 'hours'
+Every rule takes an optional 'for' (minutes the condition must hold before it
+fires) and 'products' (internal names it applies to). The state of every
+alert is kept in models.AlertState, so an alert is sent once when it fires
+and once when it clears. Alerts go to the sinks in ALERT_SINKS: 'log',
+'webhook' (POSTs JSON to ALERT_WEBHOOK_URL) or 'email' (ALERT_SMTP_HOST).
+:Example:
+        # >>> @sink('teams')
+        # ... def teams_sink(alert): ...
+'''
+
+import datetime
+import json
+import smtplib
+import urllib.request
+from email.message import EmailMessage
+
+from app import app, db
+from app.arcgis_config import products as product_config
+from app.models import AlertState
+from app.logger_setup import logger
+
+
+class Snapshot(object):
+    """What one poll of a license server saw."""
+
+    def __init__(self, server, server_id, time=None):
+        self.server = server
+        self.server_id = server_id
+        self.time = time or datetime.datetime.now()
+        self.status = None
+        self.failures = 0
+        self.products = {}  # internal_name: (license_out, license_total)
+        self.sessions = None  # [(internal_name, user, workstation, time_out)], None when checkouts were not read
+
+    def add_product(self, internal_name, license_out, license_total):
+        self.products[internal_name] = (license_out, license_total)
+
+    def add_session(self, internal_name, user, workstation, time_out):
+        if self.sessions is None:
+            self.sessions = []
+        self.sessions.append((internal_name, user, workstation, time_out))
+
+
+def _common_name(internal_name):
+    return product_config.get(internal_name, {}).get('common_name', internal_name)
+
+
+def _applies(rule, internal_name):
+    return not rule.get('products') or internal_name in rule['products']
+
+
+# ----------------------------------------------------------------------------#
+# Rules: yield (key, condition, message), where condition is True to fire, False to clear and None to
+# keep the alert as it is.
+# ----------------------------------------------------------------------------#
+
+def seats_rule(rule, snapshot):
+    above = rule.get('above', 1.0)
+    below = rule.get('below', above)
+    for name, (out, total) in snapshot.products.items():
+        if not total or not _applies(rule, name):
+            continue
+        share = float(out or 0) / total
+        condition = True if share >= above else False if share < below else None
+        yield '{}/{}'.format(snapshot.server, name), condition, \
+            '{} on {}: {} of {} seats in use'.format(_common_name(name), snapshot.server, out, total)
+
+
+def server_down_rule(rule, snapshot):
+    failures = rule.get('failures', 3)
+    condition = True if snapshot.failures >= failures else False if snapshot.failures == 0 else None
+    yield snapshot.server, condition, '{} is {}, {} failed polls in a row'.format(
+        snapshot.server, snapshot.status, snapshot.failures)
+
+
+def long_session_rule(rule, snapshot):
+    limit = datetime.timedelta(hours=rule.get('hours', 24))
+    for name, user, workstation, time_out in snapshot.sessions or ():
+        if _applies(rule, name) and snapshot.time - time_out > limit:
+            yield '{}/{}/{}/{}'.format(snapshot.server, name, user, workstation), True, \
+                '{} on {} has held {} since {}'.format(user, workstation, _common_name(name), time_out)
+
+
+# type: (rule, whether alerts whose key is not in a full snapshot are cleared)
+RULE_TYPES = {
+    'seats': (seats_rule, False),
+    'server_down': (server_down_rule, False),
+    'long_session': (long_session_rule, True),
+}
+
+
+# ----------------------------------------------------------------------------#
+# Sinks
+# ----------------------------------------------------------------------------#
+
+SINKS = {}
+
+
+def sink(name):
+    """Registers a function called with every alert that fires or clears, enabled by adding name to ALERT_SINKS."""
+    def decorator(f):
+        SINKS[name] = f
+        return f
+    return decorator
+
+
+@sink('log')
+def log_sink(alert):
+    if alert['state'] == 'firing':
+        logger.warning('Alert {rule} firing: {message}'.format(**alert), alert=alert['key'])
+    else:
+        logger.info('Alert {rule} resolved: {message}'.format(**alert), alert=alert['key'])
+
+
+@sink('webhook')
+def webhook_sink(alert):
+    request = urllib.request.Request(app.config['ALERT_WEBHOOK_URL'], data=json.dumps(alert).encode('utf-8'),
+                                     headers={'Content-Type': 'application/json'}, method='POST')
+    with urllib.request.urlopen(request, timeout=app.config['ALERT_TIMEOUT']) as response:
+        response.read()
+
+
+@sink('email')
+def email_sink(alert):
+    msg = EmailMessage()
+    msg['Subject'] = '[{}] {}: {}'.format(alert['state'].upper(), alert['rule'], alert['message'])
+    msg['From'] = app.config['ALERT_EMAIL_FROM']
+    msg['To'] = ', '.join(app.config['ALERT_EMAIL_TO'])
+    msg.set_content('{message}\n\nrule: {rule}\nkey: {key}\nsince: {since}\ntime: {time}\n'.format(**alert))
+    with smtplib.SMTP(app.config['ALERT_SMTP_HOST'], app.config['ALERT_SMTP_PORT'],
+                      timeout=app.config['ALERT_TIMEOUT']) as smtp:
+        smtp.send_message(msg)
+
+
+def notify(alert):
+    for name in app.config['ALERT_SINKS']:
+        try:
+            SINKS[name](alert)
+        except Exception as e:
+            logger.error('Alert sink {} failed: {}'.format(name, str(e)))
+
+
+# ----------------------------------------------------------------------------#
+# Evaluation
+# ----------------------------------------------------------------------------#
+
+# server_id: (time of the last evaluation, {(rule, key): (state, since)})
+_states = {}
+
+
+def _load_states(server_id, now):
+    """
+    The alert states of a server. They are kept in memory between polls and only reloaded when this
+    process has not evaluated the server for POLL_LEASE_TTL, ie. when another worker may have polled it.
+    """
+    cached = _states.get(server_id)
+    if cached is None or (now - cached[0]).total_seconds() > app.config['POLL_LEASE_TTL']:
+        rows = db.session.query(AlertState.rule, AlertState.key, AlertState.state, AlertState.since). \
+            filter(AlertState.server_id == server_id, AlertState.state != 'OK').all()
+        cached = (now, {(r.rule, r.key): (r.state, r.since) for r in rows})
+    _states[server_id] = (now, cached[1])
+    return cached[1]
+
+
+def evaluate(snapshot, rules=None):
+    """
+    Evaluates the rules on a snapshot, records the alerts that changed state and sends the ones that
+    fired or cleared to the sinks.
+    :return: list of alerts sent
+    """
+    rules = app.config['ALERT_RULES'] if rules is None else rules
+    now = snapshot.time
+    states = _load_states(snapshot.server_id, now)
+    sent = []
+    saved = []
+
+    def save(name, key, state, since, message, fired=None, cleared=None):
+        row = AlertState(rule=name, key=key, server_id=snapshot.server_id, state=state, since=since,
+                         message=message[:255])
+        if fired:
+            row.fired, row.cleared = fired, None
+        if cleared:
+            row.cleared = cleared
+        db.session.merge(row)
+        saved.append(row)
+        if state == 'OK':
+            states.pop((name, key), None)
+        else:
+            states[(name, key)] = (state, since)
+        if fired or cleared:
+            sent.append({'rule': name, 'key': key, 'server': snapshot.server,
+                         'state': 'firing' if fired else 'resolved', 'message': message,
+                         'since': since.isoformat(), 'time': now.isoformat()})
+
+    for rule in rules:
+        name = rule['name']
+        evaluate_rule, clear_missing = RULE_TYPES[rule['type']]
+        wait = datetime.timedelta(minutes=rule.get('for', 0))
+        seen = set()
+        for key, condition, message in evaluate_rule(rule, snapshot):
+            seen.add(key)
+            state, since = states.get((name, key), ('OK', None))
+            if condition:
+                if state == 'OK':
+                    state, since = 'PENDING', now
+                if state == 'PENDING':
+                    if now - since >= wait:
+                        save(name, key, 'FIRING', since, message, fired=now)
+                    elif (name, key) not in states:
+                        save(name, key, 'PENDING', since, message)
+            elif condition is False and state != 'OK':
+                save(name, key, 'OK', since, message, cleared=now if state == 'FIRING' else None)
+        if clear_missing and snapshot.sessions is not None:
+            for (rule_name, key), (state, since) in list(states.items()):
+                if rule_name == name and key not in seen:
+                    save(name, key, 'OK', since, '{} cleared'.format(key),
+                         cleared=now if state == 'FIRING' else None)
+    if saved:
+        db.session.commit()
+    for alert in sent:
+        notify(alert)
+    return sent
@@ -1,7 +1,8 @@
 import os
 import platform
 
-# license server names and ports. Default port is 27000.
+# license server names and ports. Default port is 27000. An optional "timeout" (seconds) overrides
+# config.LMUTIL_TIMEOUT for that server.
 license_servers = [
     {"hostname": "gv-gislicense", "port": "27000"},
     # {"name": "MY-2ND-LICENSE-SERVER", "port": "27000"}
@@ -0,0 +1,255 @@
+'''
+bench.py is the benchmark suite run by ``manage.py bench``. Each benchmark is
+a setup function registered with @benchmark that returns the callable to time:
+        - parse:  split_license_data and the parse_* functions on tests/data
+        - ingest: a full read(license_file=...) poll
+        - views:  serialize_dashboard_data at 10k rows and the main routes
+                  through the test client on generated data
+Results are compared to a JSON baseline (BASELINE_PATH) and benchmarks whose
+median got slower than the threshold are flagged as regressions.
+'''
+
+import json
+import os
+import platform
+import statistics
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta
+
+from app import app, db, cache
+
+DATA_DIR = os.path.join(os.path.dirname(app.root_path), 'tests', 'data')
+BASELINE_PATH = os.path.join(os.path.dirname(app.root_path), 'benchmarks', 'baseline.json')
+
+BENCHMARKS = OrderedDict()
+
+
+def benchmark(name):
+    """Registers a benchmark setup function under a dotted name, eg. 'parse.split_license_data'."""
+    def decorator(f):
+        BENCHMARKS[name] = f
+        return f
+    return decorator
+
+
+def _fixture(name):
+    with open(os.path.join(DATA_DIR, name)) as f:
+        return f.read()
+
+
+def _fixtures():
+    return [_fixture(name) for name in sorted(os.listdir(DATA_DIR)) if name.endswith('.txt')]
+
+
+@benchmark('parse.split_license_data')
+def bench_split_license_data():
+    from app.read_licenses import split_license_data
+    texts = _fixtures()
+    return lambda: [split_license_data(t) for t in texts]
+
+
+@benchmark('parse.parse_server_info')
+def bench_parse_server_info():
+    from app.read_licenses import parse_server_info
+    texts = _fixtures()
+    return lambda: [parse_server_info(t) for t in texts]
+
+
+@benchmark('parse.parse_error_info')
+def bench_parse_error_info():
+    from app.read_licenses import parse_error_info
+    texts = _fixtures()
+    return lambda: [parse_error_info(t) for t in texts]
+
+
+@benchmark('parse.parse_product_info')
+def bench_parse_product_info():
+    from app.read_licenses import split_license_data, parse_product_info
+    lines = [lic.split('\n', 1)[0].strip() for t in _fixtures() for lic in split_license_data(t)[1:]]
+    return lambda: [parse_product_info(line) for line in lines]
+
+
+@benchmark('parse.parse_version_info')
+def bench_parse_version_info():
+    from app.read_licenses import split_license_data, parse_version_info
+    blocks = [lic.split('FLOATING LICENSE')[0] for t in _fixtures() for lic in split_license_data(t)[1:]]
+    return lambda: [parse_version_info(b) for b in blocks]
+
+
+@benchmark('parse.parse_users_and_workstations')
+def bench_parse_users_and_workstations():
+    from app.read_licenses import split_license_data, parse_users_and_workstations
+    blocks = [lic.split('FLOATING LICENSE')[-1] for t in _fixtures() for lic in split_license_data(t)[1:]]
+    return lambda: [list(parse_users_and_workstations(b)) for b in blocks]
+
+
+@benchmark('parse.parse_totals')
+def bench_parse_totals():
+    from app.read_licenses import parse_totals
+    texts = _fixtures()
+    return lambda: [parse_totals(t) for t in texts]
+
+
+def _reset_db():
+    db.session.remove()
+    db.drop_all()
+    db.create_all()
+
+
+@benchmark('ingest.read')
+def bench_read():
+    """A poll whose checkouts did not change since the previous one, the common case."""
+    from app.read_licenses import read
+    path = os.path.join(DATA_DIR, 'prod-license.txt')
+    _reset_db()
+    read(license_file=path)
+    return lambda: read(license_file=path)
+
+
+@benchmark('ingest.read_changes')
+def bench_read_changes():
+    """Polls alternating between two snapshots, so every poll checks licenses out and in."""
+    from app.read_licenses import read
+    paths = [os.path.join(DATA_DIR, 'prod-license.txt'), os.path.join(DATA_DIR, 'prod-license-v2.txt')]
+    _reset_db()
+    read(license_file=paths[0])
+    state = {'i': 0}
+
+    def poll():
+        state['i'] += 1
+        read(license_file=paths[state['i'] % 2])
+    return poll
+
+
+def dashboard_rows(n=10000, servers=2, products=20, seed=0):
+    """Rows shaped like the dashboard query: workstation, user, product, out, total, server, time_in."""
+    import random
+    rnd = random.Random(seed)
+    now = datetime.now()
+    rows = []
+    for i in range(n):
+        rows.append(('WS-{:05d}'.format(i % 2000), 'user{:05d}'.format(i % 3000),
+                     'Product {}'.format(rnd.randrange(products)), rnd.randrange(50), 50,
+                     'gis-license-{}'.format(rnd.randrange(servers) + 1),
+                     None if rnd.random() < 0.3 else now - timedelta(minutes=rnd.randrange(10000))))
+    return rows
+
+
+@benchmark('views.serialize_dashboard_data')
+def bench_serialize_dashboard_data():
+    from app.views.main import serialize_dashboard_data
+    rows = dashboard_rows()
+    return lambda: serialize_dashboard_data(rows)
+
+
+_populated = {}
+
+
+def _route(endpoint):
+    from app.explain import representative_routes
+    from app.fake_populate import populate_large
+    if not _populated:
+        _reset_db()
+        populate_large(servers=2, users=200, workstations=200, days=30)
+        _populated.update(representative_routes())
+    url = _populated[endpoint]
+    client = app.test_client()
+
+    def get():
+        cache.clear()
+        response = client.get(url)
+        if response.status_code != 200:
+            raise RuntimeError('{} returned {}'.format(url, response.status_code))
+    return get
+
+
+for _endpoint in ['dashboard', 'users', 'username', 'servers', 'servername', 'products', 'productname',
+                  'workstations', 'workstationname']:
+    benchmark('routes.' + _endpoint)(lambda endpoint=_endpoint: _route(endpoint))
+
+
+def measure(fn, repeat=5, min_time=0.05):
+    """
+    Times a callable, calling it enough times per repeat to run for at least min_time seconds.
+    :return: {'number', 'repeat', 'min_us', 'median_us', 'mean_us'} per call
+    """
+    number = 1
+    while True:
+        start = time.perf_counter()
+        for _ in range(number):
+            fn()
+        elapsed = time.perf_counter() - start
+        if elapsed >= min_time:
+            break
+        number = number * 10 if elapsed == 0 else max(number * 2, int(number * min_time / elapsed) + 1)
+    timings = [elapsed / number]
+    for _ in range(repeat - 1):
+        start = time.perf_counter()
+        for _ in range(number):
+            fn()
+        timings.append((time.perf_counter() - start) / number)
+    return {
+        'number': number,
+        'repeat': repeat,
+        'min_us': round(min(timings) * 1e6, 3),
+        'median_us': round(statistics.median(timings) * 1e6, 3),
+        'mean_us': round(statistics.mean(timings) * 1e6, 3),
+    }
+
+
+def run(names=None, repeat=5, min_time=0.05, progress=None):
+    """
+    Runs the benchmarks whose name starts with one of names (all when empty).
+    :return: {name: measurement}
+    """
+    results = OrderedDict()
+    for name, setup in BENCHMARKS.items():
+        if names and not any(name.startswith(n) for n in names):
+            continue
+        with app.app_context():
+            results[name] = measure(setup(), repeat=repeat, min_time=min_time)
+        if progress:
+            progress(name, results[name])
+    return results
+
+
+def load_baseline(path=BASELINE_PATH):
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+
+def save_baseline(results, path=BASELINE_PATH):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    baseline = load_baseline(path) or {'results': {}}
+    baseline['results'].update(results)
+    baseline['meta'] = {'python': platform.python_version(), 'platform': platform.platform(),
+                        'database': db.engine.dialect.name, 'saved': datetime.now().isoformat()}
+    with open(path, 'w') as f:
+        json.dump(baseline, f, indent=2, sort_keys=True)
+
+
+def compare(results, baseline, threshold=0.2):
+    """
+    Compares medians to the baseline.
+    :return: list of (name, baseline median, median, ratio, status) where status is
+             'regression', 'improvement', 'ok' or 'new'
+    """
+    out = []
+    previous = (baseline or {}).get('results', {})
+    for name, r in results.items():
+        b = previous.get(name)
+        if b is None:
+            out.append((name, None, r['median_us'], None, 'new'))
+            continue
+        ratio = r['median_us'] / b['median_us'] if b['median_us'] else float('inf')
+        if ratio > 1 + threshold:
+            status = 'regression'
+        elif ratio < 1 - threshold:
+            status = 'improvement'
+        else:
+            status = 'ok'
+        out.append((name, b['median_us'], r['median_us'], round(ratio, 3), status))
+    return out
@@ -0,0 +1,172 @@
+'''
+caching.py caches the pages that are expensive to render (the dashboard and
+the listing pages) without a thundering herd when they expire. Every copy
+knows when it goes stale (CACHE_VIEW_TIMEOUT). The first request that sees a
+copy within CACHE_REFRESH_AHEAD seconds of that, or past it, takes the
+page's lock and renders it again in a background thread, while it and every
+other request keep getting the cached copy. A stale copy is served for up to
+CACHE_STALE_TTL seconds. A request that finds no copy at all renders the
+page if it gets the lock, otherwise it waits for the request that has it
+(single flight). After a poll, invalidate() marks the pages stale instead of
+deleting them and warm() renders them again, so no reader pays for the miss.
+The locks are cache keys, so with a shared cache (RedisCache, Memcached) the
+single flight holds across processes. With SimpleCache every process keeps
+its own copies, so the poller only warms the pages after a poll when the
+cache is shared and the poll changed data.
+:Example:
+        # >>> @app.route('/users')
+        # ... @cached_view('users')
+        # ... def users(): ...
+'''
+
+import threading
+import time
+from functools import wraps
+
+from flask import g, request, url_for
+
+from app import app, cache
+from app.logger_setup import logger
+
+# key: view function, filled by @cached_view
+VIEWS = {}
+
+_lock = threading.Lock()
+
+# number of invalidate() calls, and the number each consumer of changes (see changed()) last saw
+_generation = 0
+_seen = {}
+
+# cache types whose copies are only seen by the process that stored them
+LOCAL_CACHES = ('simplecache', 'simple', 'nullcache', 'null')
+
+
+def _copy_key(key):
+    return 'view:' + key
+
+
+def _lock_key(key):
+    return 'view-lock:' + key
+
+
+def _acquire(key):
+    with _lock:
+        return cache.add(_lock_key(key), True, timeout=app.config['CACHE_LOCK_TIMEOUT'])
+
+
+def _render(key, view, args=(), kwargs=None):
+    """Renders a page while holding its lock and keeps it unless the view returned an error response."""
+    try:
+        value = view(*args, **(kwargs or {}))
+        if isinstance(value, str):
+            timeout = app.config['CACHE_VIEW_TIMEOUT']
+            cache.set(_copy_key(key), (time.time() + timeout, value), timeout=timeout + app.config['CACHE_STALE_TTL'])
+        return value
+    finally:
+        cache.delete(_lock_key(key))
+
+
+def _refresh(key, view, path, args, kwargs):
+    with app.test_request_context(path):
+        try:
+            _render(key, view, args, kwargs)
+        except Exception as e:
+            logger.error('Refreshing the cached page {} failed: {}'.format(key, str(e)))
+
+
+def _fill(key, view, args, kwargs):
+    """Renders a page nobody has a copy of, or waits for the request that is already rendering it."""
+    deadline = time.monotonic() + app.config['CACHE_LOCK_TIMEOUT']
+    while not _acquire(key):
+        if time.monotonic() >= deadline:
+            return view(*args, **kwargs)
+        time.sleep(0.05)
+        copy = cache.get(_copy_key(key))
+        if copy is not None:
+            return copy[1]
+    return _render(key, view, args, kwargs)
+
+
+def cached_view(key):
+    """
+    Caches the page of a view under key, see the module docstring. Profiled requests and renders that must
+    see the database as it is now (g.render_fresh, see app/publish.py) skip the cache.
+    """
+    def decorator(f):
+        VIEWS[key] = f
+
+        @wraps(f)
+        def decorated_function(*args, **kwargs):
+            from app.profiler import is_authorized
+            if g.get('render_fresh') or is_authorized():
+                return f(*args, **kwargs)
+            copy = cache.get(_copy_key(key))
+            if copy is None:
+                return _fill(key, f, args, kwargs)
+            stale_at, value = copy
+            if time.time() >= stale_at - app.config['CACHE_REFRESH_AHEAD'] and _acquire(key):
+                threading.Thread(target=_refresh, args=(key, f, request.path, args, kwargs),
+                                 name='cache-refresh', daemon=True).start()
+            return value
+        return decorated_function
+    return decorator
+
+
+def invalidate(*keys):
+    """Marks cached pages stale (all of them by default). They are served until they are rendered again."""
+    global _generation
+    _generation += 1
+    for key in keys or VIEWS:
+        copy = cache.get(_copy_key(key))
+        if copy is not None:
+            cache.set(_copy_key(key), (0, copy[1]), timeout=app.config['CACHE_STALE_TTL'])
+
+
+def warm(keys=None):
+    """
+    Renders cached pages (all of them by default) unless another process is already rendering them.
+    :return: keys of the pages rendered
+    """
+    warmed = []
+    for key in keys or list(VIEWS):
+        view = VIEWS[key]
+        with app.test_request_context():
+            path = url_for(view.__name__)
+        if not _acquire(key):
+            continue
+        started = time.monotonic()
+        with app.test_request_context(path):
+            try:
+                _render(key, view)
+            except Exception as e:
+                logger.error('Warming the cached page {} failed: {}'.format(key, str(e)))
+                continue
+        warmed.append(key)
+        logger.debug('Warmed cached page {} in {:.0f} ms'.format(key, (time.monotonic() - started) * 1000))
+    return warmed
+
+
+def shared():
+    """Whether other processes (the web workers) see the copies this process stores."""
+    return str(app.config['CACHE_TYPE']).rsplit('.', 1)[-1].lower() not in LOCAL_CACHES
+
+
+def changed(consumer):
+    """:return: whether invalidate() ran, data changed, since the last call for the same consumer"""
+    seen = _seen.get(consumer, 0)
+    _seen[consumer] = _generation
+    return seen != _generation
+
+
+def warm_after_poll():
+    """
+    Renders the cached pages at the end of a poll cycle, if CACHE_WARM_AFTER_POLL, the cache is shared and
+    the cycle changed data (invalidate() ran).
+    """
+    if not app.config['CACHE_WARM_AFTER_POLL'] or not shared() or not changed('warm'):
+        return []
+    try:
+        return warm()
+    except Exception as e:
+        logger.warning('Failed to warm the cached pages: {}'.format(str(e)))
+        return []
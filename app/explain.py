@@ -0,0 +1,192 @@
+'''
+explain.py audits the query plans of the app's routes. Every route is requested
+through the test client with representative parameters taken from the
+database, the SQL it runs is captured and each SELECT is explained with the
+configured dialect:
+        - SQLite:     EXPLAIN QUERY PLAN
+        - PostgreSQL: EXPLAIN
+        - MySQL:      EXPLAIN
+        - SQL Server: SET SHOWPLAN_TEXT ON
+Plans with full table scans or temporary B-trees/sorts are flagged.
+ensure_indexes() creates the indexes declared in the models' __table_args__
+that are missing from the database.
+'''
+
+from collections import OrderedDict
+
+from sqlalchemy import event, func, inspect
+
+from app import app, db, cache
+from app.models import User, Workstation, Server, Product, History
+
+# (dialect, substring of a plan line, problem)
+PLAN_FLAGS = [
+    ('sqlite', 'USE TEMP B-TREE', 'temp b-tree'),
+    ('postgresql', 'Seq Scan', 'full scan'),
+    ('mysql', 'Using temporary', 'temp table'),
+    ('mysql', 'Using filesort', 'filesort'),
+    ('mssql', 'Table Scan', 'full scan'),
+    ('mssql', 'Clustered Index Scan', 'full scan'),
+    ('mssql', 'Sort(', 'sort'),
+]
+
+
+def ensure_indexes():
+    """
+    Creates the indexes declared on the models that do not exist in the database.
+    :return: names of the indexes created
+    """
+    created = []
+    with db.engine.connect() as conn:
+        if db.engine.dialect.name == 'sqlite':
+            # PRAGMA index_list answers from the connection's schema cache, a statement refreshes it
+            # when another connection changed the schema
+            conn.exec_driver_sql('SELECT count(*) FROM sqlite_master').scalar()
+        inspector = inspect(conn)
+        for table in db.metadata.sorted_tables:
+            if not inspector.has_table(table.name):
+                continue
+            existing = {i['name'] for i in inspector.get_indexes(table.name)}
+            for index in sorted(table.indexes, key=lambda i: i.name):
+                # indexes declared with .ddl_if(dialect=...) only exist on those databases
+                ddl_if = getattr(index, '_ddl_if', None)
+                if ddl_if is not None and ddl_if.dialect and db.engine.dialect.name not in ddl_if.dialect:
+                    continue
+                if index.name not in existing:
+                    index.create(conn)
+                    created.append(index.name)
+        conn.commit()
+    return created
+
+
+def _most_used(column, *joins):
+    q = db.session.query(column)
+    for condition in joins:
+        q = q.filter(condition)
+    return q.group_by(column).order_by(func.count().desc()).limit(1).scalar()
+
+
+def representative_values():
+    """Picks the most used user, workstation, server and product to fill in route parameters."""
+    return {
+        'username': _most_used(User.name, User.id == History.user_id),
+        'workstationname': _most_used(Workstation.name, Workstation.id == History.workstation_id),
+        'servername': _most_used(Server.name, Server.id == History.server_id),
+        'product_name': _most_used(Product.common_name, Product.id == History.product_id),
+        'product': _most_used(Product.internal_name, Product.id == History.product_id),
+    }
+
+
+def representative_routes(values=None):
+    """
+    Builds a url for every GET route of the app, filling in path and query parameters.
+    :return: {endpoint: url}
+    """
+    values = values or representative_values()
+    query_args = {
+        'server_availability': {'servername': values['servername']},
+        'product_availability': {'servername': values['servername'], 'product': values['product']},
+        'product_seats': {'servername': values['servername'], 'product': values['product']},
+    }
+    routes = OrderedDict()
+    with app.test_request_context():
+        from flask import url_for
+        for rule in sorted(app.url_map.iter_rules(), key=lambda r: r.rule):
+            if rule.endpoint == 'static' or 'GET' not in rule.methods or rule.endpoint in routes:
+                continue
+            args = {a: values.get(a) for a in rule.arguments}
+            if None in args.values():
+                continue
+            args.update({k: v for k, v in query_args.get(rule.endpoint, {}).items() if v is not None})
+            routes[rule.endpoint] = url_for(rule.endpoint, **args)
+    return routes
+
+
+def capture_queries(url):
+    """
+    Requests a url and returns the SELECT statements it ran as (statement, parameters), on the primary and
+    on the read replica GET requests are routed to.
+    """
+    statements = []
+
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        if not executemany and statement.lstrip().upper().startswith('SELECT'):
+            statements.append((statement, parameters))
+
+    engines = set(db.engines.values()) | {db.engine}
+    for engine in engines:
+        event.listen(engine, 'before_cursor_execute', before_cursor_execute)
+    try:
+        cache.clear()
+        response = app.test_client().get(url)
+    finally:
+        for engine in engines:
+            event.remove(engine, 'before_cursor_execute', before_cursor_execute)
+    return response.status_code, statements
+
+
+def explain(statement, parameters):
+    """
+    Explains a statement with the configured dialect.
+    :return: list of plan lines
+    """
+    dialect = db.engine.dialect.name
+    with db.engine.connect() as conn:
+        if dialect == 'sqlite':
+            rows = conn.exec_driver_sql('EXPLAIN QUERY PLAN ' + statement, parameters).fetchall()
+            return [r[-1] for r in rows]
+        if dialect == 'mssql':
+            conn.exec_driver_sql('SET SHOWPLAN_TEXT ON')
+            try:
+                result = conn.exec_driver_sql(statement, parameters)
+                lines = []
+                while True:
+                    lines.extend(r[0] for r in result.fetchall())
+                    if not result.cursor.nextset():
+                        break
+                return lines
+            finally:
+                conn.exec_driver_sql('SET SHOWPLAN_TEXT OFF')
+        rows = conn.exec_driver_sql('EXPLAIN ' + statement, parameters).fetchall()
+        if dialect == 'mysql':
+            # id, select_type, table, partitions, type, possible_keys, key, key_len, ref, rows, filtered, Extra
+            return ['{} type={} key={} {}'.format(r[2], r[4], r[6], r[-1] or '') for r in rows]
+        return [r[0] for r in rows]
+
+
+def problems(plan):
+    """Flags full table scans and temporary B-trees/sorts in a plan."""
+    dialect = db.engine.dialect.name
+    found = []
+    for line in plan:
+        if dialect == 'sqlite':
+            detail = line.strip()
+            # "SCAN history" is a full table scan, "SCAN history USING COVERING INDEX" only reads an index
+            if detail.startswith('SCAN ') and 'USING' not in detail:
+                found.append(('full scan', detail))
+        if dialect == 'mysql' and ' type=ALL ' in line:
+            found.append(('full scan', line.strip()))
+        for d, needle, problem in PLAN_FLAGS:
+            if d == dialect and needle in line:
+                found.append((problem, line.strip()))
+    return found
+
+
+def audit(routes=None):
+    """
+    Explains the queries of every route.
+    :return: list of dicts with the endpoint, url, status, and the statements with their plan and problems
+    """
+    report = []
+    for endpoint, url in (routes or representative_routes()).items():
+        status, statements = capture_queries(url)
+        seen = set()
+        entry = {'endpoint': endpoint, 'url': url, 'status': status, 'queries': []}
+        for statement, parameters in statements:
+            if statement in seen:
+                continue
+            seen.add(statement)
+            plan = explain(statement, parameters)
+            entry['queries'].append({'statement': statement, 'plan': plan, 'problems': problems(plan)})
+        report.append(entry)
+    return report
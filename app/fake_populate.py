@@ -1,6 +1,7 @@
 import random
 from datetime import timedelta, datetime
-from app.models import Server, Product, Updates, History, User, Workstation
+from app import db
+from app.models import Server, Product, Updates, History, User, Workstation, SessionBucket
 from app.arcgis_config import products
 
 
@@ -49,9 +50,11 @@ def populate():
 
     server_2 = get_server_id('gis-license-2')
 
-    update_1 = Updates.start(server_1)
+    update_1 = Updates.record(server_1, 'UP')
 
-    update_2 = Updates.start(server_2)
+    update_2 = Updates.record(server_2, 'UP')
+
+    db.session.commit()
 
 
 
@@ -162,9 +165,81 @@ def populate():
         if d[3]:
             check_in(server_id=d[1], h=id, data=d[2])
 
-    Updates.end(update_1, 'UP', '')
-    Updates.end(update_2, 'UP', '')
 
+def populate_large(servers=2, users=300, workstations=250, days=60, sessions_per_day=2, seed=0):
+    """
+    Fills the database with a realistic amount of data for load testing: hourly Updates per
+    server and a few sessions per user per workday, the ones of the last hours still open.
+    :return: number of History rows inserted
+    """
+    rnd = random.Random(seed)
+    now = datetime.now().replace(microsecond=0)
+    first_day = (now - timedelta(days=days)).replace(hour=0, minute=0, second=0)
+    names = list(products)
+    server_ids = [Server.upsert('gis-license-{}'.format(i + 1), 27000) for i in range(servers)]
+    product_ids = {}
+    for server_id in server_ids:
+        for name in names:
+            p = products[name]
+            product_ids[(server_id, name)] = Product.upsert(server_id, name, common_name=p['common_name'],
+                                                            category=p['category'], type=p['type'],
+                                                            license_out=0, license_total=rnd.choice([2, 5, 10, 25]))
+    db.session.bulk_insert_mappings(Workstation, [{'name': 'WS-{:05d}'.format(i)} for i in range(workstations)])
+    db.session.bulk_insert_mappings(User, [{'name': 'user{:05d}'.format(i)} for i in range(users)])
+    db.session.commit()
+    user_ids = [r[0] for r in db.session.query(User.id)]
+    workstation_ids = [r[0] for r in db.session.query(Workstation.id)]
+
+    updates = []
+    for server_id in server_ids:
+        t = first_day
+        while t < now:
+            status = 'UP' if rnd.random() > 0.01 else 'DOWN'
+            updates.append({'server_id': server_id, 'status': status, 'info': '' if status == 'UP' else 'Cannot connect',
+                            'time_start': t, 'time_complete': t + timedelta(seconds=2)})
+            t += timedelta(hours=1)
+    db.session.bulk_insert_mappings(Updates, updates)
+    db.session.commit()
+    update_ids = {server_id: db.session.query(Updates.id).filter(Updates.server_id == server_id).
+                  order_by(Updates.id.desc()).limit(1).scalar() for server_id in server_ids}
+
+    inserted = 0
+    rows = []
+    for day in range(days + 1):
+        date = first_day + timedelta(days=day)
+        if date.weekday() >= 5:
+            continue
+        for i, user_id in enumerate(user_ids):
+            workstation_id = workstation_ids[i % len(workstation_ids)]
+            for _ in range(rnd.randint(0, sessions_per_day * 2)):
+                server_id = rnd.choice(server_ids)
+                time_out = date + timedelta(minutes=rnd.randint(7 * 60, 17 * 60))
+                if time_out > now:
+                    continue
+                time_in = time_out + timedelta(minutes=rnd.randint(5, 8 * 60))
+                if time_in > now:
+                    time_in = None
+                rows.append({'user_id': user_id, 'workstation_id': workstation_id,
+                             'product_id': product_ids[(server_id, rnd.choice(names))],
+                             'update_id': update_ids[server_id], 'server_id': server_id,
+                             'time_out': time_out, 'time_in': time_in,
+                             'duration_minutes': History.minutes_between(time_out, time_in) if time_in else None})
+        if len(rows) >= 10000:
+            db.session.bulk_insert_mappings(History, rows)
+            db.session.commit()
+            inserted += len(rows)
+            rows = []
+    db.session.bulk_insert_mappings(History, rows)
+    inserted += len(rows)
+
+    open_sessions = dict(db.session.query(History.product_id, db.func.count()).filter(History.time_in == None).
+                         group_by(History.product_id))
+    for p in db.session.query(Product).all():
+        p.license_out = open_sessions.get(p.id, 0)
+        p.license_total = max(p.license_total, p.license_out)
+    db.session.commit()
+    SessionBucket.backfill()
+    return inserted
 
 if __name__ == "__main__":
     populate()
\ No newline at end of file
@@ -0,0 +1,214 @@
+'''
+federation.py keeps a central tracker in sync with the trackers of other
+sites. Every instance logs the sessions it inserts, checks in or deletes and the
+products whose seats change (models.ChangeLog). /data/changes serves the rows
+logged after a watermark as NDJSON, one record per line and a last line
+holding the new watermark:
+        {"seq":41,"kind":"product","server":"gis-1","name":"ARC/INFO",...,"out":3,"total":10}
+        {"seq":42,"kind":"history","id":977,"server":"gis-1","product":"ARC/INFO",...}
+        {"seq":43,"kind":"history","id":978,"deleted":true}
+        {"seq":43,"kind":"watermark","more":false}
+Rows logged more than once in a batch are sent once, with their current
+state. A deleted session (merged into another one by History.merge_gaps)
+deletes its copy. ``manage.py federate <url>`` pulls a feed from the last watermark
+applied (models.FederationSource) until it is caught up. Products are matched
+by server and name and sessions through models.FederatedSession, so a batch
+applied twice changes nothing. Entries older than CHANGELOG_RETENTION_DAYS are
+deleted by 'manage.py prune-changes'; a pull from a watermark before them gets
+410 "resync needed" instead of a feed with a hole in it.
+:Example:
+        # >>> records, watermark, more = changes(since=0, limit=1000)
+        # >>> pull('http://site-b:5000')
+'''
+
+import datetime
+import gzip
+import json
+import urllib.error
+import urllib.request
+
+from app import app, db
+from app.models import (Server, Product, Updates, History, User, Workstation, ChangeLog, FederationSource,
+                        FederatedSession, SessionBucket)
+
+_product_fields = ('common_name', 'category', 'type', 'version', 'expires')
+
+
+def _chunks(values, size=500):
+    values = list(values)
+    for i in range(0, len(values), size):
+        yield values[i:i + size]
+
+
+def _time(value):
+    return value.isoformat() if value else None
+
+
+def changes(since=0, limit=1000):
+    """
+    Rows changed after a watermark.
+    :param since: watermark of the last record applied
+    :param limit: number of change log entries read
+    :return: (records ordered by seq, watermark to ask for next, whether more entries are waiting)
+    """
+    entries = db.session.query(ChangeLog.id, ChangeLog.kind, ChangeLog.row_id, ChangeLog.time, ChangeLog.deleted). \
+        filter(ChangeLog.id > since).order_by(ChangeLog.id).limit(limit + 1).all()
+    more = len(entries) > limit
+    # Ids are assigned before commit, so on server databases an entry can become visible after a later
+    # one. Entries younger than CHANGES_SETTLE are left for the next pull. SQLite has a single writer.
+    cutoff = None
+    if db.engine.dialect.name != 'sqlite':
+        cutoff = datetime.datetime.now() - datetime.timedelta(seconds=app.config['CHANGES_SETTLE'])
+    watermark = since
+    latest = {}
+    deleted = set()
+    for seq, kind, row_id, time, is_deleted in entries[:limit]:
+        if cutoff is not None and time > cutoff:
+            more = False
+            break
+        latest[(kind, row_id)] = seq
+        if is_deleted:
+            deleted.add((kind, row_id))
+        else:
+            deleted.discard((kind, row_id))
+        watermark = seq
+
+    records = []
+    product_ids = {row_id: seq for (kind, row_id), seq in latest.items() if kind == 'product'}
+    for ids in _chunks(product_ids):
+        for p, server, port in db.session.query(Product, Server.name, Server.port). \
+                filter(Product.server_id == Server.id, Product.id.in_(ids)):
+            record = {'seq': product_ids[p.id], 'kind': 'product', 'server': server, 'port': port,
+                      'name': p.internal_name, 'out': p.license_out, 'total': p.license_total}
+            record.update((f, getattr(p, f)) for f in _product_fields)
+            records.append(record)
+    history_ids = {row_id: seq for (kind, row_id), seq in latest.items()
+                   if kind == 'history' and (kind, row_id) not in deleted}
+    records.extend({'seq': seq, 'kind': kind, 'id': row_id, 'deleted': True}
+                   for (kind, row_id), seq in latest.items() if (kind, row_id) in deleted)
+    for ids in _chunks(history_ids):
+        for r in db.session.query(History.id, Server.name, Server.port, Product.internal_name, User.name,
+                                  Workstation.name, History.time_out, History.time_in). \
+                filter(History.id.in_(ids), Product.id == History.product_id, Server.id == Product.server_id,
+                       User.id == History.user_id, Workstation.id == History.workstation_id):
+            records.append({'seq': history_ids[r[0]], 'kind': 'history', 'id': r[0], 'server': r[1], 'port': r[2],
+                            'product': r[3], 'user': r[4], 'workstation': r[5], 'time_out': _time(r[6]),
+                            'time_in': _time(r[7])})
+    records.sort(key=lambda r: r['seq'])
+    return records, watermark, more
+
+
+def ndjson(records, watermark, more):
+    """Encodes a batch of changes as NDJSON."""
+    lines = [json.dumps(r, separators=(',', ':')) for r in records]
+    lines.append(json.dumps({'seq': watermark, 'kind': 'watermark', 'more': more}, separators=(',', ':')))
+    return '\n'.join(lines) + '\n'
+
+
+def apply(source, lines):
+    """
+    Applies a batch of /data/changes to this database and moves the source's watermark.
+    :param source: FederationSource
+    :param lines: NDJSON lines of a batch
+    :return: (products applied, sessions applied, watermark, more)
+    """
+    records = [json.loads(line) for line in lines if line.strip()]
+    if not records or records[-1]['kind'] != 'watermark':
+        raise ValueError('Incomplete change feed from {}'.format(source.url))
+    trailer = records.pop()
+    servers = {}
+    updates = {}
+
+    def server_id(name, port):
+        if name not in servers:
+            servers[name] = Server.upsert(name, port)
+        return servers[name]
+
+    products = [r for r in records if r['kind'] == 'product']
+    sessions = [r for r in records if r['kind'] == 'history']
+    for r in products:
+        fields = {f: r[f] for f in _product_fields}
+        Product.upsert(server_id(r['server'], r['port']), r['name'], license_out=r['out'],
+                       license_total=r['total'], **fields)
+
+    for r in sessions:
+        copy = db.session.query(FederatedSession).filter_by(source_id=source.id, remote_id=r['id']).first()
+        if r.get('deleted'):
+            if copy is not None:
+                h = db.session.get(History, copy.history_id)
+                db.session.query(SessionBucket).filter(SessionBucket.history_id == h.id). \
+                    delete(synchronize_session=False)
+                db.session.delete(copy)
+                db.session.delete(h)
+                # an open row must be gone before the session it was merged into is reopened
+                db.session.flush()
+            continue
+        time_in = datetime.datetime.fromisoformat(r['time_in']) if r['time_in'] else None
+        if copy is not None:
+            h = db.session.get(History, copy.history_id)
+            # the source reopens sessions that were checked out again right after their check in
+            if h.time_in != time_in:
+                if h.time_in is not None:
+                    h.reopen()
+                if time_in is not None:
+                    h.check_in(time_in)
+            continue
+        sid = server_id(r['server'], r['port'])
+        product = db.session.query(Product.id).filter_by(server_id=sid, internal_name=r['product']).first()
+        if product is None:
+            raise ValueError('Session {} of {} refers to unknown product {}'.format(r['id'], source.url,
+                                                                                 r['product']))
+        if sid not in updates:
+            updates[sid] = Updates.record(sid, 'UP', 'Federated from {}'.format(source.url))
+        h = History(update_id=updates[sid], server_id=sid, product_id=product.id,
+                    user_id=User.add(r['user']), workstation_id=Workstation.add(r['workstation']),
+                    time_out=datetime.datetime.fromisoformat(r['time_out']), time_in=None)
+        db.session.add(h)
+        if time_in is not None:
+            h.check_in(time_in)
+        db.session.flush()
+        db.session.add(FederatedSession(source_id=source.id, remote_id=r['id'], history_id=h.id))
+
+    source.watermark = max(source.watermark, trailer['seq'])
+    source.last_pull = datetime.datetime.now()
+    db.session.commit()
+    return len(products), len(sessions), source.watermark, trailer['more']
+
+
+def fetch(url, since, limit=1000, timeout=60):
+    """:return: the lines of a batch of the /data/changes feed of another instance"""
+    request = urllib.request.Request('{}/data/changes?since={}&limit={}'.format(url.rstrip('/'), since, limit),
+                                     headers={'Accept-Encoding': 'gzip'})
+    try:
+        response = urllib.request.urlopen(request, timeout=timeout)
+    except urllib.error.HTTPError as e:
+        if e.code == 410:
+            raise ValueError('{} pruned the changes after watermark {}, resync needed'.format(url, since))
+        raise
+    with response:
+        body = response.read()
+        if response.headers.get('Content-Encoding') == 'gzip':
+            body = gzip.decompress(body)
+    return body.decode('utf-8').splitlines()
+
+
+def pull(url, limit=1000, timeout=60):
+    """
+    Pulls the feed of another instance until it is caught up.
+    :return: (products applied, sessions applied)
+    """
+    source = FederationSource.get(url)
+    total_products = total_sessions = 0
+    more = True
+    while more:
+        try:
+            n_products, n_sessions, _, more = apply(source, fetch(url, source.watermark, limit, timeout))
+        except Exception:
+            db.session.rollback()
+            raise
+        total_products += n_products
+        total_sessions += n_sessions
+    if total_products or total_sessions:
+        from app import caching
+        caching.invalidate()
+    return total_products, total_sessions
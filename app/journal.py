@@ -0,0 +1,210 @@
+'''
+journal.py decouples polling the license servers from writing to the
+database. With JOURNAL_DIR set, every poll (the raw lmstat output, or the
+error of a poll that failed, and the time it ran) is appended to an hourly
+segment file in that directory and fsync'd before the poller moves on, so a
+slow or unavailable database neither blocks nor loses polls. Each line is
+'<crc32> <json>'; a line whose checksum does not match, a write that was cut
+short by a crash, is skipped. A last line without its newline is waited for
+while the segment may still be written to and skipped once it is older. The applier ('manage.py apply-journal') reads
+the segments in order and applies each entry with read_server() (or
+read_server_totals() for totals-only polls), which parses it with the poll's
+own time, so sessions are checked in when they
+were last seen and not when the database came back. How far each segment was
+applied is kept in JournalCursor, committed after every entry. An entry that
+is not newer than the last poll applied for its server is skipped, so an
+entry applied twice (the applier stopped between the entry and its cursor)
+changes nothing. When the database fails the applier stops at that entry and
+retries it with a growing backoff, later entries wait so the order holds.
+Segments that were applied completely are deleted once nobody writes to them.
+:Example:
+        # $ export JOURNAL_DIR=/var/lib/license-tracker/journal
+        # $ python manage.py poll
+        # $ python manage.py apply-journal --interval 10
+'''
+
+import datetime
+import json
+import os
+import time
+import zlib
+
+from sqlalchemy.exc import SQLAlchemyError
+
+from app import app, db
+from app.models import JournalCursor
+from app.logger_setup import logger
+
+SEGMENT = 'journal-{:%Y%m%d%H}.log'
+
+
+def segment_name(when=None):
+    return SEGMENT.format(when or datetime.datetime.now())
+
+
+def encode(entry):
+    payload = json.dumps(entry, sort_keys=True, separators=(',', ':')).encode('utf-8')
+    return b'%08x ' % zlib.crc32(payload) + payload + b'\n'
+
+
+def decode(line):
+    """:return: the entry of a journal line or None if its checksum does not match"""
+    checksum, _, payload = line.rstrip(b'\n').partition(b' ')
+    try:
+        if int(checksum, 16) != zlib.crc32(payload):
+            return None
+        return json.loads(payload)
+    except ValueError:
+        return None
+
+
+def _fsync_directory(directory):
+    # makes a new segment's directory entry durable, directories can not be opened on Windows
+    if os.name == 'posix':
+        fd = os.open(directory, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+
+def append(entries, directory=None):
+    """Appends entries to the current segment and waits until they are on disk."""
+    directory = directory or app.config['JOURNAL_DIR']
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, segment_name())
+    data = b''.join(encode(e) for e in entries)
+    created = not os.path.exists(path)
+    fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT | getattr(os, 'O_BINARY', 0), 0o644)
+    try:
+        size = os.fstat(fd).st_size
+        if size:
+            with open(path, 'rb') as f:
+                f.seek(size - 1)
+                if f.read(1) != b'\n':
+                    # the last write was cut short, end that line so it is skipped on its own
+                    data = b'\n' + data
+        # one write, appends of other processes do not interleave with it
+        os.write(fd, data)
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+    if created:
+        _fsync_directory(directory)
+
+
+def segments(directory=None):
+    """:return: names of the journal's segments, oldest first"""
+    directory = directory or app.config['JOURNAL_DIR']
+    if not os.path.isdir(directory):
+        return []
+    return sorted(n for n in os.listdir(directory) if n.startswith('journal-') and n.endswith('.log'))
+
+
+def read_segment(path, offset=0, closed=False):
+    """
+    Reads the complete lines of a segment from a byte offset.
+    :param closed: nobody writes to the segment any more, a last line without its newline was cut short by a
+    crash and is returned as corrupt
+    :return: iterator of (entry or None if the line is corrupt, offset after the line)
+    """
+    with open(path, 'rb') as f:
+        f.seek(offset)
+        for line in f:
+            if not line.endswith(b'\n'):
+                if closed:
+                    yield None, offset + len(line)
+                # otherwise still being written
+                return
+            offset += len(line)
+            if line.strip():
+                yield decode(line), offset
+
+
+def apply_entry(entry):
+    from app.read_licenses import read_server, read_server_totals
+    s = {'hostname': entry['hostname'], 'port': entry['port']}
+    if entry.get('kind') == 'totals':
+        read_server_totals(s, entry=entry)
+    else:
+        read_server(s, entry=entry)
+
+
+def apply(directory=None, batch_size=None):
+    """
+    Applies the entries of the journal that were not applied yet, in order. Database errors are raised, the
+    entry that failed is the first one applied by the next call.
+    :param batch_size: stop after this many entries
+    :return: number of entries applied
+    """
+    directory = directory or app.config['JOURNAL_DIR']
+    applied = 0
+    written = _write_window()
+    for name in segments(directory):
+        path = os.path.join(directory, name)
+        cursor = JournalCursor.get(name)
+        for entry, offset in read_segment(path, cursor.offset, closed=name < written):
+            if entry is None:
+                logger.error('Skipped corrupt journal record in {} before offset {}'.format(name, offset))
+            else:
+                apply_entry(entry)
+                applied += 1
+            cursor.offset = offset
+            cursor.time_updated = datetime.datetime.now()
+            db.session.commit()
+            if batch_size and applied >= batch_size:
+                return applied
+    remove_applied(directory)
+    return applied
+
+
+def _write_window():
+    """:return: name of the oldest segment that may still be written to, the previous hour's"""
+    return segment_name(datetime.datetime.now() - datetime.timedelta(hours=1))
+
+
+def remove_applied(directory=None):
+    """Deletes the segments that were applied completely and are older than the previous hour."""
+    directory = directory or app.config['JOURNAL_DIR']
+    keep = _write_window()
+    removed = []
+    for name in segments(directory):
+        if name >= keep:
+            continue
+        path = os.path.join(directory, name)
+        cursor = db.session.get(JournalCursor, name)
+        if cursor is None or cursor.offset < os.path.getsize(path):
+            continue
+        os.remove(path)
+        db.session.delete(cursor)
+        db.session.commit()
+        removed.append(name)
+    return removed
+
+
+def run(interval=None, batch_size=None):
+    """Applies the journal every interval seconds until stopped, or once without an interval."""
+    from app import caching, publish
+    backoff = app.config['JOURNAL_RETRY_BACKOFF']
+    while True:
+        wait = interval
+        try:
+            applied = apply(batch_size=batch_size)
+            backoff = app.config['JOURNAL_RETRY_BACKOFF']
+            if applied:
+                logger.info('Applied {} journal entries'.format(applied))
+                caching.warm_after_poll()
+                publish.publish_after_poll()
+                if batch_size and applied >= batch_size:
+                    # more to apply
+                    wait = 0
+        except SQLAlchemyError as e:
+            db.session.rollback()
+            logger.error('Applying the journal failed, retrying in {}s: {}'.format(backoff, str(e)))
+            if interval is None:
+                raise
+            wait = backoff
+            backoff = min(backoff * 2, app.config['JOURNAL_RETRY_BACKOFF_MAX'])
+        if interval is None:
+            return
+        time.sleep(wait)
@@ -0,0 +1,151 @@
+'''
+loadtest.py drives a running instance of the app with a weighted mix of
+routes from many client threads and reports, per route, the throughput, the
+latency percentiles and the split between database and template time taken
+from the Server-Timing header (see profiler.SERVER_TIMING).
+:Example:
+        # >>> mix = parse_mix('/:5,/users:2,/servers/gis-license-1:1')
+        # >>> results = run('http://127.0.0.1:5050', mix, threads=16, requests=2000)
+        # >>> report(results, elapsed)
+'''
+
+import http.client
+import math
+import random
+import re
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit
+
+DEFAULT_MIX = '/:5,/users:2,/products:2,/servers:1,/workstations:1'
+
+_timing = re.compile(r'(\w+);dur=([\d.]+)')
+
+
+def parse_mix(mix):
+    """
+    Parses a route mix such as '/:5,/users:2'. Routes without a weight count once.
+    :return: list of (route, weight)
+    """
+    routes = []
+    for item in mix.split(','):
+        item = item.strip()
+        if not item:
+            continue
+        route, sep, weight = item.rpartition(':')
+        if not sep or not weight.isdigit():
+            route, weight = item, '1'
+        routes.append((route, int(weight)))
+    return routes
+
+
+def parse_server_timing(header):
+    """:return: {'db': ms, 'render': ms, 'app': ms, 'total': ms} from a Server-Timing header"""
+    return {name: float(dur) for name, dur in _timing.findall(header or '')}
+
+
+def percentile(values, p):
+    """Nearest-rank percentile of sorted values."""
+    if not values:
+        return None
+    k = max(int(math.ceil(p / 100.0 * len(values))) - 1, 0)
+    return values[min(k, len(values) - 1)]
+
+
+def _client(base_url, mix, count, deadline, seed, results, lock):
+    """Sends requests on one keep-alive connection until count or the deadline is reached."""
+    url = urlsplit(base_url)
+    conn = http.client.HTTPConnection(url.hostname, url.port or 80, timeout=60)
+    rnd = random.Random(seed)
+    routes = [r for r, w in mix]
+    weights = [w for r, w in mix]
+    sent = 0
+    local = []
+    while (count is None or sent < count) and (deadline is None or time.perf_counter() < deadline):
+        route = rnd.choices(routes, weights)[0]
+        start = time.perf_counter()
+        try:
+            conn.request('GET', url.path.rstrip('/') + route)
+            response = conn.getresponse()
+            response.read()
+            status = response.status
+            timing = parse_server_timing(response.getheader('Server-Timing'))
+        except (OSError, http.client.HTTPException):
+            conn.close()
+            status = 0
+            timing = {}
+        local.append((route, status, (time.perf_counter() - start) * 1000, timing))
+        sent += 1
+    conn.close()
+    with lock:
+        results.extend(local)
+
+
+def run(base_url, mix, threads=8, requests=None, duration=None, seed=0):
+    """
+    Runs the load test, stopping after a number of requests or seconds.
+    :return: (results, elapsed seconds), results are (route, status, latency ms, server timing)
+    """
+    if requests is None and duration is None:
+        requests = 1000
+    results = []
+    lock = threading.Lock()
+    per_thread = [None] * threads
+    if requests is not None:
+        per_thread = [requests // threads + (1 if i < requests % threads else 0) for i in range(threads)]
+    start = time.perf_counter()
+    deadline = start + duration if duration else None
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        for i in range(threads):
+            pool.submit(_client, base_url, mix, per_thread[i], deadline, seed + i, results, lock)
+    return results, time.perf_counter() - start
+
+
+def _mean(values):
+    return round(sum(values) / len(values), 3) if values else None
+
+
+def report(results, elapsed, threads=None):
+    """Summarizes the results overall and per route."""
+    by_route = defaultdict(list)
+    for r in results:
+        by_route[r[0]].append(r)
+
+    def summarize(rows):
+        latencies = sorted(r[2] for r in rows)
+        return {
+            'requests': len(rows),
+            'errors': sum(1 for r in rows if not 200 <= r[1] < 400),
+            'rps': round(len(rows) / elapsed, 2) if elapsed else None,
+            'mean_ms': _mean(latencies),
+            'p50_ms': round(percentile(latencies, 50), 3),
+            'p95_ms': round(percentile(latencies, 95), 3),
+            'p99_ms': round(percentile(latencies, 99), 3),
+            'max_ms': round(latencies[-1], 3),
+            'db_ms': _mean([r[3]['db'] for r in rows if 'db' in r[3]]),
+            'render_ms': _mean([r[3]['render'] for r in rows if 'render' in r[3]]),
+            'app_ms': _mean([r[3]['app'] for r in rows if 'app' in r[3]]),
+        }
+
+    return {
+        'elapsed_s': round(elapsed, 3),
+        'threads': threads,
+        'total': summarize(results) if results else None,
+        'routes': {route: summarize(rows) for route, rows in sorted(by_route.items())},
+    }
+
+
+def format_report(summary):
+    """Formats a report as a table."""
+    lines = ['{:<40} {:>7} {:>6} {:>8} {:>8} {:>8} {:>8} {:>8} {:>8}'.format(
+        'route', 'reqs', 'errors', 'rps', 'p50', 'p95', 'p99', 'db', 'render')]
+    rows = list(summary['routes'].items())
+    if summary['total']:
+        rows.append(('TOTAL', summary['total']))
+    for route, s in rows:
+        lines.append('{:<40} {:>7} {:>6} {:>8} {:>8} {:>8} {:>8} {:>8} {:>8}'.format(
+            route[:40], s['requests'], s['errors'], s['rps'], s['p50_ms'], s['p95_ms'], s['p99_ms'],
+            s['db_ms'] if s['db_ms'] is not None else '-', s['render_ms'] if s['render_ms'] is not None else '-'))
+    return '\n'.join(lines)
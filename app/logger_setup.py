@@ -17,15 +17,27 @@ You can build a log incrementally as so:
         >>> log = logger.new(date='now')
         >>> log = log.bind(weather='rainy')
         >>> log.info('user logged in', user='John')
+With LOG_ASYNC the file is written by a background thread: events are put on a
+queue and written in batches of up to LOG_BATCH_SIZE lines, at the latest
+LOG_FLUSH_INTERVAL seconds after they were logged (errors are written right
+away). Frequent info events can be sampled, either by LOG_SAMPLE_RATES or per
+call:
+        >>> logger.info('polled', sample=0.1)
 '''
 
+import atexit
 import datetime as dt
 import logging
-from logging.handlers import RotatingFileHandler
+import multiprocessing.util
+import os
+import queue
+import random
+import re
+from logging.handlers import RotatingFileHandler, QueueHandler, QueueListener
 import pytz
 
-from flask import request, session
-from structlog import wrap_logger
+from flask import request, session, g, has_request_context
+from structlog import wrap_logger, DropEvent
 from structlog.processors import JSONRenderer
 
 from app import app
@@ -39,35 +51,173 @@ if app.logger.handlers:
 
 TZ = pytz.timezone(app.config['TIMEZONE'])
 
+# (local hour, utc offset) of the last conversion. Offsets only change on the hour.
+_offset = (None, None)
+
+
+def utc_timestamp(now=None):
+    ''' ISO timestamp in UTC of a local (TIMEZONE) time, defaults to now. '''
+    global _offset
+    now = now or dt.datetime.now()
+    hour = now.replace(minute=0, second=0, microsecond=0)
+    cached_hour, offset = _offset
+    if cached_hour != hour:
+        offset = TZ.localize(hour, True).utcoffset()
+        _offset = (hour, offset)
+    return (now - offset).replace(tzinfo=dt.timezone.utc).isoformat()
+
+
+def request_fields():
+    ''' Fields of the current request, looked up once per request. '''
+    if not has_request_context():
+        return None
+    fields = g.get('_log_fields')
+    if fields is None:
+        fields = {}
+        if session:
+            fields['session_id'] = session.get('session_id')
+        try:
+            fields['ip_address'] = request.headers['X-Forwarded-For'].split(',')[0].strip()
+        except (KeyError, IndexError):
+            fields['ip_address'] = 'unknown'
+        g._log_fields = fields
+    return fields
+
+
 def add_fields(_, level, event_dict):
     ''' Add custom fields to each record. '''
-    now = dt.datetime.now()
-    event_dict['timestamp'] = TZ.localize(now, True).astimezone(pytz.utc).isoformat()
+    event_dict['timestamp'] = utc_timestamp()
     event_dict['level'] = level
+    fields = request_fields()
+    if fields:
+        event_dict.update(fields)
+    return event_dict
 
-    if session:
-        event_dict['session_id'] = session.get('session_id')
-    if request:
-        try:
-            event_dict['ip_address'] = request.headers['X-Forwarded-For'].split(',')[0].strip()
-        except:
-            event_dict['ip_address'] = 'unknown'
+
+_sample_rates = [(re.compile(pattern), rate) for pattern, rate in app.config.get('LOG_SAMPLE_RATES', {}).items()]
+
+
+def sample_events(_, level, event_dict):
+    ''' Drops a share of debug/info events that match LOG_SAMPLE_RATES or were logged with sample=<rate>. '''
+    rate = event_dict.pop('sample', None)
+    if level not in ('debug', 'info'):
+        return event_dict
+    if rate is None:
+        event = str(event_dict.get('event', ''))
+        rate = next((r for pattern, r in _sample_rates if pattern.match(event)), None)
+    if rate is not None:
+        if random.random() >= rate:
+            raise DropEvent
+        event_dict['sample_rate'] = rate
     return event_dict
 
+
+class BatchingFileHandler(RotatingFileHandler):
+    '''
+    A RotatingFileHandler that keeps formatted lines in memory and writes them in one go when
+    batch_size lines are pending, an error is logged or flush() is called.
+    '''
+
+    def __init__(self, *args, batch_size=100, **kwargs):
+        self.batch_size = batch_size
+        self._pending = []
+        super(BatchingFileHandler, self).__init__(*args, **kwargs)
+
+    def emit(self, record):
+        try:
+            self._pending.append(self.format(record) + self.terminator)
+        except Exception:
+            self.handleError(record)
+            return
+        if len(self._pending) >= self.batch_size or record.levelno >= logging.ERROR:
+            self.flush()
+
+    def flush(self):
+        self.acquire()
+        try:
+            if not self._pending:
+                return
+            data = ''.join(self._pending)
+            self._pending = []
+            if self.stream is None:
+                self.stream = self._open()
+            if self.maxBytes > 0 and self.stream.tell() + len(data) >= self.maxBytes:
+                self.doRollover()
+            self.stream.write(data)
+            self.stream.flush()
+        finally:
+            self.release()
+
+    def close(self):
+        self.flush()
+        super(BatchingFileHandler, self).close()
+
+
+class BatchingQueueListener(QueueListener):
+    ''' A QueueListener that flushes its handlers whenever the queue stays empty for flush_interval seconds. '''
+
+    def __init__(self, q, *handlers, flush_interval=1.0, **kwargs):
+        super(BatchingQueueListener, self).__init__(q, *handlers, **kwargs)
+        self.flush_interval = flush_interval
+
+    def dequeue(self, block):
+        while True:
+            try:
+                return self.queue.get(block, self.flush_interval)
+            except queue.Empty:
+                if not block:
+                    raise
+                for handler in self.handlers:
+                    handler.flush()
+
+    def stop(self):
+        if self._thread is not None:
+            super(BatchingQueueListener, self).stop()
+        for handler in self.handlers:
+            handler.flush()
+
+
+listener = None
+
 # Add a handler to write log messages to a file
 if app.config.get('LOG_FILENAME'):
-    file_handler = RotatingFileHandler(filename=app.config['LOG_FILENAME'],
+    file_handler = BatchingFileHandler(filename=app.config['LOG_FILENAME'],
                                        maxBytes=app.config['LOG_MAXBYTES'],
                                        backupCount=app.config['LOG_BACKUPS'],
+                                       batch_size=app.config.get('LOG_BATCH_SIZE', 100) if app.config.get(
+                                           'LOG_ASYNC') else 1,
                                        mode='a',
                                        encoding='utf-8')
     file_handler.setLevel(logging.DEBUG)
-    app.logger.addHandler(file_handler)
+    if app.config.get('LOG_ASYNC'):
+        queue_handler = QueueHandler(queue.Queue(-1))
+        listener = BatchingQueueListener(queue_handler.queue, file_handler,
+                                         flush_interval=app.config.get('LOG_FLUSH_INTERVAL', 1.0),
+                                         respect_handler_level=True)
+        listener.start()
+        atexit.register(listener.stop)
+        app.logger.addHandler(queue_handler)
+
+        def _restart_listener():
+            # A forked poller worker gets a copy of the queue but not the listener thread, and the
+            # queue's lock may have been held by that thread. Start over with a new queue and thread.
+            file_handler._pending = []
+            queue_handler.queue = listener.queue = queue.Queue(-1)
+            listener._thread = None
+            listener.start()
+
+        os.register_at_fork(after_in_child=_restart_listener)
+        # multiprocessing children exit without running atexit
+        multiprocessing.util.register_after_fork(
+            listener, lambda l: multiprocessing.util.Finalize(l, l.stop, exitpriority=10))
+    else:
+        app.logger.addHandler(file_handler)
 
 # Wrap the application logger with structlog to format the output
 logger = wrap_logger(
     app.logger,
     processors=[
+        sample_events,
         add_fields,
         JSONRenderer(indent=None)
     ]
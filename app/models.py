@@ -1,6 +1,9 @@
 import datetime
 from app import db
+from sqlalchemy import event, inspect, or_, and_, text, tuple_
+from sqlalchemy.dialects import postgresql, sqlite
 from sqlalchemy.ext.hybrid import hybrid_property
+from sqlalchemy.orm import Session
 import json
 
 # SQLAlchemy 2.0 compatibility
@@ -16,6 +19,110 @@ except ImportError:
         return isinstance(obj.__class__, DeclarativeMeta)
 
 
+# Called with (model, names) after rows were inserted by upsert_rows, which bypasses the ORM's mapper events
+insert_listeners = []
+
+# Rows per statement, SQL Server takes at most 2100 parameters
+UPSERT_BATCH_SIZE = 200
+
+
+def upsert_rows(model, rows, keys, update=False, open_column=None):
+    """
+    Inserts the rows whose keys are not in the table yet, in one statement per batch. Uses
+    INSERT ... ON CONFLICT on SQLite and PostgreSQL and MERGE on SQL Server, so concurrent pollers
+    cannot insert a row twice. Other databases fall back to a SELECT and an INSERT per row.
+    :param keys: columns of the unique index rows are matched on
+    :param update: update the other columns of existing rows when one of them changed
+    :param open_column: the unique index only covers rows where this column is NULL (partial index)
+    :return: ids of the rows inserted or updated
+    """
+    # rows of a statement must have the same columns
+    groups = {}
+    for row in rows:
+        groups.setdefault(tuple(sorted(row)), []).append(row)
+    ids = []
+    for columns, group in groups.items():
+        columns = [c for c in columns if c not in keys] if update else []
+        for start in range(0, len(group), UPSERT_BATCH_SIZE):
+            ids.extend(_upsert_batch(model.__table__, group[start:start + UPSERT_BATCH_SIZE], keys, columns,
+                                     open_column))
+    return ids
+
+
+def _upsert_batch(table, rows, keys, update, open_column):
+    dialect = db.engine.dialect.name
+    if dialect in ('sqlite', 'postgresql') and db.engine.dialect.insert_returning:
+        insert = (sqlite.insert if dialect == 'sqlite' else postgresql.insert)(table).values(rows)
+        where = table.c[open_column].is_(None) if open_column else None
+        if update:
+            insert = insert.on_conflict_do_update(
+                index_elements=keys, index_where=where,
+                set_={c: insert.excluded[c] for c in update},
+                where=or_(*[table.c[c].is_distinct_from(insert.excluded[c]) for c in update]))
+        else:
+            insert = insert.on_conflict_do_nothing(index_elements=keys, index_where=where)
+        return [r[0] for r in db.session.execute(insert.returning(table.c.id))]
+    if dialect == 'mssql':
+        return [r[0] for r in db.session.execute(*_merge(table, rows, keys, update, open_column))]
+    ids = []
+    for row in rows:
+        match = [table.c[k] == row[k] for k in keys]
+        if open_column:
+            match.append(table.c[open_column].is_(None))
+        existing = db.session.execute(db.select(table.c.id, *[table.c[c] for c in update]).
+                                      where(and_(*match))).first()
+        if existing is None:
+            ids.append(db.session.execute(table.insert().values(row)).inserted_primary_key[0])
+        elif any(existing[i + 1] != row[c] for i, c in enumerate(update)):
+            db.session.execute(table.update().where(table.c.id == existing[0]).values({c: row[c] for c in update}))
+            ids.append(existing[0])
+    return ids
+
+
+def _merge(table, rows, keys, update, open_column):
+    """A MERGE statement for upsert_rows on SQL Server, HOLDLOCK makes the match and insert atomic."""
+    quote = db.engine.dialect.identifier_preparer.quote
+    columns = list(rows[0])
+    params = {}
+    values = []
+    for i, row in enumerate(rows):
+        values.append('({})'.format(', '.join(':p{}_{}'.format(i, j) for j in range(len(columns)))))
+        params.update(('p{}_{}'.format(i, j), row[c]) for j, c in enumerate(columns))
+    on = ' AND '.join('t.{0} = s.{0}'.format(quote(k)) for k in keys)
+    if open_column:
+        on += ' AND t.{} IS NULL'.format(quote(open_column))
+    sql = 'MERGE {} WITH (HOLDLOCK) AS t USING (VALUES {}) AS s ({}) ON {}'.format(
+        db.engine.dialect.identifier_preparer.format_table(table), ', '.join(values),
+        ', '.join(quote(c) for c in columns), on)
+    if update:
+        # EXISTS (SELECT a EXCEPT SELECT b) is a NULL-safe a <> b
+        sql += ' WHEN MATCHED AND ({}) THEN UPDATE SET {}'.format(
+            ' OR '.join('EXISTS (SELECT t.{0} EXCEPT SELECT s.{0})'.format(quote(c)) for c in update),
+            ', '.join('t.{0} = s.{0}'.format(quote(c)) for c in update))
+    sql += ' WHEN NOT MATCHED THEN INSERT ({0}) VALUES ({1}) OUTPUT inserted.id;'.format(
+        ', '.join(quote(c) for c in columns), ', '.join('s.{}'.format(quote(c)) for c in columns))
+    return text(sql), params
+
+
+def _ids_by_name(model, column, names):
+    """:return: {name: id} of the rows with these names"""
+    ids = {}
+    names = list(names)
+    for start in range(0, len(names), UPSERT_BATCH_SIZE):
+        ids.update((name, i) for i, name in db.session.query(model.id, column).
+                   filter(column.in_(names[start:start + UPSERT_BATCH_SIZE])))
+    return ids
+
+
+def _inserted(model, ids, names):
+    """Tells insert_listeners about the names whose id was inserted."""
+    inserted = set(ids)
+    new = [name for name, i in names.items() if i in inserted]
+    if new:
+        for listener in insert_listeners:
+            listener(model, new)
+
+
 class Server(db.Model):
     __table_args__ = (
         db.Index('idx_server_name', 'name'),  # For filtering by server name
@@ -29,18 +136,132 @@ class Server(db.Model):
 
     @staticmethod
     def upsert(hostname, port):
-        p = db.session.query(Server).filter(Server.name == hostname).first()
-        if p is None:
-            p = Server(name=hostname,
-                       port=port)
-            db.session.add(p)
-        else:
-            p.port = port
+        inserted = upsert_rows(Server, [{'name': hostname, 'port': str(port)}], keys=['name'], update=True)
+        ids = _ids_by_name(Server, Server.name, [hostname])
         db.session.commit()
-        return p.id
+        _inserted(Server, inserted, ids)
+        return ids[hostname]
+
+
+class PollerWorker(db.Model):
+    """A polling worker process. Workers heartbeat every cycle, workers without a recent heartbeat are dead."""
+    __table_args__ = (
+        db.Index('idx_pollerworker_heartbeat', 'heartbeat'),  # For counting live workers
+    )
+    id = db.Column(db.String(64), primary_key=True)
+    heartbeat = db.Column(db.DateTime, nullable=False)
+
+    def __repr__(self):
+        return '<PollerWorker %r>' % self.id
+
+    @staticmethod
+    def beat(worker_id, now):
+        updated = db.session.query(PollerWorker).filter_by(id=worker_id).update({"heartbeat": now})
+        if not updated:
+            db.session.add(PollerWorker(id=worker_id, heartbeat=now))
+        db.session.commit()
+
+    @staticmethod
+    def live_count(since):
+        return db.session.query(PollerWorker).filter(PollerWorker.heartbeat > since).count()
+
+    @staticmethod
+    def remove(worker_id):
+        db.session.query(PollerWorker).filter_by(id=worker_id).delete()
+        db.session.commit()
+
+
+class ServerLease(db.Model):
+    """Lease on a license server. Only the worker holding an unexpired lease polls the server."""
+    __table_args__ = (
+        db.Index('idx_serverlease_worker_id', 'worker_id'),  # For finding a worker's leases
+        db.Index('idx_serverlease_expires', 'expires'),  # For finding expired leases
+    )
+    server_id = db.Column(db.Integer, db.ForeignKey("server.id"), primary_key=True)
+    worker_id = db.Column(db.String(64), default=None)
+    expires = db.Column(db.DateTime, default=None)
+    FlexLM_server = db.relationship('Server')
+
+    def __repr__(self):
+        return '<ServerLease %r>' % self.server_id
+
+
+class ServerState(db.Model):
+    """
+    Polling state of a license server. Tracks consecutive failures so servers that are DOWN are probed
+    less often (circuit breaker): CLOSED polls every cycle, OPEN skips the server until next_attempt,
+    HALF_OPEN is a single probe after which the circuit closes or opens again with a longer backoff.
+    """
+    server_id = db.Column(db.Integer, db.ForeignKey("server.id"), primary_key=True)
+    consecutive_failures = db.Column(db.Integer, nullable=False, default=0)
+    circuit = db.Column(db.String(9), nullable=False, default='CLOSED')
+    next_attempt = db.Column(db.DateTime, default=None)
+    last_error = db.Column(db.String(255), default=None)
+    last_detail_poll = db.Column(db.DateTime, default=None)  # Last full (per-user) poll
+    # sha256 of the lmstat output of the last successful full poll, and of each of its features (JSON)
+    fingerprint = db.Column(db.String(64), default=None)
+    feature_fingerprints = db.Column(db.Text, default=None)
+    FlexLM_server = db.relationship('Server')
+
+    def __repr__(self):
+        return '<ServerState %r>' % self.server_id
+
+    @staticmethod
+    def get(server_id):
+        s = db.session.get(ServerState, server_id)
+        if s is None:
+            s = ServerState(server_id=server_id, consecutive_failures=0, circuit='CLOSED')
+            db.session.add(s)
+            db.session.commit()
+        return s
+
+    def allow(self, now):
+        """Checks if the server should be polled now. An OPEN circuit becomes HALF_OPEN once its backoff is over."""
+        if self.circuit == 'OPEN':
+            if self.next_attempt and now < self.next_attempt:
+                return False
+            self.circuit = 'HALF_OPEN'
+            db.session.commit()
+        return True
+
+    def failure(self, error, now, threshold, backoff, backoff_max):
+        """
+        Records a failed poll. The circuit opens after `threshold` consecutive failures and the wait before
+        the next probe doubles with each failure, starting at `backoff` seconds, up to `backoff_max` seconds.
+        """
+        self.consecutive_failures += 1
+        self.last_error = error[:255] if error else None
+        # the sessions were checked in, the next successful poll writes everything again
+        self.fingerprint = self.feature_fingerprints = None
+        if self.consecutive_failures >= threshold:
+            delay = min(backoff * 2 ** (self.consecutive_failures - threshold), backoff_max)
+            self.circuit = 'OPEN'
+            self.next_attempt = now + datetime.timedelta(seconds=delay)
+        db.session.commit()
+
+    def forget(self, names):
+        """Makes the next full poll write these features even if its output matches the last one."""
+        self.fingerprint = None
+        if self.feature_fingerprints:
+            features = json.loads(self.feature_fingerprints)
+            for name in names:
+                features.pop(name, None)
+            self.feature_fingerprints = json.dumps(features, sort_keys=True)
+
+    def success(self):
+        if self.consecutive_failures or self.circuit != 'CLOSED':
+            self.consecutive_failures = 0
+            self.circuit = 'CLOSED'
+            self.next_attempt = None
+            self.last_error = None
+            db.session.commit()
 
 
 class Updates(db.Model):
+    """
+    Status of a license server as run-length intervals: polls with the same status as the server's last
+    interval extend it (time_complete, polls) instead of adding a row. info is the last error.
+    """
     __table_args__ = (
         db.Index('idx_updates_server_id', 'server_id'),  # For JOINs with Server
         db.Index('idx_updates_status', 'status'),  # For filtering by status
@@ -54,25 +275,117 @@ class Updates(db.Model):
     info = db.Column(db.String(255), default=None)
     time_start = db.Column(db.DateTime)
     time_complete = db.Column(db.DateTime, default=None)
+    polls = db.Column(db.Integer, default=1)  # Polls in the interval
     FlexLM_server = db.relationship('Server')
 
     def __repr__(self):
         return '<Updates %r>' % self.id
 
     @staticmethod
-    def start(server_id):
-        insert = Updates(server_id=server_id, time_start=datetime.datetime.now(), status='UPDATING', info=None)
-        db.session.add(insert)
-        db.session.commit()
-        return insert.id
+    def record(server_id, status, info=None, now=None):
+        """
+        Records a poll: extends the server's last interval if it has the same status, otherwise starts a
+        new one. Flushed, not committed.
+        :return: id of the interval
+        """
+        now = now or datetime.datetime.now()
+        last = db.session.query(Updates).filter(Updates.server_id == server_id). \
+            order_by(Updates.time_start.desc(), Updates.id.desc()).first()
+        if last is not None and last.status == status:
+            last.time_complete = now
+            last.polls = (last.polls or 1) + 1
+            if info:
+                last.info = info[:255]
+        else:
+            last = Updates(server_id=server_id, status=status, info=info[:255] if info else None, time_start=now,
+                           time_complete=now, polls=1)
+            db.session.add(last)
+        db.session.flush()
+        return last.id
 
     @staticmethod
-    def end(update_id, status=None, info=None):
-        db.session.query(Updates).filter_by(id=update_id).update({"status": status,
-                                                                  "info": info,
-                                                                  "time_complete": datetime.datetime.now()},
-                                                                 synchronize_session='fetch')
-        db.session.commit()
+    def note(update_id, info):
+        """Sets the last error of an interval, for a poll that failed after it was recorded."""
+        db.session.query(Updates).filter_by(id=update_id).update({"info": info[:255]}, synchronize_session='fetch')
+
+    @staticmethod
+    def history_page(server_id, before=None, limit=50):
+        """
+        Intervals of a server that were not UP, newest first, one page at a time (keyset pagination on
+        idx_updates_server_time).
+        :param before: (time_start, id) of the last interval of the previous page
+        :return: (intervals, (time_start, id) to pass for the next page or None)
+        """
+        q = db.session.query(Updates).filter(Updates.server_id == server_id, Updates.status != 'UP')
+        if before is not None:
+            q = q.filter(or_(Updates.time_start < before[0],
+                             and_(Updates.time_start == before[0], Updates.id < before[1])))
+        rows = q.order_by(Updates.time_start.desc(), Updates.id.desc()).limit(limit + 1).all()
+        if len(rows) > limit:
+            return rows[:limit], (rows[limit - 1].time_start, rows[limit - 1].id)
+        return rows, None
+
+    @staticmethod
+    def uptime(server_id, start, end):
+        """
+        Time a server spent in each status between start and end. A status lasts until the next interval
+        starts, the last one until its last poll.
+        :return: ({status: seconds}, share of the observed time the server was UP or None)
+        """
+        columns = (Updates.status, Updates.time_start, Updates.time_complete)
+        before = db.session.query(*columns).filter(Updates.server_id == server_id, Updates.time_start <= start). \
+            order_by(Updates.time_start.desc(), Updates.id.desc()).first()
+        rows = ([before] if before else []) + \
+            db.session.query(*columns).filter(Updates.server_id == server_id, Updates.time_start > start,
+                                              Updates.time_start < end). \
+            order_by(Updates.time_start, Updates.id).all()
+        seconds = {}
+        for i, (status, time_start, time_complete) in enumerate(rows):
+            until = rows[i + 1][1] if i + 1 < len(rows) else time_complete
+            span = (min(until or time_start, end) - max(time_start, start)).total_seconds()
+            if status and span > 0:
+                seconds[status] = seconds.get(status, 0) + span
+        total = sum(seconds.values())
+        return seconds, (seconds.get('UP', 0) / total if total else None)
+
+    @staticmethod
+    def compact(batch_size=10000):
+        """
+        Merges consecutive rows of a server with the same status, recorded before polls were run-length
+        encoded, into the first row of each run. Sessions are moved to that row.
+        :return: number of rows merged away
+        """
+        total = 0
+        for (server_id,) in db.session.query(Updates.server_id).distinct().all():
+            head = None
+            after = None
+            while True:
+                q = db.session.query(Updates).filter(Updates.server_id == server_id)
+                if after is not None:
+                    q = q.filter(or_(Updates.time_start > after[0],
+                                     and_(Updates.time_start == after[0], Updates.id > after[1])))
+                batch = q.order_by(Updates.time_start, Updates.id).limit(batch_size).all()
+                if not batch:
+                    break
+                merged = {}
+                for u in batch:
+                    if head is not None and u.status == head.status:
+                        head.time_complete = max(filter(None, (head.time_complete, u.time_complete, u.time_start)))
+                        head.polls = (head.polls or 1) + (u.polls or 1)
+                        head.info = u.info or head.info
+                        merged.setdefault(head.id, []).append(u.id)
+                    else:
+                        head = u
+                after = (batch[-1].time_start, batch[-1].id)
+                for head_id, ids in merged.items():
+                    for start in range(0, len(ids), UPSERT_BATCH_SIZE):
+                        chunk = ids[start:start + UPSERT_BATCH_SIZE]
+                        db.session.query(History).filter(History.update_id.in_(chunk)). \
+                            update({"update_id": head_id}, synchronize_session=False)
+                        db.session.query(Updates).filter(Updates.id.in_(chunk)).delete(synchronize_session=False)
+                    total += len(ids)
+                db.session.commit()
+        return total
 
     @staticmethod
     def clear():
@@ -110,22 +423,54 @@ class Product(db.Model):
 
     @staticmethod
     def reset(server_id):
+        in_use = db.session.query(Product.id).filter(Product.server_id == server_id, Product.license_out != 0)
+        ChangeLog.record('product', [p.id for p in in_use])
         db.session.query(Product).filter_by(server_id=server_id).update({"license_out": 0})
         db.session.flush()
 
     @staticmethod
     def upsert(server_id, internal_name, **kwargs):
-        p = db.session.query(Product).filter_by(internal_name=internal_name, server_id=server_id)
-        if not p.first():
-            p = Product(server_id=server_id,
-                        internal_name=internal_name,
-                        **kwargs)
-            db.session.add(p)
-            db.session.commit()
-            return p.id
-        else:
-            p.update(kwargs)
-            return p.first().id
+        return Product.upsert_many(server_id, [dict(kwargs, internal_name=internal_name)])[internal_name]
+
+    @staticmethod
+    def upsert_many(server_id, products):
+        """
+        Adds or updates the products of a server in one statement, rows are only written when a
+        column changed.
+        :param products: list of {'internal_name', 'common_name', 'license_out', ...}
+        :return: {internal_name: id}
+        """
+        if not products:
+            return {}
+        rows = [dict(p, server_id=server_id) for p in products]
+        changed = upsert_rows(Product, rows, keys=['server_id', 'internal_name'], update=True)
+        ChangeLog.record('product', changed)
+        ids = {}
+        names = [p['internal_name'] for p in products]
+        for start in range(0, len(names), UPSERT_BATCH_SIZE):
+            ids.update((name, i) for i, name in db.session.query(Product.id, Product.internal_name).
+                       filter(Product.server_id == server_id,
+                              Product.internal_name.in_(names[start:start + UPSERT_BATCH_SIZE])))
+        db.session.commit()
+        _inserted(Product, changed, {p['common_name']: ids[p['internal_name']] for p in products if 'common_name' in p})
+        return ids
+
+    @staticmethod
+    def update_counts(server_id, counts):
+        """
+        Updates the seats in use and issued of a server's products in one pass. Products that are not
+        in the database yet are left to the full poll.
+        :param counts: {internal_name: (license_out, license_total)}
+        :return: internal names of the products whose counts changed
+        """
+        changed = []
+        for p in db.session.query(Product).filter_by(server_id=server_id).all():
+            c = counts.get(p.internal_name)
+            if c is not None and (p.license_out, p.license_total) != c:
+                p.license_out, p.license_total = c
+                changed.append(p.internal_name)
+        db.session.commit()
+        return changed
 
     @staticmethod
     def query(internal_name, server_id):
@@ -133,6 +478,59 @@ class Product(db.Model):
         return p.id
 
 
+class SeatSample(db.Model):
+    """
+    Seats in use of a product at one poll. Polls append rows here, timeseries.compact() folds the days
+    before today into SeatSeries.
+    """
+    __table_args__ = (
+        db.Index('idx_seatsample_product_time', 'product_id', 'time'),  # For a product's recent samples
+        db.Index('idx_seatsample_time', 'time'),  # For compacting past days
+    )
+    id = db.Column(db.Integer, primary_key=True)
+    product_id = db.Column(db.Integer, db.ForeignKey("product.id"), nullable=False)
+    time = db.Column(db.DateTime, nullable=False)
+    value = db.Column(db.Integer, nullable=False)
+
+    def __repr__(self):
+        return '<SeatSample %r %r>' % (self.product_id, self.time)
+
+
+class SeatSeries(db.Model):
+    """
+    Seats in use of a product over time. One row per product per past day holding one sample per poll,
+    delta-encoded into `samples` (see app/timeseries.py) when the day's SeatSample rows are compacted.
+    """
+    __table_args__ = (
+        db.Index('idx_seatseries_day', 'day'),  # For pruning old days
+    )
+    product_id = db.Column(db.Integer, db.ForeignKey("product.id"), primary_key=True)
+    day = db.Column(db.Date, primary_key=True)
+    samples = db.Column(db.LargeBinary, nullable=False, default=b'')
+    count = db.Column(db.Integer, nullable=False, default=0)
+    last_offset = db.Column(db.Integer, default=None)  # Seconds since midnight of the last sample
+    last_value = db.Column(db.Integer, default=None)
+
+    def __repr__(self):
+        return '<SeatSeries %r %r>' % (self.product_id, self.day)
+
+
+class UserSketch(db.Model):
+    """
+    Distinct users of a product on a day as a compressed HyperLogLog sketch (see app/sketch.py), one row
+    per product per day.
+    """
+    __table_args__ = (
+        db.Index('idx_usersketch_day', 'day'),  # For ranges over all products
+    )
+    product_id = db.Column(db.Integer, db.ForeignKey("product.id"), primary_key=True)
+    day = db.Column(db.Date, primary_key=True)
+    registers = db.Column(db.LargeBinary, nullable=False)
+
+    def __repr__(self):
+        return '<UserSketch %r %r>' % (self.product_id, self.day)
+
+
 class Workstation(db.Model):
     __table_args__ = (
         db.Index('idx_workstation_name', 'name'),  # For filtering by workstation name
@@ -145,13 +543,17 @@ class Workstation(db.Model):
 
     @staticmethod
     def add(workstation):
-        w = db.session.query(Workstation).filter_by(name=workstation).first()
-        if w is None:
-            w = Workstation(name=workstation)
-            db.session.add(w)
-            db.session.commit()
-            return db.session.query(Workstation).filter_by(name=workstation).first().id
-        return w.id
+        return Workstation.add_many([workstation])[workstation]
+
+    @staticmethod
+    def add_many(names):
+        """:return: {name: id}, adding the workstations that do not exist yet"""
+        names = set(names)
+        inserted = upsert_rows(Workstation, [{'name': n} for n in sorted(names)], keys=['name'])
+        ids = _ids_by_name(Workstation, Workstation.name, names)
+        db.session.commit()
+        _inserted(Workstation, inserted, ids)
+        return ids
 
 
 class User(db.Model):
@@ -166,12 +568,17 @@ class User(db.Model):
 
     @staticmethod
     def add(username):
-        u = db.session.query(User).filter_by(name=username).first()
-        if u is None:
-            u = User(name=username)
-            db.session.add(u)
-            db.session.commit()
-        return u.id
+        return User.add_many([username])[username]
+
+    @staticmethod
+    def add_many(names):
+        """:return: {name: id}, adding the users that do not exist yet"""
+        names = set(names)
+        inserted = upsert_rows(User, [{'name': n} for n in sorted(names)], keys=['name'])
+        ids = _ids_by_name(User, User.name, names)
+        db.session.commit()
+        _inserted(User, inserted, ids)
+        return ids
 
     @staticmethod
     def delete(name):
@@ -190,6 +597,7 @@ class History(db.Model):
         db.Index('idx_history_workstation_id', 'workstation_id'),  # For JOINs with Workstation
         db.Index('idx_history_product_id', 'product_id'),  # For JOINs with Product
         db.Index('idx_history_update_id', 'update_id'),  # For JOINs with Updates
+        db.Index('idx_history_server_timein', 'server_id', 'time_in'),  # Open sessions of a server
         # Date indexes - for sorting and filtering
         db.Index('idx_history_time_out', 'time_out'),  # For sorting by checkout time
         db.Index('idx_history_time_in', 'time_in'),  # For filtering active licenses (time_in IS NULL)
@@ -197,18 +605,31 @@ class History(db.Model):
         db.Index('idx_history_user_timein', 'user_id', 'time_in'),  # User + active status queries
         db.Index('idx_history_product_timein', 'product_id', 'time_in'),  # Product + active status queries
         db.Index('idx_history_workstation_timein', 'workstation_id', 'time_in'),  # Workstation + active status
+        # Covering indexes - session time sums per user/workstation/product read only the index
+        db.Index('idx_history_user_product_duration', 'user_id', 'product_id', 'duration_minutes', 'time_in'),
+        db.Index('idx_history_workstation_product_duration', 'workstation_id', 'product_id', 'duration_minutes',
+                 'time_in'),
+        db.Index('idx_history_product_user_duration', 'product_id', 'user_id', 'duration_minutes', 'time_in'),
+        # One open session per user, workstation and product. A partial (filtered) index, which MySQL
+        # does not have, so it is only created on SQLite, PostgreSQL and SQL Server.
+        db.Index('uq_history_open_session', 'user_id', 'workstation_id', 'product_id', unique=True,
+                 sqlite_where=text('time_in IS NULL'), postgresql_where=text('time_in IS NULL'),
+                 mssql_where=text('time_in IS NULL')).ddl_if(dialect=('sqlite', 'postgresql', 'mssql')),
     )
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey("user.id"), nullable=False)
     workstation_id = db.Column(db.Integer, db.ForeignKey("workstation.id"), nullable=False)
     product_id = db.Column(db.Integer, db.ForeignKey("product.id"), nullable=False)
     update_id = db.Column(db.Integer, db.ForeignKey("updates.id"), nullable=False)
+    server_id = db.Column(db.Integer, db.ForeignKey("server.id"), nullable=True)  # Denormalized from Product
     time_out = db.Column(db.DateTime, nullable=False)
     time_in = db.Column(db.DateTime, nullable=True)
+    duration_minutes = db.Column(db.Integer, nullable=True)  # Set when the session is checked in
     FlexLM_product = db.relationship('Product')
     FlexLM_update = db.relationship('Updates')
     FlexLM_user = db.relationship('User')
     FlexLM_workstation = db.relationship('Workstation')
+    FlexLM_server = db.relationship('Server')
 
     def __repr__(self):
         return '<History %r>' % self.id
@@ -222,36 +643,227 @@ class History(db.Model):
 
     @staticmethod
     def add(update_id, server_id, **kwargs):
+        History.add_many(update_id, server_id, [kwargs])
+        return db.session.query(History.id).filter_by(user_id=kwargs.get('user_id'),
+                                                      workstation_id=kwargs.get('workstation_id'),
+                                                      product_id=kwargs.get('product_id'),
+                                                      time_in=None).scalar()
 
-        h = db.session.query(History).filter_by(user_id=kwargs.get('user_id'),
-                                                workstation_id=kwargs.get('workstation_id'),
-                                                product_id=kwargs.get('product_id'),
-                                                time_in=None).join(Product).filter_by(server_id=server_id).first()
-        if h is None:
-            h = History(update_id=update_id,
-                        time_in=None,
-                        **kwargs)
-            db.session.add(h)
-            db.session.commit()
-        return h.id
+    @staticmethod
+    def add_many(update_id, server_id, sessions, gap_minutes=0):
+        """
+        Opens the sessions that are not open yet, in one statement per batch (see upsert_rows and
+        uq_history_open_session).
+        :param sessions: list of {'user_id', 'workstation_id', 'product_id', 'time_out'}
+        :param gap_minutes: a session checked in at most this long before it is seen again is reopened
+        instead of opening a new row (see reopen_recent)
+        :return: ids of the sessions opened
+        """
+        rows = {}
+        for s in sorted(sessions, key=lambda s: s['time_out'], reverse=True):
+            rows[(s['user_id'], s['workstation_id'], s['product_id'])] = dict(s, update_id=update_id,
+                                                                              server_id=server_id)
+        reopened = []
+        if gap_minutes and rows:
+            reopened = History.reopen_recent(server_id, {k: r['time_out'] for k, r in rows.items()},
+                                             datetime.timedelta(minutes=gap_minutes))
+            for h in reopened:
+                del rows[(h.user_id, h.workstation_id, h.product_id)]
+            db.session.flush()
+        opened = upsert_rows(History, list(rows.values()), keys=['user_id', 'workstation_id', 'product_id'],
+                             open_column='time_in')
+        ChangeLog.record('history', opened)
+        db.session.commit()
+        return [h.id for h in reopened] + opened
+
+    @staticmethod
+    def reopen_recent(server_id, sessions, gap):
+        """
+        Reopens the last row of sessions that are checked out again within gap of being checked in, so
+        a session that was missing from a poll or two (a FlexLM reconnect, an lmutil hiccup) keeps its
+        row. Read through idx_history_server_timein.
+        :param sessions: {(user_id, workstation_id, product_id): time_out} of the checked out sessions
+        :param gap: datetime.timedelta
+        :return: History rows reopened
+        """
+        still_open = {tuple(r) for r in db.session.query(History.user_id, History.workstation_id,
+                                                         History.product_id).
+                      filter(History.server_id == server_id, History.time_in == None)}
+        candidates = {k: t for k, t in sessions.items() if k not in still_open}
+        if not candidates:
+            return []
+        latest = {}
+        for h in db.session.query(History).filter(History.server_id == server_id,
+                                                  History.time_in >= min(candidates.values()) - gap). \
+                order_by(History.time_in, History.id):
+            key = (h.user_id, h.workstation_id, h.product_id)
+            if key in candidates:
+                latest[key] = h
+        reopened = [h for key, h in latest.items() if h.time_in >= candidates[key] - gap]
+        for h in reopened:
+            h.reopen()
+        return reopened
+
+    @staticmethod
+    def close_duplicates():
+        """
+        Checks in all but the first of the open sessions of the same user, workstation and product,
+        which uq_history_open_session does not allow.
+        :return: number of sessions checked in
+        """
+        dt = datetime.datetime.now().replace(second=0, microsecond=0)
+        groups = db.session.query(History.user_id, History.workstation_id, History.product_id,
+                                  db.func.min(History.id)).filter(History.time_in == None). \
+            group_by(History.user_id, History.workstation_id, History.product_id). \
+            having(db.func.count(History.id) > 1).all()
+        total = 0
+        for user_id, workstation_id, product_id, first in groups:
+            for h in db.session.query(History).filter(History.user_id == user_id,
+                                                      History.workstation_id == workstation_id,
+                                                      History.product_id == product_id,
+                                                      History.time_in == None, History.id != first):
+                h.check_in(dt)
+                total += 1
+        db.session.commit()
+        return total
 
     @staticmethod
     def time_in_none(server_id):
-        t = db.session.query(History).filter_by(time_in=None).join(Product).filter_by(server_id=server_id).all()
+        t = db.session.query(History).filter_by(server_id=server_id, time_in=None).all()
         return t
 
+    @staticmethod
+    def minutes_between(time_out, time_in):
+        return int(round((time_in - time_out).total_seconds() / 60.0))
+
+    def check_in(self, dt):
+        self.time_in = dt
+        self.duration_minutes = History.minutes_between(self.time_out, dt)
+        if self.id is None:
+            db.session.flush()
+        db.session.add_all(SessionBucket(**b) for b in SessionBucket.buckets(self.id, self.product_id,
+                                                                             self.time_out, dt))
+
+    def reopen(self):
+        """Undoes the check in of a session, removing its buckets."""
+        db.session.query(SessionBucket).filter(SessionBucket.history_id == self.id).delete(synchronize_session=False)
+        self.time_in = None
+        self.duration_minutes = None
+
+    @staticmethod
+    def merge_gaps(gap_minutes, batch_size=500):
+        """
+        Merges the rows of a session that was checked in and out again within gap_minutes into its first
+        row, for data recorded before reopen_recent. Keys with more than one row are read in batches.
+        :return: number of rows merged away
+        """
+        gap = datetime.timedelta(minutes=gap_minutes)
+        key = (History.user_id, History.workstation_id, History.product_id)
+        keys = [tuple(r) for r in db.session.query(*key).group_by(*key).having(db.func.count(History.id) > 1).
+                order_by(*key)]
+        total = 0
+        for i in range(0, len(keys), batch_size):
+            batch = set(keys[i:i + batch_size])
+            rows = {}
+            if db.engine.dialect.name == 'mssql':
+                # SQL Server has no row value IN
+                match = or_(*[and_(*[c == v for c, v in zip(key, k)]) for k in batch])
+            else:
+                match = tuple_(*key).in_(list(batch))
+            for h in db.session.query(History).filter(match).order_by(History.time_out, History.id):
+                rows.setdefault((h.user_id, h.workstation_id, h.product_id), []).append(h)
+            for fragments in rows.values():
+                first = fragments[0]
+                for h in fragments[1:]:
+                    if first.time_in is None or h.time_out - first.time_in > gap:
+                        first = h
+                        continue
+                    time_in = None if h.time_in is None else max(first.time_in, h.time_in)
+                    db.session.query(SessionBucket).filter(SessionBucket.history_id == h.id). \
+                        delete(synchronize_session=False)
+                    db.session.query(FederatedSession).filter(FederatedSession.history_id == h.id). \
+                        update({'history_id': first.id}, synchronize_session=False)
+                    db.session.delete(h)
+                    # an open row must be gone before the first one is reopened (uq_history_open_session)
+                    db.session.flush()
+                    first.reopen()
+                    if time_in is not None:
+                        first.check_in(time_in)
+                    total += 1
+            db.session.commit()
+        return total
+
+    @staticmethod
+    def held_between(product_ids, start, end=None):
+        """
+        Sessions of products that were checked out at some time between start and end (at start when
+        end is None). Checked in sessions are found through SessionBucket, open ones through
+        idx_history_product_timein, so neither scans History.
+        :return: query of History
+        """
+        end = end or start
+        closed = db.session.query(SessionBucket.history_id). \
+            filter(SessionBucket.product_id.in_(product_ids),
+                   SessionBucket.bucket >= SessionBucket.bucket_of(start),
+                   SessionBucket.bucket <= SessionBucket.bucket_of(end))
+        held = db.session.query(History).filter(History.id.in_(closed), History.time_out <= end,
+                                                History.time_in > start)
+        still_open = db.session.query(History).filter(History.product_id.in_(product_ids),
+                                                      History.time_in == None, History.time_out <= end)
+        return held.union_all(still_open)
+
     @staticmethod
     def update(history_id, dt, server_id):
-        return db.session.query(History).filter(History.FlexLM_product.has(server_id=server_id),
-                                                History.id == history_id,
-                                                History.time_in == None).update(
-            {"time_in": dt}, synchronize_session='fetch')
+        h = db.session.query(History).filter(History.server_id == server_id,
+                                             History.id == history_id,
+                                             History.time_in == None).first()
+        if h is None:
+            return 0
+        h.check_in(dt)
+        return 1
 
     @staticmethod
-    def reset(server_id):
-        return db.session.query(History).filter(History.FlexLM_product.has(server_id=server_id),
-                                                History.time_in == None).update(
-            {'time_in': datetime.datetime.now().replace(second=0, microsecond=0)}, synchronize_session='fetch')
+    def reset(server_id, when=None):
+        dt = (when or datetime.datetime.now()).replace(second=0, microsecond=0)
+        checked_out = db.session.query(History).filter(History.server_id == server_id,
+                                                       History.time_in == None).all()
+        for h in checked_out:
+            h.check_in(dt)
+        return len(checked_out)
+
+    @staticmethod
+    def backfill_durations(batch_size=1000):
+        """
+        Fills in duration_minutes of checked in sessions that do not have it yet, in batches.
+        :return: number of sessions updated
+        """
+        total = 0
+        while True:
+            batch = db.session.query(History).filter(History.time_in != None,
+                                                     History.duration_minutes == None).limit(batch_size).all()
+            if not batch:
+                return total
+            for h in batch:
+                h.duration_minutes = History.minutes_between(h.time_out, h.time_in)
+            db.session.commit()
+            total += len(batch)
+
+    @staticmethod
+    def backfill_server_ids(batch_size=10000):
+        """
+        Copies the server of each session's product into History.server_id, in batches of ids.
+        :return: number of sessions updated
+        """
+        total = 0
+        last_id = db.session.query(db.func.max(History.id)).scalar() or 0
+        product_server = db.select(Product.server_id).where(Product.id == History.product_id).scalar_subquery()
+        for start in range(0, last_id + 1, batch_size):
+            total += db.session.query(History).filter(History.server_id == None,
+                                                      History.id >= start,
+                                                      History.id < start + batch_size). \
+                update({"server_id": product_server}, synchronize_session=False)
+            db.session.commit()
+        return total
 
     # @staticmethod
     # def users_currently_checked_out(server_id):
@@ -260,6 +872,208 @@ class History(db.Model):
     #     return query
 
 
+class SessionBucket(db.Model):
+    """
+    Interval index of checked in sessions: one row per day a session was checked out, so the sessions
+    of a product at a point in time are found without a range scan over History.
+    """
+    product_id = db.Column(db.Integer, db.ForeignKey("product.id"), primary_key=True)
+    bucket = db.Column(db.Integer, primary_key=True, autoincrement=False)  # date.toordinal() of the day
+    history_id = db.Column(db.Integer, db.ForeignKey("history.id"), primary_key=True)
+    __table_args__ = (
+        db.Index('idx_sessionbucket_history_id', 'history_id'),  # For removing the buckets of a session
+    )
+
+    def __repr__(self):
+        return '<SessionBucket %r %r>' % (self.history_id, self.bucket)
+
+    @staticmethod
+    def bucket_of(dt):
+        return dt.toordinal()
+
+    @staticmethod
+    def buckets(history_id, product_id, time_out, time_in):
+        return [{'product_id': product_id, 'bucket': b, 'history_id': history_id}
+                for b in range(SessionBucket.bucket_of(time_out), SessionBucket.bucket_of(time_in) + 1)]
+
+    @staticmethod
+    def backfill(batch_size=10000):
+        """
+        Adds the buckets of checked in sessions that do not have any, in batches of ids.
+        :return: number of sessions indexed
+        """
+        total = 0
+        last_id = db.session.query(db.func.max(History.id)).scalar() or 0
+        indexed = db.session.query(SessionBucket.history_id).filter(SessionBucket.history_id == History.id).exists()
+        for start in range(0, last_id + 1, batch_size):
+            rows = db.session.query(History.id, History.product_id, History.time_out, History.time_in). \
+                filter(History.id >= start, History.id < start + batch_size, History.time_in != None, ~indexed).all()
+            db.session.bulk_insert_mappings(SessionBucket, [b for r in rows for b in SessionBucket.buckets(*r)])
+            db.session.commit()
+            total += len(rows)
+        return total
+
+
+class ChangeLog(db.Model):
+    """
+    Rows changed by this instance, served by /data/changes (see app/federation.py). One row per
+    History insert, check in or delete and per Product whose seats change; the id is the feed's watermark.
+    prune() deletes old entries and leaves a 'pruned' row with the id of the last one deleted, so a feed
+    asked for changes before it knows they are gone (and ids do not start over).
+    """
+    __table_args__ = (
+        db.Index('idx_changelog_time', 'time'),  # For pruning old entries
+    )
+    id = db.Column(db.Integer, primary_key=True)
+    kind = db.Column(db.String(8), nullable=False)  # 'product', 'history' or 'pruned'
+    row_id = db.Column(db.Integer, nullable=False)
+    time = db.Column(db.DateTime, nullable=False)
+    deleted = db.Column(db.Boolean, default=False)  # The row was deleted, eg. merged by History.merge_gaps
+
+    def __repr__(self):
+        return '<ChangeLog %r %s %r>' % (self.id, self.kind, self.row_id)
+
+    @staticmethod
+    def record(kind, row_ids):
+        """Logs rows changed without the ORM, eg. by a bulk update."""
+        now = datetime.datetime.now()
+        if row_ids:
+            db.session.execute(ChangeLog.__table__.insert(),
+                               [{'kind': kind, 'row_id': i, 'time': now} for i in row_ids])
+
+    @staticmethod
+    def prune(before):
+        """
+        Deletes the entries logged before a time.
+        :return: number of entries deleted
+        """
+        last = db.session.query(db.func.max(ChangeLog.id)).filter(ChangeLog.time < before).scalar()
+        if last is None:
+            return 0
+        deleted = db.session.query(ChangeLog).filter(ChangeLog.id < last).delete(synchronize_session=False)
+        deleted += db.session.query(ChangeLog).filter(ChangeLog.id == last, ChangeLog.kind != 'pruned'). \
+            update({'kind': 'pruned', 'row_id': 0, 'deleted': False}, synchronize_session=False)
+        db.session.commit()
+        return deleted
+
+    @staticmethod
+    def pruned():
+        """:return: id of the last entry deleted by prune(), 0 if none were"""
+        return db.session.query(db.func.max(ChangeLog.id)).filter(ChangeLog.kind == 'pruned').scalar() or 0
+
+    @staticmethod
+    def backfill():
+        """
+        Seeds an empty change log with every product and session, so the first pull of another
+        instance gets all of them.
+        :return: number of rows logged
+        """
+        if db.session.query(ChangeLog.id).first() is not None:
+            return 0
+        now = datetime.datetime.now()
+        total = 0
+        for kind, model in (('product', Product), ('history', History)):
+            total += db.session.execute(ChangeLog.__table__.insert().from_select(
+                ['kind', 'row_id', 'time'],
+                db.select(db.literal(kind), model.id, db.literal(now)).order_by(model.id))).rowcount
+        db.session.commit()
+        return total
+
+
+# Columns whose changes are logged, new rows are always logged
+_logged_columns = {Product: ('product', ('license_out', 'license_total')),
+                   History: ('history', ('time_in',))}
+
+
+@event.listens_for(Session, 'after_flush')
+def _log_changes(session, flush_context):
+    now = datetime.datetime.now()
+    rows = []
+    for obj in session.new:
+        logged = _logged_columns.get(type(obj))
+        if logged:
+            rows.append({'kind': logged[0], 'row_id': obj.id, 'time': now})
+    for obj in session.dirty:
+        logged = _logged_columns.get(type(obj))
+        if logged and any(inspect(obj).attrs[c].history.has_changes() for c in logged[1]):
+            rows.append({'kind': logged[0], 'row_id': obj.id, 'time': now})
+    for obj in session.deleted:
+        logged = _logged_columns.get(type(obj))
+        if logged:
+            rows.append({'kind': logged[0], 'row_id': obj.id, 'time': now, 'deleted': True})
+    if rows:
+        for row in rows:
+            row.setdefault('deleted', False)
+        session.connection().execute(ChangeLog.__table__.insert(), rows)
+
+
+class FederationSource(db.Model):
+    """Another instance whose /data/changes feed is pulled by 'manage.py federate', and how far it was read."""
+    id = db.Column(db.Integer, primary_key=True)
+    url = db.Column(db.String(255), nullable=False, unique=True)
+    watermark = db.Column(db.Integer, nullable=False, default=0)
+    last_pull = db.Column(db.DateTime, default=None)
+
+    def __repr__(self):
+        return '<FederationSource %r>' % self.url
+
+    @staticmethod
+    def get(url):
+        s = db.session.query(FederationSource).filter_by(url=url).first()
+        if s is None:
+            s = FederationSource(url=url, watermark=0)
+            db.session.add(s)
+            db.session.commit()
+        return s
+
+
+class FederatedSession(db.Model):
+    """The local copy of a session pulled from another instance."""
+    source_id = db.Column(db.Integer, db.ForeignKey("federation_source.id"), primary_key=True)
+    remote_id = db.Column(db.Integer, primary_key=True, autoincrement=False)  # History.id at the source
+    history_id = db.Column(db.Integer, db.ForeignKey("history.id"), nullable=False)
+
+    def __repr__(self):
+        return '<FederatedSession %r %r>' % (self.source_id, self.remote_id)
+
+
+class JournalCursor(db.Model):
+    """How far a segment of the poll journal (see app/journal.py) was applied to the database."""
+    segment = db.Column(db.String(64), primary_key=True)
+    offset = db.Column(db.BigInteger, nullable=False, default=0)  # Bytes of the segment applied
+    time_updated = db.Column(db.DateTime, default=None)
+
+    def __repr__(self):
+        return '<JournalCursor %r %r>' % (self.segment, self.offset)
+
+    @staticmethod
+    def get(segment):
+        c = db.session.get(JournalCursor, segment)
+        if c is None:
+            c = JournalCursor(segment=segment, offset=0)
+            db.session.add(c)
+            db.session.commit()
+        return c
+
+
+class AlertState(db.Model):
+    """State of an alert (see app/alerts.py): PENDING while its condition holds for less than the rule's 'for'."""
+    __table_args__ = (
+        db.Index('idx_alertstate_server_state', 'server_id', 'state'),  # Open alerts of a server
+    )
+    rule = db.Column(db.String(64), primary_key=True)
+    key = db.Column(db.String(255), primary_key=True)
+    server_id = db.Column(db.Integer, db.ForeignKey("server.id"), nullable=False)
+    state = db.Column(db.String(8), nullable=False, default='OK')  # OK, PENDING or FIRING
+    since = db.Column(db.DateTime, default=None)  # When the condition started to hold
+    fired = db.Column(db.DateTime, default=None)
+    cleared = db.Column(db.DateTime, default=None)
+    message = db.Column(db.String(255), default=None)
+
+    def __repr__(self):
+        return '<AlertState %r %r %s>' % (self.rule, self.key, self.state)
+
+
 # ----------------------------------------------------------------------------#
 # Jsonify results
 # ----------------------------------------------------------------------------#
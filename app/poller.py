@@ -0,0 +1,295 @@
+'''
+poller.py polls the license servers continuously and lets several worker
+processes, on one host or several, share the work. Each worker claims a share
+of the servers through ServerLease rows that expire after POLL_LEASE_TTL
+seconds, so each server is polled by exactly one worker per cycle and the
+leases of a worker that dies are picked up by the others once they expire.
+Servers are polled in two tiers: a fast totals-only poll that updates the
+seats in use (POLL_TOTALS_INTERVAL) and a slower full poll that reconciles
+the checkouts of every user (POLL_DETAIL_INTERVAL).
+:Example:
+        # >>> python manage.py poll --processes 4
+On PostgreSQL and MySQL free leases are claimed with
+``SELECT ... FOR UPDATE SKIP LOCKED``, on SQL Server with the
+``WITH (UPDLOCK, READPAST, ROWLOCK)`` table hint. SQLite has no row locks,
+there each lease is claimed with a conditional UPDATE that only succeeds
+while the lease is still free.
+With JOURNAL_DIR set the poller does not use the database at all: polls are
+appended to the journal (see app/journal.py) and the servers are split among
+the workers statically, by POLL_SHARD on each host and by process.
+'''
+
+import datetime
+import math
+import multiprocessing
+import os
+import socket
+import time
+
+from sqlalchemy import or_
+from sqlalchemy.exc import IntegrityError
+
+from app import app, db
+from app.arcgis_config import license_servers
+from app.models import Server, ServerLease, ServerState, PollerWorker
+from app.logger_setup import logger
+
+# dialects that support SELECT ... FOR UPDATE SKIP LOCKED (UPDLOCK, READPAST on SQL Server)
+ROW_LOCKING_DIALECTS = ('postgresql', 'mssql', 'mysql', 'oracle')
+
+
+def default_worker_id():
+    return '{}-{}'.format(socket.gethostname(), os.getpid())
+
+
+class Poller(object):
+    def __init__(self, worker_id=None, interval=None, ttl=None, servers=None, license_file=None, shard=None):
+        """
+        :param worker_id: unique id of this worker, defaults to <hostname>-<pid>
+        :param interval: seconds between the start of two cycles, defaults to the fastest polling tier
+        :param ttl: seconds a lease is valid for. Must be longer than a cycle.
+        :param servers: license server configs, defaults to arcgis_config.license_servers
+        :param license_file: read every server from this file instead of lmutil (testing)
+        :param shard: (index, count) of this worker in journal mode, defaults to POLL_SHARD
+        """
+        self.worker_id = worker_id or default_worker_id()
+        self.ttl = datetime.timedelta(seconds=ttl or app.config['POLL_LEASE_TTL'])
+        self.configs = servers if servers is not None else license_servers
+        self.interval = interval or min([self.totals_interval(s) or self.detail_interval(s)
+                                         for s in self.configs] or [app.config['POLL_DETAIL_INTERVAL']])
+        self.license_file = license_file
+        self.servers = {}
+        self.last_totals = {}
+        self.last_detail = {}  # Detail polls appended to the journal, they are applied later
+        self.journal = bool(app.config['JOURNAL_DIR'])
+        self.shard = shard or app.config['POLL_SHARD']
+
+    @staticmethod
+    def totals_interval(s):
+        return s.get('totals_interval', app.config['POLL_TOTALS_INTERVAL'])
+
+    @staticmethod
+    def detail_interval(s):
+        return s.get('detail_interval', app.config['POLL_DETAIL_INTERVAL'])
+
+    def tier(self, server_id, now):
+        """
+        Picks the polling tier of a server for this cycle.
+        :return: 'detail' for a full poll, 'totals' for a totals-only poll or None if the server is not due
+        """
+        s = self.servers[server_id]
+        last_detail = ServerState.get(server_id).last_detail_poll
+        if last_detail is None or (now - last_detail).total_seconds() >= self.detail_interval(s):
+            return 'detail'
+        totals = self.totals_interval(s)
+        last_totals = self.last_totals.get(server_id)
+        if totals and (last_totals is None or (now - last_totals).total_seconds() >= totals):
+            return 'totals'
+        return None
+
+    def register_servers(self):
+        """Makes sure every configured server has a Server row and a lease row."""
+        for s in self.configs:
+            try:
+                server_id = Server.upsert(s['hostname'], s['port'])
+            except IntegrityError:
+                # another worker registered the same server at the same time
+                db.session.rollback()
+                server_id = Server.upsert(s['hostname'], s['port'])
+            self.servers[server_id] = s
+            if db.session.get(ServerLease, server_id) is None:
+                try:
+                    db.session.add(ServerLease(server_id=server_id))
+                    db.session.commit()
+                except IntegrityError:
+                    db.session.rollback()
+        return self.servers
+
+    def _free(self, now):
+        return or_(ServerLease.worker_id == None, ServerLease.expires < now)
+
+    def share(self, now):
+        """The number of servers this worker should hold, given the number of live workers."""
+        workers = max(PollerWorker.live_count(now - self.ttl), 1)
+        return int(math.ceil(len(self.servers) / float(workers)))
+
+    def claim(self):
+        """
+        Renews the leases held by this worker and claims free or expired ones, up to this worker's share.
+        Leases above the share are released so workers that just started can pick them up.
+        :return: ids of the servers leased by this worker
+        """
+        if not self.servers:
+            self.register_servers()
+        now = datetime.datetime.now()
+        expires = now + self.ttl
+        PollerWorker.beat(self.worker_id, now)
+        share = self.share(now)
+
+        held = [l.server_id for l in db.session.query(ServerLease).
+                filter(ServerLease.worker_id == self.worker_id,
+                       ServerLease.expires >= now,
+                       ServerLease.server_id.in_(list(self.servers))).
+                order_by(ServerLease.server_id)]
+        if len(held) > share:
+            self.release(held[share:])
+            held = held[:share]
+        if held:
+            db.session.query(ServerLease).filter(ServerLease.worker_id == self.worker_id,
+                                                 ServerLease.server_id.in_(held)). \
+                update({"expires": expires}, synchronize_session=False)
+            db.session.commit()
+
+        need = share - len(held)
+        if need > 0:
+            held.extend(self._claim_free(now, expires, need))
+        return held
+
+    @staticmethod
+    def lock_free(free, need):
+        """
+        Locks up to `need` free leases, skipping the ones other workers locked. SQL Server ignores
+        FOR UPDATE, there the rows are locked with table hints.
+        """
+        return free.order_by(ServerLease.server_id). \
+            with_hint(ServerLease, 'WITH (UPDLOCK, READPAST, ROWLOCK)', 'mssql'). \
+            with_for_update(skip_locked=True).limit(need)
+
+    def _claim_free(self, now, expires, need):
+        claimed = []
+        free = db.session.query(ServerLease).filter(self._free(now), ServerLease.server_id.in_(list(self.servers)))
+        if db.engine.dialect.name in ROW_LOCKING_DIALECTS:
+            rows = self.lock_free(free, need).all()
+            for r in rows:
+                r.worker_id = self.worker_id
+                r.expires = expires
+                claimed.append(r.server_id)
+            db.session.commit()
+        else:
+            candidates = [r.server_id for r in free.order_by(ServerLease.server_id).all()]
+            db.session.commit()
+            for server_id in candidates:
+                if len(claimed) == need:
+                    break
+                # compare-and-swap: only succeeds if nobody claimed the lease since it was read
+                n = db.session.query(ServerLease).filter(ServerLease.server_id == server_id, self._free(now)). \
+                    update({"worker_id": self.worker_id, "expires": expires}, synchronize_session=False)
+                db.session.commit()
+                if n:
+                    claimed.append(server_id)
+        return claimed
+
+    def renew(self, server_id):
+        """Extends a lease right before polling. Returns False if the lease was lost to another worker."""
+        now = datetime.datetime.now()
+        n = db.session.query(ServerLease).filter(ServerLease.server_id == server_id,
+                                                 ServerLease.worker_id == self.worker_id,
+                                                 ServerLease.expires >= now). \
+            update({"expires": now + self.ttl}, synchronize_session=False)
+        db.session.commit()
+        return n == 1
+
+    def release(self, server_ids=None):
+        q = db.session.query(ServerLease).filter(ServerLease.worker_id == self.worker_id)
+        if server_ids is not None:
+            q = q.filter(ServerLease.server_id.in_(server_ids))
+        q.update({"worker_id": None, "expires": None}, synchronize_session=False)
+        db.session.commit()
+
+    def journal_servers(self):
+        """:return: {'<hostname>:<port>': config} of the servers of this worker's shard"""
+        index, count = self.shard
+        return {'{}:{}'.format(s['hostname'], s['port']): s
+                for i, s in enumerate(self.configs) if i % count == index}
+
+    def run_journal_cycle(self):
+        """Polls the servers of this worker's shard that are due and appends the polls to the journal."""
+        from app import journal
+        from app.read_licenses import poll_server
+        polled = []
+        for key, s in self.journal_servers().items():
+            now = datetime.datetime.now() + datetime.timedelta(seconds=1)
+            last_detail = self.last_detail.get(key)
+            last_totals = self.last_totals.get(key)
+            if last_detail is None or (now - last_detail).total_seconds() >= self.detail_interval(s):
+                tier = 'detail'
+            elif self.totals_interval(s) and (last_totals is None or
+                                              (now - last_totals).total_seconds() >= self.totals_interval(s)):
+                tier = 'totals'
+            else:
+                continue
+            journal.append([poll_server(s, license_file=self.license_file, kind=tier)])
+            if tier == 'detail':
+                self.last_detail[key] = datetime.datetime.now()
+            self.last_totals[key] = datetime.datetime.now()
+            polled.append((key, tier))
+        return polled
+
+    def run_cycle(self):
+        from app.read_licenses import read_server, read_server_totals
+        if self.journal:
+            return self.run_journal_cycle()
+        polled = []
+        for server_id in self.claim():
+            # allow for the time the cycle started late
+            tier = self.tier(server_id, datetime.datetime.now() + datetime.timedelta(seconds=1))
+            if tier is None:
+                continue
+            if not self.renew(server_id):
+                logger.warning('Lease on server id {} lost by worker {}'.format(server_id, self.worker_id))
+                continue
+            if tier == 'detail':
+                read_server(self.servers[server_id], license_file=self.license_file)
+            else:
+                read_server_totals(self.servers[server_id], license_file=self.license_file, server_id=server_id)
+            self.last_totals[server_id] = datetime.datetime.now()
+            polled.append((server_id, tier))
+        if polled:
+            from app import caching, publish
+            caching.warm_after_poll()
+            publish.publish_after_poll()
+        return polled
+
+    def run(self, cycles=None):
+        """Polls until stopped, or for a number of cycles. Leases are released on exit."""
+        logger.info('Poller worker {} started'.format(self.worker_id))
+        n = 0
+        try:
+            while cycles is None or n < cycles:
+                started = time.monotonic()
+                polled = self.run_cycle()
+                n += 1
+                logger.info('Poller worker {} finished cycle {} | servers:{}'.format(self.worker_id, n, polled))
+                if cycles is None or n < cycles:
+                    time.sleep(max(self.interval - (time.monotonic() - started), 0))
+        finally:
+            if not self.journal:
+                db.session.rollback()
+                self.release()
+                PollerWorker.remove(self.worker_id)
+            logger.info('Poller worker {} stopped'.format(self.worker_id))
+
+
+def run_workers(processes, cycles=None, **kwargs):
+    """Runs a number of polling workers as local processes."""
+    if processes <= 1:
+        with app.app_context():
+            Poller(**kwargs).run(cycles=cycles)
+        return
+    workers = []
+    index, count = app.config['POLL_SHARD']
+    for i in range(processes):
+        worker_kwargs = dict(kwargs, worker_id='{}-{}'.format(kwargs.get('worker_id') or default_worker_id(), i),
+                             shard=(index * processes + i, count * processes))
+        p = multiprocessing.Process(target=_worker_main, args=(cycles,), kwargs=worker_kwargs)
+        p.start()
+        workers.append(p)
+    for p in workers:
+        p.join()
+
+
+def _worker_main(cycles, **kwargs):
+    with app.app_context():
+        # connections inherited from the parent process must not be shared
+        db.engine.dispose(close=False)
+        Poller(**kwargs).run(cycles=cycles)
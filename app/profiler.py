@@ -0,0 +1,252 @@
+'''
+profiler.py provides an opt-in, per-request profiler. It is disabled unless
+PROFILER_ENABLED is set, and even then only requests that ask for it are
+profiled:
+        - send an ``X-Profile: <PROFILER_TOKEN>`` header, or
+        - add ``?profile=<PROFILER_TOKEN>`` to the url.
+When no PROFILER_TOKEN is configured only requests from localhost are allowed.
+
+Each profiled request writes into PROFILER_DIR:
+        - ``<id>.prof``   pstats file (PROFILER_MODE = 'cprofile'), or
+        - ``<id>.folded`` collapsed stacks for flamegraph.pl/speedscope
+                          (PROFILER_MODE = 'sampling')
+        - ``<id>.json``   summary splitting the request time into SQL, Jinja
+                          rendering and Python time.
+The report id is returned to the client in the ``X-Profile-Report`` header.
+
+With SERVER_TIMING set every response carries the same split in a
+``Server-Timing`` header (db, render and app durations in milliseconds), which
+is what ``manage.py loadtest`` reports on.
+'''
+
+import cProfile
+import json
+import os
+import sys
+import threading
+import time
+from collections import Counter
+from datetime import datetime
+
+from flask import request, before_render_template, template_rendered
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from app import app
+from app.logger_setup import logger
+
+_local = threading.local()
+
+
+class RequestTimings(object):
+    """Accumulates SQL and template timings for the request running on this thread."""
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.sql = 0.0
+        self.sql_count = 0
+        self.render = 0.0
+        self.sql_during_render = 0.0
+        self._render_start = None
+        self._render_sql_start = None
+
+    def summary(self):
+        total = time.perf_counter() - self.start
+        render_only = max(self.render - self.sql_during_render, 0.0)
+        return {
+            'total_ms': round(total * 1000, 3),
+            'sql_ms': round(self.sql * 1000, 3),
+            'sql_count': self.sql_count,
+            'render_ms': round(render_only * 1000, 3),
+            'python_ms': round(max(total - self.sql - render_only, 0.0) * 1000, 3),
+        }
+
+
+def current_timings():
+    """Returns the timings of the request on this thread or None when it is not being timed."""
+    return getattr(_local, 'timings', None)
+
+
+def start_timings():
+    _local.timings = RequestTimings()
+    return _local.timings
+
+
+def stop_timings():
+    t = current_timings()
+    _local.timings = None
+    return t
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if current_timings() is not None:
+        conn.info.setdefault('profiler_query_start', []).append(time.perf_counter())
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    t = current_timings()
+    starts = conn.info.get('profiler_query_start')
+    if t is None or not starts:
+        return
+    elapsed = time.perf_counter() - starts.pop()
+    t.sql += elapsed
+    t.sql_count += 1
+    if t._render_start is not None:
+        t.sql_during_render += elapsed
+
+
+def _before_render(sender, template, context, **extra):
+    t = current_timings()
+    if t is not None and t._render_start is None:
+        t._render_start = time.perf_counter()
+
+
+def _after_render(sender, template, context, **extra):
+    t = current_timings()
+    if t is not None and t._render_start is not None:
+        t.render += time.perf_counter() - t._render_start
+        t._render_start = None
+
+
+before_render_template.connect(_before_render, app)
+template_rendered.connect(_after_render, app)
+
+
+class StackSampler(object):
+    """
+    Samples the call stack of one thread at a fixed interval and counts the
+    collapsed stacks, in the format used by flamegraph.pl.
+    """
+
+    def __init__(self, thread_id, interval):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = Counter()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='profiler-sampler', daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None:
+                continue
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append('{}:{}'.format(os.path.basename(code.co_filename), code.co_name))
+                frame = frame.f_back
+            self.stacks[';'.join(reversed(stack))] += 1
+
+    def write(self, path):
+        with open(path, 'w') as f:
+            for stack, count in self.stacks.most_common():
+                f.write('{} {}\n'.format(stack, count))
+
+
+def is_authorized():
+    """Checks if the current request asked to be profiled and is allowed to."""
+    if not app.config.get('PROFILER_ENABLED'):
+        return False
+    supplied = request.headers.get('X-Profile') or request.args.get('profile')
+    if supplied is None:
+        return False
+    token = app.config.get('PROFILER_TOKEN')
+    if token:
+        return supplied == token
+    return request.remote_addr in ('127.0.0.1', '::1')
+
+
+def server_timing(summary):
+    """Formats a timings summary as a Server-Timing header value."""
+    return 'db;dur={};desc="{} queries", render;dur={}, app;dur={}, total;dur={}'.format(
+        summary['sql_ms'], summary['sql_count'], summary['render_ms'], summary['python_ms'], summary['total_ms'])
+
+
+@app.before_request
+def start_profile():
+    if not is_authorized():
+        if app.config.get('SERVER_TIMING'):
+            start_timings()
+        return
+    mode = app.config.get('PROFILER_MODE', 'cprofile')
+    timings = start_timings()
+    if mode == 'sampling':
+        timings.profiler = StackSampler(threading.get_ident(), app.config.get('PROFILER_SAMPLE_INTERVAL', 0.005))
+        timings.profiler.start()
+    else:
+        timings.profiler = cProfile.Profile()
+        try:
+            timings.profiler.enable()
+        except ValueError as e:
+            # another profiler is already active on this interpreter
+            logger.warning('Profiler could not be enabled: {}'.format(str(e)))
+            timings.profiler = None
+
+
+def finish_profile(timings):
+    """Stops the profiler and writes the report files. Returns the report id."""
+    profiler = getattr(timings, 'profiler', None)
+    if isinstance(profiler, StackSampler):
+        profiler.stop()
+    elif profiler is not None:
+        profiler.disable()
+
+    directory = app.config.get('PROFILER_DIR', 'profiles')
+    os.makedirs(directory, exist_ok=True)
+    endpoint = (request.endpoint or 'unknown').replace('.', '-')
+    report_id = '{}-{}'.format(datetime.now().strftime('%Y%m%d-%H%M%S-%f'), endpoint)
+    base = os.path.join(directory, report_id)
+
+    summary = timings.summary()
+    summary.update({'path': request.full_path.rstrip('?'), 'endpoint': request.endpoint, 'method': request.method})
+    if isinstance(profiler, StackSampler):
+        profiler.write(base + '.folded')
+        summary['profile'] = report_id + '.folded'
+    elif profiler is not None:
+        profiler.dump_stats(base + '.prof')
+        summary['profile'] = report_id + '.prof'
+    with open(base + '.json', 'w') as f:
+        json.dump(summary, f, indent=2)
+    logger.info('Profiled request', **summary)
+    return report_id
+
+
+@app.after_request
+def stop_profile(response):
+    timings = stop_timings()
+    if timings is None:
+        return response
+    if app.config.get('SERVER_TIMING'):
+        response.headers['Server-Timing'] = server_timing(timings.summary())
+    if hasattr(timings, 'profiler'):
+        try:
+            response.headers['X-Profile-Report'] = finish_profile(timings)
+        except Exception as e:
+            logger.error('Failed to write profile: {}'.format(str(e)))
+    return response
+
+
+@app.teardown_request
+def discard_profile(exc):
+    # after_request is skipped for unhandled exceptions, make sure the profiler is not left running
+    timings = stop_timings()
+    profiler = getattr(timings, 'profiler', None)
+    if isinstance(profiler, StackSampler):
+        profiler.stop()
+    elif profiler is not None:
+        profiler.disable()
+
+
+def load_report(report_id):
+    """Loads the json summary of a profiled request."""
+    with open(os.path.join(app.config.get('PROFILER_DIR', 'profiles'), report_id + '.json')) as f:
+        return json.load(f)
@@ -0,0 +1,143 @@
+'''
+publish.py writes the pages that only change when the license servers are
+polled (the dashboard, the server and product listings and the page and the
+availability JSON of every server) to PUBLISH_DIR as static files, so IIS or
+any web server can serve them without Python or database work per view. Each
+page is written as <path>/index.html (or .json) plus a pre-compressed .gz copy.
+Files are written to a temporary file and swapped in with os.replace, so
+readers never see a partial page, and a page whose content hash did not
+change is not written at all. manifest.json, written last, lists every
+published file with its URL, sha256 and size. Pages of servers that are gone
+are removed. Pages are rendered from the primary database, past the page
+cache and the read replica, so they show the poll that just finished.
+:Example:
+        # $ export PUBLISH_DIR=C:\\inetpub\\license-tracker
+        # $ python manage.py publish
+'''
+
+import datetime
+import gzip
+import hashlib
+import json
+import os
+import re
+import tempfile
+
+from flask import g
+
+from app import app, db
+from app.models import Server
+from app.logger_setup import logger
+
+MANIFEST = 'manifest.json'
+
+# server names that can be used as a directory name
+_SAFE_NAME = re.compile(r'^[A-Za-z0-9][A-Za-z0-9_.-]*$')
+
+
+def pages():
+    """:return: [(URL, file path relative to the publish directory)] of the pages to publish"""
+    published = [('/', 'index.html'),
+                 ('/servers', 'servers/index.html'),
+                 ('/products', 'products/index.html'),
+                 ('/data/active_users', 'data/active_users.json')]
+    for (name,) in db.session.query(Server.name).order_by(Server.name):
+        if not _SAFE_NAME.match(name):
+            logger.warning('Not publishing server {!r}, its name is not a valid file name'.format(name))
+            continue
+        published.append(('/servers/{}'.format(name), 'servers/{}/index.html'.format(name)))
+        published.append(('/data/server/availability?servername={}'.format(name),
+                          'servers/{}/availability.json'.format(name)))
+    return published
+
+
+def render(url):
+    """
+    Renders a page from the primary database, bypassing the page cache and the read replica, which may
+    still hold the data from before the poll.
+    :return: response
+    """
+    with app.test_request_context(url):
+        g.render_fresh = True
+        return app.full_dispatch_request()
+
+
+def _write(path, data):
+    """Writes a file atomically: readers see either the old or the new content."""
+    directory = os.path.dirname(path)
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=directory, prefix='.publish-')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.replace(tmp, path)
+    except BaseException:
+        os.remove(tmp)
+        raise
+
+
+def _remove(path):
+    for p in (path, path + '.gz'):
+        if os.path.exists(p):
+            os.remove(p)
+
+
+def load_manifest(directory):
+    try:
+        with open(os.path.join(directory, MANIFEST)) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {'files': {}}
+
+
+def publish(directory=None):
+    """
+    Renders the pages and writes the ones that changed to the publish directory.
+    :param directory: defaults to PUBLISH_DIR
+    :return: (files written, files removed)
+    """
+    directory = directory or app.config['PUBLISH_DIR']
+    old = load_manifest(directory)['files']
+    files = {}
+    written = 0
+    for url, path in pages():
+        target = os.path.join(directory, *path.split('/'))
+        response = render(url)
+        if response.status_code != 200:
+            # keep the last good copy
+            logger.warning('Not publishing {}, it returned {}'.format(url, response.status_code))
+            if path in old:
+                files[path] = old[path]
+            continue
+        body = response.get_data()
+        digest = hashlib.sha256(body).hexdigest()
+        files[path] = {'url': url, 'sha256': digest, 'size': len(body)}
+        if old.get(path, {}).get('sha256') == digest and os.path.exists(target) and os.path.exists(target + '.gz'):
+            continue
+        _write(target, body)
+        _write(target + '.gz', gzip.compress(body, mtime=0))
+        written += 1
+
+    removed = [path for path in old if path not in files]
+    for path in removed:
+        _remove(os.path.join(directory, *path.split('/')))
+    manifest = {'published': datetime.datetime.now().isoformat(), 'files': files}
+    _write(os.path.join(directory, MANIFEST), json.dumps(manifest, indent=1, sort_keys=True).encode('utf-8'))
+    return written, len(removed)
+
+
+def publish_after_poll():
+    """
+    Publishes the pages at the end of a poll cycle when PUBLISH_DIR is set and the cycle changed data
+    (caching.invalidate() ran).
+    """
+    from app import caching
+    if not app.config['PUBLISH_DIR'] or not caching.changed('publish'):
+        return None
+    try:
+        written, removed = publish()
+        logger.info('Published static pages | written:{} | removed:{}'.format(written, removed))
+        return written, removed
+    except Exception as e:
+        logger.error('Publishing static pages failed: {}'.format(str(e)))
+        return None
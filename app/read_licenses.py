@@ -1,38 +1,82 @@
 from parse import *
 from datetime import datetime
+import hashlib
+import json
+import re
 import subprocess
+import uuid
+from sqlalchemy.exc import SQLAlchemyError
+from app import app, db
 from app.arcgis_config import products, license_servers, lm_util
-from app.models import Server, Product, Updates, History, User, Workstation
+from app.models import Server, ServerState, Product, Updates, History, User, Workstation
 from app.logger_setup import logger
+from app import timeseries
+from app import sketch
+from app import alerts
 
+# The time lmstat was run, the only line that changes between polls of an idle server
+STATUS_TIME = re.compile(r'\s*Flexible License Manager status on ', re.IGNORECASE)
 
-def check_year(s_id):
+# server_id: (fingerprint, products, checkouts) parsed by the last full poll of the server in this process
+_parsed = {}
+
+
+def check_year(s_id, now=None):
     """
     lmutil does not provide a year with license data, this is a work-around to account for that. Checks in
     all licences if there is a difference between current year and the year of any checked out licenses.
     :param s_id: Id of server
+    :param now: time of the poll, defaults to now
+    :return: True if the licenses were checked in
     """
+    now = now or datetime.now()
     checked_out = History.time_in_none(s_id)
     for r in checked_out:
-        if datetime.now().year != r.time_out.year:
+        if now.year != r.time_out.year:
             Product.reset(s_id)
-            History.reset(s_id)
+            History.reset(s_id, now)
             logger.info('check_year reset for server id {}'.format(s_id))
-            break
+            return True
+    return False
 
 
-def reset(uid, sid, e_msg):
+def reset(sid, e_msg, when=None):
     """
     Checks in all licences on error.
-    :param uid: User ID
     :param sid: Server ID
     :param e_msg: Error message
+    :param when: check in time, defaults to now
     """
     Product.reset(sid)
-    History.reset(sid)
-    Updates.end(uid, 'ERROR', e_msg)
+    History.reset(sid, when)
     logger.error(e_msg)
 
+
+class PollError(Exception):
+    """Raised when a license server is reachable but reports an error or is DOWN."""
+
+
+class PollTimeout(PollError):
+    """Raised when lmutil does not answer within the timeout."""
+
+
+def run_lmstat(s, timeout):
+    """
+    Runs lmstat against a license server.
+    :param s: license server config
+    :param timeout: seconds to wait for lmutil before it is killed
+    :return: lmstat output
+    """
+    process = subprocess.Popen([lm_util, "lmstat", "-f", "-c", "{}@{}".format(s['port'], s['hostname'])],
+                               stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+    try:
+        out, _ = process.communicate(timeout=timeout)
+    except subprocess.TimeoutExpired:
+        process.kill()
+        process.communicate()
+        raise PollTimeout('{}@{}: lmutil timed out after {}s'.format(s['port'], s['hostname'], timeout))
+    return out
+
 def parse_error_info(lines):
     result = parse('{:^}Error getting status:{}\n', lines, case_sensitive=False)
     if result:
@@ -44,6 +88,24 @@ def split_license_data(text):
     return text.replace("\n\n", "\n").upper().split("USERS OF")
 
 
+def _digest(lines):
+    kept = [line.rstrip() for line in lines if line.strip() and not STATUS_TIME.match(line)]
+    return hashlib.sha256('\n'.join(kept).encode('utf-8')).hexdigest()
+
+
+def fingerprint(lines):
+    """
+    Hash of lmstat output without its 'status on <time>' line and blank lines, polls that saw the same
+    checkouts have the same fingerprint.
+    """
+    return _digest(lines.splitlines())
+
+
+def feature_fingerprints(license_data):
+    """:return: {feature: hash of its 'Users of' block} of split_license_data()"""
+    return {block.split(':', 1)[0].strip(): _digest(block.splitlines()) for block in license_data[1:]}
+
+
 def parse_server_info(lines):
     """
     Returns an iterable parse.Result object. The parsed word({:w}) should indicate the server status (UP/DOWN). 
@@ -69,12 +131,25 @@ def parse_users_and_workstations(lines):
     return findall('    {} {} {} (v{}) ({}/{}), start {:w} {:d}/{:d} {:d}:{:d}', lines, case_sensitive=False)
 
 
-def add_product(text, server_id):
+def parse_totals(lines):
     """
-    Adds a licensed product into the database
+    Parses only the per-feature 'Total of X issued; Total of Y in use' lines of lmstat output.
+    :return: {internal_name: (license_out, license_total)} for the tracked products
+    """
+    totals = {}
+    for lic in split_license_data(lines):
+        result = parse_product_info(lic.split("\n", 1)[0].strip())
+        if result and result[0] in products:
+            totals[result[0]] = (result[3], result[1])
+    return totals
+
+
+def parse_product(text, server_id):
+    """
+    Parses the seats and version of a tracked product
     :param text: text to be parsed
     :param server_id: ID of server where product is licensed from
-    :return: product ID or None
+    :return: product columns or None
     """
     product = {}
     split_text = text.split("\n")
@@ -88,12 +163,25 @@ def add_product(text, server_id):
             product['internal_name'] = quantity_result[0].upper()
             product['license_out'] = quantity_result[3]
             product['license_total'] = quantity_result[1]
-            if len(data) > 0:
+            if len(split_text) > 1:
                 version_result = parse_version_info(split_text[1].strip())
                 if version_result:
                     product['version'] = version_result[1]
                     product['expires'] = version_result[3]
-            return Product.upsert(**product)
+            return product
+    return None
+
+
+def add_product(text, server_id):
+    """
+    Adds a licensed product into the database
+    :param text: text to be parsed
+    :param server_id: ID of server where product is licensed from
+    :return: product ID or None
+    """
+    product = parse_product(text, server_id)
+    if product:
+        return Product.upsert(**product)
     return None
 
 
@@ -105,82 +193,315 @@ def map_product_id(product_id, arr):
     return out
 
 
+def parse_checkouts(text, year=None):
+    """:return: list of (username, workstation, time_out), lmstat leaves out the year (defaults to this year)"""
+    if not text:
+        return []
+    year = year or datetime.now().year
+    return [(r[0], r[1], datetime(year, r[7], r[8], r[9], r[10])) for r in parse_users_and_workstations(text)]
+
+
 def add_users_and_workstations(text):
     data = []
-    if text:
-        result = parse_users_and_workstations(text)
-        for r in result:
-            user_id = User.add(username=r[0])
-            workstation_id = Workstation.add(workstation=r[1])
-            date_4_db = datetime(datetime.now().year, r[7], r[8], r[9], r[10])
-            data.append(
-                {'user_id': user_id, 'workstation_id': workstation_id, 'time_out': date_4_db})
+    for username, workstation, time_out in parse_checkouts(text):
+        user_id = User.add(username=username)
+        workstation_id = Workstation.add(workstation=workstation)
+        data.append(
+            {'user_id': user_id, 'workstation_id': workstation_id, 'time_out': time_out})
     return data
 
 
+def evaluate_alerts(snapshot):
+    """Evaluates the alert rules on a poll, alerts never fail the poll."""
+    try:
+        alerts.evaluate(snapshot)
+    except Exception as e:
+        db.session.rollback()
+        logger.error('Alert evaluation of \'{}\' failed: {}'.format(snapshot.server, str(e)))
+
+
+def poll_server(s, license_file=None, kind='detail'):
+    """
+    Runs lmstat against a license server without touching the database.
+    :param s: license server config
+    :param license_file: manually pass in a license file in the same format the lmutil displays data.
+    :param kind: 'detail' for a full poll (read_server), 'totals' for a totals-only poll (read_server_totals)
+    :return: journal entry of the poll (see app/journal.py)
+    """
+    entry = {'id': uuid.uuid4().hex, 'kind': kind, 'time': datetime.now().isoformat(), 'hostname': s['hostname'],
+             'port': s['port'], 'output': None, 'error': None, 'timeout': False}
+    try:
+        if license_file:
+            with open(license_file) as process:
+                entry['output'] = process.read()
+        else:
+            entry['output'] = run_lmstat(s, s.get('timeout', app.config['LMUTIL_TIMEOUT']))
+    except PollTimeout as e:
+        entry['error'], entry['timeout'] = str(e), True
+    except Exception as e:
+        entry['error'] = str(e)
+    return entry
+
+
+def replay(entry):
+    """:return: the lmstat output of a journal entry, raises the error of a poll that failed"""
+    if entry['timeout']:
+        raise PollTimeout(entry['error'])
+    if entry['error'] is not None:
+        raise RuntimeError(entry['error'])
+    return entry['output']
+
+
 def read(license_file=None):
     """
-    entry point for reading license data from a FlexLM license server.
+    entry point for reading license data from a FlexLM license server. With JOURNAL_DIR set the polls are
+    only appended to the journal, 'manage.py apply-journal' writes them to the database.
     :param license_file: manually pass in a license file in the same format the lmutil displays data.
     :return:
     """
+    from app import caching, publish
+    if app.config['JOURNAL_DIR']:
+        from app import journal
+        for s in license_servers:
+            journal.append([poll_server(s, license_file=license_file)])
+        return
+    for s in license_servers:
+        read_server(s, license_file=license_file)
+    caching.warm_after_poll()
+    publish.publish_after_poll()
+
+
+def read_totals(license_file=None):
+    """
+    entry point for a totals-only read of all license servers.
+    :param license_file: manually pass in a license file in the same format the lmutil displays data.
+    """
+    from app import caching, publish
+    if app.config['JOURNAL_DIR']:
+        from app import journal
+        for s in license_servers:
+            journal.append([poll_server(s, license_file=license_file, kind='totals')])
+        return
     for s in license_servers:
+        read_server_totals(s, license_file=license_file)
+    caching.warm_after_poll()
+    publish.publish_after_poll()
+
+
+def read_server_totals(s, license_file=None, server_id=None, entry=None):
+    """
+    Fast poll that only updates the seats in use of a license server's products. Checkouts are
+    reconciled by the slower read_server() poll, which also handles failing servers.
+    :param s: license server config
+    :param license_file: manually pass in a license file in the same format the lmutil displays data.
+    :param server_id: ID of the server if already known
+    :param entry: apply this journal entry instead of polling the server, as read_server() does. Entries that
+    are not newer than the server's last applied full poll are skipped.
+    :return: number of products whose counts changed, or None if the server was not read
+    """
+    if server_id is None:
+        server_id = Server.upsert(s['hostname'], s['port'])
+    state = ServerState.get(server_id)
+    if state.circuit != 'CLOSED' or state.consecutive_failures:
+        return None
+    now = datetime.fromisoformat(entry['time']) if entry else datetime.now()
+    if entry is not None and state.last_detail_poll is not None and now <= state.last_detail_poll:
+        return None
+    try:
+        if entry is not None:
+            lines = replay(entry)
+        elif license_file:
+            with open(license_file) as process:
+                lines = process.read()
+        else:
+            lines = run_lmstat(s, s.get('timeout', app.config['LMUTIL_TIMEOUT']))
+        if parse_error_info(lines) or not parse_server_info(lines):
+            logger.info('Totals read of \'{}\' failed, leaving it to the full read.'.format(s['hostname']))
+            return None
+        totals = parse_totals(lines)
+        changed = Product.update_counts(server_id, totals)
+        if changed:
+            # the next full poll writes these products again, even if its output matches the last one
+            state.forget(changed)
+            db.session.commit()
+        timeseries.record_server(server_id, now)
+        snapshot = alerts.Snapshot(s['hostname'], server_id)
+        snapshot.status = 'UP'
+        for name, (out, total) in totals.items():
+            snapshot.add_product(name, out, total)
+        evaluate_alerts(snapshot)
+    except Exception as e:
+        if isinstance(e, SQLAlchemyError):
+            db.session.rollback()
+            if entry is not None:
+                raise
+        logger.error('Totals read of \'{}\' failed: {}'.format(s['hostname'], str(e)))
+        return None
+    if changed:
         try:
-            info = ''
-            server_id = Server.upsert(s['hostname'], s['port'])
-            update_id = Updates.start(server_id)
-            check_year(server_id)
-            checked_out_history_ids = []
-            if license_file:
-                with open(license_file) as process:
-                    lines = process.read()
-            else:
-                process = subprocess.Popen([lm_util, "lmstat", "-f", "-c", "{}@{}".format(s['port'], s['hostname'])],
-                                           stdout=subprocess.PIPE, stderr=subprocess.PIPE, bufsize=1, universal_newlines=True)
-                lines = process.stdout.read()
-            has_error = parse_error_info(lines)
-            if has_error:
-                reset(update_id, server_id, '{}@{}: {}'.format(s['port'], s['hostname'], has_error))
-                raise Exception(has_error)
-            license_data = split_license_data(lines)
-            updates = {'update_id': update_id, 'status': None}
-            server_information = parse_server_info(lines)
-            if server_information:
-                updates['status'] = server_information[2]
-            else:
-                updates['status'] = "DOWN"
-                reset(update_id, server_id, '{}@{} is DOWN'.format(s['port'], s['hostname']))
-                raise Exception(has_error)
+            from app import caching
+            caching.invalidate()
+        except Exception as e:
+            logger.warning(f'Failed to clear cache: {str(e)}')
+    return len(changed)
+
+
+def read_server(s, license_file=None, entry=None):
+    """
+    Reads license data from a single license server. Servers that keep failing are skipped until their
+    backoff is over (see models.ServerState), and licenses are only checked in on the first failure.
+    :param s: license server config, eg. {"hostname": "gv-gislicense", "port": "27000", "timeout": 30}
+    :param license_file: manually pass in a license file in the same format the lmutil displays data.
+    :param entry: apply this journal entry instead of polling the server. Entries that are not newer than the
+    server's last applied poll are skipped, and database errors are raised so the entry can be retried.
+    :return:
+    """
+    server_id = Server.upsert(s['hostname'], s['port'])
+    state = ServerState.get(server_id)
+    now = datetime.fromisoformat(entry['time']) if entry else datetime.now()
+    if entry is not None:
+        if state.last_detail_poll is not None and now <= state.last_detail_poll:
+            logger.info('Skipped journal entry {} of \'{}\', a later poll was applied.'.format(entry['id'],
+                                                                                            s['hostname']))
+            return
+    elif not state.allow(now):
+        logger.info('Skipped reading data from \'{}\', circuit {} until {} after {} failures.'.format(
+            s['hostname'], state.circuit, state.next_attempt, state.consecutive_failures))
+        return
+    previous_poll, state.last_detail_poll = state.last_detail_poll, now
+    snapshot = alerts.Snapshot(s['hostname'], server_id)
+    update_id = None
+    updates = {'status': None}
+    info = ''
+    unchanged = False
+    db_error = False
+    try:
+        if entry is not None:
+            lines = replay(entry)
+        elif license_file:
+            with open(license_file) as process:
+                lines = process.read()
+        else:
+            lines = run_lmstat(s, s.get('timeout', app.config['LMUTIL_TIMEOUT']))
+        has_error = parse_error_info(lines)
+        if has_error:
+            updates['status'] = 'ERROR'
+            raise PollError('{}@{}: {}'.format(s['port'], s['hostname'], has_error))
+        license_data = split_license_data(lines)
+        server_information = parse_server_info(lines)
+        if server_information:
+            updates['status'] = server_information[2]
+        else:
+            updates['status'] = "DOWN"
+            raise PollError('{}@{} is DOWN'.format(s['port'], s['hostname']))
+        # extends the server's status interval when the status did not change
+        update_id = Updates.record(server_id, updates['status'], now=now)
+        db.session.commit()
+        current = fingerprint(lines)
+        unchanged = current == state.fingerprint and previous_poll is not None and \
+            previous_poll.year == now.year
+        if unchanged and _parsed.get(server_id, (None,))[0] == current:
+            found, checkouts = _parsed[server_id][1:]
+        else:
+            found = []
+            checkouts = []
             for lic in license_data:
                 split_line = lic.split('FLOATING LICENSE')
-                product_id = add_product(split_line[0], server_id=server_id)
-                users_and_workstations = add_users_and_workstations(split_line[-1])
-                if product_id and len(users_and_workstations):
-                    data = map_product_id(product_id, users_and_workstations)
-                    for kwargs in data:
-                        history_id = History.add(update_id=update_id, server_id=server_id, **kwargs)
-                        checked_out_history_ids.append(history_id)
-            dt = datetime.now().replace(second=0, microsecond=0)
-            checked_out = History.time_in_none(server_id)
-            for c in checked_out:
-                if c.id not in checked_out_history_ids:
-                    History.update(c.id, dt, server_id)
-        except Exception as e:
-            info = "{} error: {}".format(s['hostname'], str(e))
+                product = parse_product(split_line[0], server_id)
+                if product:
+                    del product['server_id']
+                    found.append(product)
+                    checkouts.extend((product['internal_name'],) + c
+                                     for c in parse_checkouts(split_line[-1], now.year))
+            _parsed[server_id] = (current, found, checkouts)
+        snapshot.sessions = list(checkouts)
+        for p in found:
+            snapshot.add_product(p['internal_name'], p['license_out'], p['license_total'])
+        if unchanged:
+            # Same checkouts as the last poll: the status interval is the heartbeat, seats are still sampled
+            sketch.record_server(server_id, checkouts, now)
+            timeseries.record_server(server_id, now)
+            state.success()
+            return
+        features = feature_fingerprints(license_data)
+        previous = {}
+        if not check_year(server_id, now) and state.feature_fingerprints:
+            previous = json.loads(state.feature_fingerprints)
+        changed = {name for name, digest in features.items() if previous.get(name) != digest} | \
+            (set(previous) - set(features))
+        # Write only the features whose block changed, with one statement each for the products, users,
+        # workstations and sessions
+        product_ids = Product.upsert_many(server_id, [p for p in found if p['internal_name'] in changed])
+        checkouts = [c for c in checkouts if c[0] in changed]
+        user_ids = User.add_many(c[1] for c in checkouts)
+        workstation_ids = Workstation.add_many(c[2] for c in checkouts)
+        sessions = [{'user_id': user_ids[u], 'workstation_id': workstation_ids[w], 'product_id': product_ids[p],
+                     'time_out': t} for p, u, w, t in checkouts]
+        History.add_many(update_id, server_id, sessions, gap_minutes=app.config['SESSION_GAP_MINUTES'])
+        still_out = {(s['user_id'], s['workstation_id'], s['product_id']) for s in sessions}
+        dt = now.replace(second=0, microsecond=0)
+        changed_ids = db.session.query(Product.id).filter(Product.server_id == server_id,
+                                                          Product.internal_name.in_(changed))
+        checked_out = db.session.query(History).filter(History.server_id == server_id, History.time_in == None,
+                                                       History.product_id.in_(changed_ids)).all()
+        for c in checked_out:
+            if (c.user_id, c.workstation_id, c.product_id) not in still_out:
+                History.update(c.id, dt, server_id)
+        sketch.record_server(server_id, snapshot.sessions, now)
+        timeseries.record_server(server_id, now)
+        state.fingerprint = current
+        state.feature_fingerprints = json.dumps(features, sort_keys=True)
+        db.session.commit()
+        state.success()
+    except Exception as e:
+        info = "{} error: {}".format(s['hostname'], str(e))
+        if isinstance(e, SQLAlchemyError):
+            db.session.rollback()
+            if entry is not None:
+                # the database failed, not the server: the journal entry is applied again later
+                db_error = True
+                raise
+        if isinstance(e, PollError):
+            if isinstance(e, PollTimeout):
+                updates['status'] = 'TIMEOUT'
+            # the licenses were already checked in when the server started failing
+            if state.consecutive_failures == 0:
+                reset(server_id, str(e), now)
+            else:
+                logger.error(str(e))
+        else:
             logger.error(str(e))
-            pass
-        finally:
+        state.failure(str(e), now,
+                      threshold=app.config['CIRCUIT_FAILURE_THRESHOLD'],
+                      backoff=app.config['CIRCUIT_BACKOFF'],
+                      backoff_max=app.config['CIRCUIT_BACKOFF_MAX'])
+    finally:
+        if not db_error:
             logger.info(
                 'Finished reading data from \'{}\'. '
                 'Update details | id:{} | status:{} | info:{}.'.format(s['hostname'],
                                                                        update_id,
                                                                        updates['status'],
                                                                        info))
-            Updates.end(update_id, updates['status'], info)
-            # Clear dashboard cache when license data is updated
             try:
-                from app import cache
-                cache.delete('dashboard')
-                logger.info('Dashboard cache cleared after license update')
-            except Exception as e:
-                logger.warning(f'Failed to clear cache: {str(e)}')
\ No newline at end of file
+                if update_id is None:
+                    Updates.record(server_id, updates['status'] or 'ERROR', info, now=now)
+                elif info:
+                    Updates.note(update_id, info)
+                db.session.commit()
+            except SQLAlchemyError as e:
+                db.session.rollback()
+                logger.error('Recording the status of \'{}\' failed: {}'.format(s['hostname'], str(e)))
+            snapshot.status = updates['status']
+            snapshot.failures = state.consecutive_failures
+            if snapshot.failures:
+                snapshot.products, snapshot.sessions = {}, None
+            evaluate_alerts(snapshot)
+            # Mark the cached pages stale when license data is updated, they are served until rendered again
+            if not unchanged:
+                try:
+                    from app import caching
+                    caching.invalidate()
+                    logger.info('Cached pages marked stale after license update')
+                except Exception as e:
+                    logger.warning(f'Failed to clear cache: {str(e)}')
@@ -0,0 +1,108 @@
+'''
+replica.py routes the reads of GET requests to a read replica, so report
+pages do not compete with the poller's writes on the primary database. The
+replica is configured with REPLICA_DATABASE_URL (the 'replica' bind). Its lag
+is the time between the last completed poll (Updates.time_complete) on the
+primary and on the replica; while it is more than REPLICA_MAX_LAG seconds
+behind, requests read from the primary. Only ORM and Core SELECTs go to the
+replica: flushes, INSERT/UPDATE/DELETE and text() statements (such as the
+MERGE of models.upsert_rows) go to the primary, unless a text() statement is
+marked with .execution_options(read_only=True). So does everything outside
+of a request (the poller, manage.py).
+For a local setup with two SQLite files, ``manage.py sync-replica`` copies
+the primary into the replica.
+:Example:
+        # $ export REPLICA_DATABASE_URL=sqlite:////srv/tracker/replica.db
+        # $ python manage.py sync-replica
+'''
+
+import sqlite3
+import time
+
+import sqlalchemy as sa
+from flask import g, request, has_app_context
+from flask_sqlalchemy.session import Session
+
+from app import app
+
+# (time.monotonic() of the last lag check, whether the replica was fresh)
+_freshness = (None, False)
+
+
+def is_read(clause):
+    """Whether a statement only reads. text() is a write unless marked with execution_options(read_only=True)."""
+    if isinstance(clause, sa.TextClause):
+        return bool(clause.get_execution_options().get('read_only'))
+    return isinstance(clause, (sa.Select, sa.CompoundSelect))
+
+
+class RoutingSession(Session):
+    """
+    Reads from the 'replica' bind when the request was routed to it (g.read_replica). After a write
+    the rest of the request reads from the primary, so it sees what it wrote. Renders that must see the
+    latest data (g.render_fresh) always read from the primary.
+    """
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if bind is None and has_app_context() and g.get('read_replica') and not g.get('render_fresh'):
+            if not self._flushing and (mapper is not None or clause is not None) and \
+                    (clause is None or is_read(clause)):
+                return self._db.engines['replica']
+            g.read_replica = False
+        return super(RoutingSession, self).get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+
+def _last_poll(engine):
+    from app.models import Updates
+    with engine.connect() as conn:
+        return conn.execute(sa.select(sa.func.max(Updates.time_complete))).scalar()
+
+
+def lag():
+    """:return: seconds the replica is behind the primary, None when the primary has no polls yet"""
+    from app import db
+    primary = _last_poll(db.engine)
+    if primary is None:
+        return None
+    replica = _last_poll(db.engines['replica'])
+    return float('inf') if replica is None else max((primary - replica).total_seconds(), 0.0)
+
+
+def fresh():
+    """Whether the replica is within REPLICA_MAX_LAG, checked at most every REPLICA_LAG_CHECK_INTERVAL seconds."""
+    global _freshness
+    checked, is_fresh = _freshness
+    now = time.monotonic()
+    if checked is None or now - checked >= app.config['REPLICA_LAG_CHECK_INTERVAL']:
+        try:
+            seconds = lag()
+            is_fresh = seconds is None or seconds <= app.config['REPLICA_MAX_LAG']
+        except sa.exc.SQLAlchemyError as e:
+            from app.logger_setup import logger
+            logger.warning('Read replica unavailable, reading from the primary: {}'.format(str(e)))
+            is_fresh = False
+        _freshness = (now, is_fresh)
+    return is_fresh
+
+
+@app.before_request
+def route_reads():
+    from app import db
+    if request.method in ('GET', 'HEAD') and 'replica' in db.engines and not g.get('render_fresh') \
+            and fresh():
+        g.read_replica = True
+
+
+def sync(primary_path, replica_path):
+    """
+    Copies a SQLite database into another with the online backup API, so the replica's readers see
+    either the old or the new copy.
+    """
+    src = sqlite3.connect(primary_path)
+    dst = sqlite3.connect(replica_path)
+    try:
+        with dst:
+            src.backup(dst)
+    finally:
+        src.close()
+        dst.close()
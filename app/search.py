@@ -0,0 +1,159 @@
+'''
+search.py keeps an in-process prefix index over the names of users,
+workstations, products and servers for the /data/search autocomplete.
+Names are kept in one sorted list of lowercase keys, so a lookup is a bisect
+to the first key starting with the query followed by a short scan. Every word
+of a name is a key of its own ('ArcGIS Pro Advanced' is found by 'pro' and
+'adv', 'WS-00012' by '000').
+
+The index is built on the first search. Rows inserted by this process are
+added as they are inserted (models.insert_listeners and mapper events).
+Rows inserted by other processes, eg. the poller, are picked up every
+SEARCH_REFRESH_INTERVAL seconds by loading the rows with an id above the last
+one indexed, and the whole index is rebuilt every SEARCH_REBUILD_INTERVAL
+seconds to drop deleted names.
+:Example:
+        # >>> index.search('jo', limit=10)
+        # [('user', 'john'), ('workstation', 'JOHN-PC')]
+'''
+
+import re
+import threading
+import time
+from bisect import bisect_left, insort
+
+from sqlalchemy import event
+
+from app import app, db
+from app.models import User, Workstation, Product, Server, insert_listeners
+
+# kind: (model, name column)
+KINDS = {
+    'user': (User, User.name),
+    'workstation': (Workstation, Workstation.name),
+    'product': (Product, Product.common_name),
+    'server': (Server, Server.name),
+}
+
+_word = re.compile(r'[\s\-_.]+')
+
+
+def keys(name):
+    """Lowercase keys a name is found by: the name and every word after the first."""
+    name = name.lower()
+    out = [name]
+    for m in _word.finditer(name):
+        if m.end() < len(name):
+            out.append(name[m.end():])
+    return out
+
+
+class PrefixIndex(object):
+    """Sorted (key, kind, name) entries searched by prefix with bisect."""
+
+    def __init__(self):
+        self._entries = []
+        self._names = set()
+        self._last_id = {}
+        self._lock = threading.Lock()
+        self.built = None
+        self.refreshed = None
+
+    def __len__(self):
+        return len(self._names)
+
+    def add(self, kind, name, row_id=None):
+        with self._lock:
+            self._add(kind, name, row_id)
+
+    def _add(self, kind, name, row_id=None):
+        if row_id is not None and row_id > self._last_id.get(kind, 0):
+            self._last_id[kind] = row_id
+        if not name or (kind, name) in self._names:
+            return
+        self._names.add((kind, name))
+        for key in keys(name):
+            insort(self._entries, (key, kind, name))
+
+    def build(self):
+        """Loads every name from the database."""
+        entries = []
+        names = set()
+        last_id = {}
+        for kind, (model, column) in KINDS.items():
+            for row_id, name in db.session.query(model.id, column):
+                last_id[kind] = max(last_id.get(kind, 0), row_id)
+                if name and (kind, name) not in names:
+                    names.add((kind, name))
+                    entries.extend((key, kind, name) for key in keys(name))
+        entries.sort()
+        with self._lock:
+            self._entries = entries
+            self._names = names
+            self._last_id = last_id
+            self.built = self.refreshed = time.time()
+
+    def refresh(self):
+        """Adds the rows inserted since the last build or refresh, eg. by another process."""
+        for kind, (model, column) in KINDS.items():
+            rows = db.session.query(model.id, column).filter(model.id > self._last_id.get(kind, 0)).all()
+            if rows:
+                with self._lock:
+                    for row_id, name in rows:
+                        self._add(kind, name, row_id)
+        self.refreshed = time.time()
+
+    def ensure_current(self):
+        now = time.time()
+        if self.built is None or now - self.built > app.config['SEARCH_REBUILD_INTERVAL']:
+            self.build()
+        elif now - self.refreshed > app.config['SEARCH_REFRESH_INTERVAL']:
+            self.refresh()
+
+    def search(self, q, limit=10, kinds=None):
+        """
+        Names with a word starting with q, in key order.
+        :return: list of (kind, name)
+        """
+        q = q.lower()
+        out = []
+        seen = set()
+        with self._lock:
+            entries = self._entries
+            i = bisect_left(entries, (q,))
+            while i < len(entries) and len(out) < limit:
+                key, kind, name = entries[i]
+                if not key.startswith(q):
+                    break
+                if (kind, name) not in seen and (kinds is None or kind in kinds):
+                    seen.add((kind, name))
+                    out.append((kind, name))
+                i += 1
+        return out
+
+
+index = PrefixIndex()
+
+
+def _after_insert(kind):
+    def listener(mapper, connection, target):
+        # the id is not recorded, rows of other processes with lower ids still have to be refreshed
+        if index.built is not None:
+            index.add(kind, getattr(target, KINDS[kind][1].key))
+    return listener
+
+
+for _kind, (_model, _column) in KINDS.items():
+    event.listen(_model, 'after_insert', _after_insert(_kind))
+
+_kind_of = {model: kind for kind, (model, column) in KINDS.items()}
+
+
+def _after_upsert(model, names):
+    kind = _kind_of.get(model)
+    if kind and index.built is not None:
+        for name in names:
+            index.add(kind, name)
+
+
+insert_listeners.append(_after_upsert)
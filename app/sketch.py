@@ -0,0 +1,200 @@
+'''
+sketch.py counts the distinct users of a product over any range of days
+without scanning History. Every poll adds the users holding a product to a
+HyperLogLog sketch of that product (and so of its license server) for the
+day, stored in models.UserSketch as 4096 one-byte registers, zlib compressed
+(a few hundred bytes for a day of a busy product). Sketches merge by taking
+the larger register, so the users of a month, a year or several servers are
+estimated by merging the days, with a standard error of about 1.6%.
+'rebuild' fills in the sketches of days polled before they were kept.
+:Example:
+        # >>> unique_users(product_ids, datetime.date(2024, 1, 1), datetime.date(2024, 12, 31), 'month')
+        # [(datetime.date(2024, 1, 1), 41), (datetime.date(2024, 2, 1), 38), ...]
+'''
+
+import bisect
+import datetime
+import hashlib
+import math
+import zlib
+
+from sqlalchemy import distinct, func
+from sqlalchemy.orm import aliased
+
+from app import db
+from app.models import History, Product, User, UserSketch
+
+P = 12  # 2 ** P registers
+M = 1 << P
+GROUPS = ('day', 'week', 'month', 'year', 'all')
+
+# (server_id, internal product name, day): user names already in the stored sketch, for this process
+_recorded = {}
+
+
+def _hash(value):
+    return int.from_bytes(hashlib.blake2b(value.encode('utf-8'), digest_size=8).digest(), 'big')
+
+
+class HyperLogLog(object):
+    def __init__(self, registers=None):
+        self.registers = bytearray(registers or M)
+
+    def add(self, value):
+        """:return: True if the sketch changed"""
+        h = _hash(value)
+        index = h >> (64 - P)
+        rest = h & ((1 << (64 - P)) - 1)
+        rank = 64 - P - rest.bit_length() + 1
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+            return True
+        return False
+
+    def merge(self, other):
+        self.registers = bytearray(map(max, self.registers, other.registers))
+        return self
+
+    def count(self):
+        alpha = 0.7213 / (1 + 1.079 / M)
+        estimate = alpha * M * M / sum(2.0 ** -r for r in self.registers)
+        zeros = self.registers.count(0)
+        if estimate <= 2.5 * M and zeros:
+            # linear counting is more accurate for small counts
+            estimate = M * math.log(M / zeros)
+        return int(round(estimate))
+
+    def to_bytes(self):
+        return zlib.compress(bytes(self.registers), 9)
+
+    @staticmethod
+    def from_bytes(blob):
+        return HyperLogLog(zlib.decompress(blob))
+
+
+def record(product_users, when=None):
+    """
+    Adds users to the sketches of a day.
+    :param product_users: {product_id: user names}
+    :param when: time of the poll, defaults to now
+    """
+    if not product_users:
+        return
+    day = (when or datetime.datetime.now()).date()
+    rows = {r.product_id: r for r in db.session.query(UserSketch).
+            filter(UserSketch.day == day, UserSketch.product_id.in_(list(product_users)))}
+    for product_id, users in product_users.items():
+        r = rows.get(product_id)
+        sketch = HyperLogLog.from_bytes(r.registers) if r is not None else HyperLogLog()
+        changed = False
+        for u in users:
+            changed = sketch.add(u) or changed
+        if r is None:
+            db.session.add(UserSketch(product_id=product_id, day=day, registers=sketch.to_bytes()))
+        elif changed:
+            r.registers = sketch.to_bytes()
+    db.session.commit()
+
+
+def record_server(server_id, checkouts, when=None):
+    """
+    Adds the users of a poll to the sketches of the server's products. Users this process already added
+    today cost no queries.
+    :param checkouts: [(internal product name, user name, ...)]
+    """
+    day = (when or datetime.datetime.now()).date()
+    for key in [k for k in _recorded if k[2] != day]:
+        del _recorded[key]
+    new = {}
+    for c in checkouts:
+        if c[1] not in _recorded.get((server_id, c[0], day), ()):
+            new.setdefault(c[0], set()).add(c[1])
+    if not new:
+        return
+    ids = dict(db.session.query(Product.internal_name, Product.id).
+               filter(Product.server_id == server_id, Product.internal_name.in_(list(new))))
+    record({ids[name]: users for name, users in new.items() if name in ids}, when)
+    for name, users in new.items():
+        if name in ids:
+            _recorded.setdefault((server_id, name, day), set()).update(users)
+
+
+def periods(start, end, group):
+    """:return: [(first day, last day)] of the periods of a group between two dates"""
+    if group == 'all':
+        return [(start, end)]
+    out = []
+    day = start
+    while day <= end:
+        if group == 'day':
+            first, last = day, day
+        elif group == 'week':
+            first = day - datetime.timedelta(days=day.weekday())
+            last = first + datetime.timedelta(days=6)
+        elif group == 'month':
+            first = day.replace(day=1)
+            last = (first + datetime.timedelta(days=32)).replace(day=1) - datetime.timedelta(days=1)
+        else:
+            first = day.replace(month=1, day=1)
+            last = day.replace(month=12, day=31)
+        out.append((max(first, start), min(last, end)))
+        day = last + datetime.timedelta(days=1)
+    return out
+
+
+def unique_users(product_ids, start, end, group='month'):
+    """
+    Estimated distinct users of products between two dates, by merging their daily sketches.
+    :return: [(first day of the period, users)]
+    """
+    rows = db.session.query(UserSketch.day, UserSketch.registers). \
+        filter(UserSketch.product_id.in_(product_ids), UserSketch.day >= start, UserSketch.day <= end)
+    spans = periods(start, end, group)
+    merged = [HyperLogLog() for _ in spans]
+    firsts = [first for first, _ in spans]
+    for day, registers in rows:
+        merged[bisect.bisect_right(firsts, day) - 1].merge(HyperLogLog.from_bytes(registers))
+    return [(first, sketch.count()) for first, sketch in zip(firsts, merged)]
+
+
+def _day_range(first, last):
+    return datetime.datetime.combine(first, datetime.time()), \
+        datetime.datetime.combine(last, datetime.time.max)
+
+
+def exact_unique_users(product_ids, start, end, group='month'):
+    """
+    Distinct users of products between two dates counted from History, one query per period.
+    :return: [(first day of the period, users)]
+    """
+    out = []
+    for first, last in periods(start, end, group):
+        held = aliased(History, History.held_between(product_ids, *_day_range(first, last)).subquery())
+        out.append((first, db.session.query(func.count(distinct(held.user_id))).scalar()))
+    return out
+
+
+def rebuild(start, end):
+    """
+    Writes the sketches of the days between two dates again from History.
+    :return: number of sketches written
+    """
+    product_ids = [p.id for p in db.session.query(Product.id)]
+    written = 0
+    day = start
+    while day <= end:
+        held = aliased(History, History.held_between(product_ids, *_day_range(day, day)).subquery())
+        users = {}
+        for product_id, name in db.session.query(held.product_id, User.name).filter(User.id == held.user_id):
+            users.setdefault(product_id, set()).add(name)
+        db.session.query(UserSketch).filter(UserSketch.day == day).delete(synchronize_session=False)
+        for product_id, names in users.items():
+            sketch = HyperLogLog()
+            for name in names:
+                sketch.add(name)
+            db.session.add(UserSketch(product_id=product_id, day=day, registers=sketch.to_bytes()))
+        db.session.commit()
+        written += len(users)
+        day += datetime.timedelta(days=1)
+    _recorded.clear()
+    return written
@@ -0,0 +1,271 @@
+'''
+timeseries.py stores the seats in use of every product, one sample per poll.
+A poll appends one narrow row per product (models.SeatSample). compact(),
+run by 'manage.py prune-seats', folds the days before today into one row per
+product per day (models.SeatSeries) holding a byte string of (time delta,
+value delta) pairs, each a zigzag varint. A poll at one minute intervals with
+an unchanged count costs two bytes per sample, so a day of a product is about
+3KB. Decoded days are kept in memory (the last SEATSERIES_CACHE_DAYS product
+days read), so a range query only decodes days it has not seen and reads the
+samples not compacted yet.
+Buckets are aligned to local time: hours to the hour, days to midnight and
+weeks to Monday, so a day bucket holds a calendar day across DST changes.
+Days older than SEATSERIES_RETENTION_DAYS are deleted by prune().
+:Example:
+        # >>> record({product_id: 3})
+        # >>> times, values = series(product_id, start, end)
+        # >>> downsample(times, values, bucket=3600, agg='max')
+        # >>> prune()
+'''
+
+import bisect
+import collections
+import datetime
+from array import array
+
+from sqlalchemy import func
+
+from app import app, db
+from app.models import Product, SeatSample, SeatSeries
+
+# (product_id, day): (count, times, values) of the compacted days decoded by this process, least recently used first
+_decoded = collections.OrderedDict()
+
+
+def _zigzag(n):
+    return (n << 1) if n >= 0 else ((-n << 1) - 1)
+
+
+def _unzigzag(n):
+    return (n >> 1) if not n & 1 else -((n + 1) >> 1)
+
+
+def encode(pairs, prev_offset=0, prev_value=0):
+    """
+    Delta-encodes (offset, value) pairs.
+    :param pairs: iterable of (seconds since midnight, value)
+    :param prev_offset: offset of the sample preceding the pairs
+    :param prev_value: value of the sample preceding the pairs
+    :return: bytes
+    """
+    out = bytearray()
+    for offset, value in pairs:
+        for n in (_zigzag(offset - prev_offset), _zigzag(value - prev_value)):
+            while n >= 0x80:
+                out.append((n & 0x7f) | 0x80)
+                n >>= 7
+            out.append(n)
+        prev_offset, prev_value = offset, value
+    return bytes(out)
+
+
+def decode(blob):
+    """
+    Decodes delta-encoded samples.
+    :return: (offsets, values) arrays
+    """
+    offsets = array('l')
+    values = array('l')
+    decoded = [0, 0]
+    i = 0
+    n = shift = 0
+    for b in blob:
+        n |= (b & 0x7f) << shift
+        if b & 0x80:
+            shift += 7
+            continue
+        decoded[i] += _unzigzag(n)
+        if i:
+            offsets.append(decoded[0])
+            values.append(decoded[1])
+        i ^= 1
+        n = shift = 0
+    return offsets, values
+
+
+def _midnight(day):
+    return datetime.datetime.combine(day, datetime.time())
+
+
+def record(samples, when=None):
+    """
+    Appends one sample per product.
+    :param samples: {product_id: seats in use}
+    :param when: time of the poll, defaults to now
+    """
+    if not samples:
+        return
+    when = (when or datetime.datetime.now()).replace(microsecond=0)
+    db.session.execute(SeatSample.__table__.insert(),
+                       [{'product_id': product_id, 'time': when, 'value': value or 0}
+                        for product_id, value in samples.items()])
+    db.session.commit()
+
+
+def record_server(server_id, when=None):
+    """Appends a sample of the current seats in use of every product of a server."""
+    record({p.id: p.license_out for p in
+            db.session.query(Product.id, Product.license_out).filter(Product.server_id == server_id)}, when)
+
+
+def compact(before=None):
+    """
+    Folds the samples of the days before a date into their SeatSeries rows, one day per transaction.
+    :param before: first day left as samples, defaults to today
+    :return: number of product days written
+    """
+    cutoff = _midnight(before or datetime.date.today())
+    written = 0
+    while True:
+        first = db.session.query(func.min(SeatSample.time)).filter(SeatSample.time < cutoff).scalar()
+        if first is None:
+            return written
+        day = first.date()
+        midnight = _midnight(day)
+        in_day = (SeatSample.time >= midnight, SeatSample.time < _midnight(day + datetime.timedelta(days=1)))
+        pairs = {}
+        for product_id, time, value in db.session.query(SeatSample.product_id, SeatSample.time, SeatSample.value). \
+                filter(*in_day).order_by(SeatSample.product_id, SeatSample.time, SeatSample.id):
+            pairs.setdefault(product_id, []).append((int((time - midnight).total_seconds()), value))
+        rows = {r.product_id: r for r in db.session.query(SeatSeries).
+                filter(SeatSeries.day == day, SeatSeries.product_id.in_(list(pairs)))}
+        for product_id, new in pairs.items():
+            r = rows.get(product_id)
+            if r is None:
+                r = SeatSeries(product_id=product_id, day=day)
+                db.session.add(r)
+            else:
+                # samples that arrived after the day was compacted, eg. from the journal
+                new = sorted(list(zip(*decode(r.samples))) + new, key=lambda p: p[0])
+            r.samples = encode(new)
+            r.count = len(new)
+            r.last_offset, r.last_value = new[-1]
+        db.session.query(SeatSample).filter(*in_day).delete(synchronize_session=False)
+        db.session.commit()
+        written += len(pairs)
+
+
+def _day(product_id, day, count, blob=None):
+    """:return: (times, values) arrays of a compacted day, decoded once per process while its count holds"""
+    key = (product_id, day)
+    cached = _decoded.get(key)
+    if cached is None or cached[0] != count:
+        if blob is None:
+            return None
+        base = _midnight(day).timestamp()
+        offsets, values = decode(blob)
+        cached = (count, array('d', (base + o for o in offsets)), values)
+        _decoded[key] = cached
+        while len(_decoded) > app.config['SEATSERIES_CACHE_DAYS']:
+            _decoded.popitem(last=False)
+    _decoded.move_to_end(key)
+    return cached[1], cached[2]
+
+
+def series(product_id, start, end):
+    """
+    Seats in use of a product between two datetimes.
+    :return: (times, values) arrays, times in seconds since the epoch
+    """
+    times = array('d')
+    values = array('l')
+    lo = start.timestamp()
+    hi = end.timestamp()
+    in_range = (SeatSeries.product_id == product_id, SeatSeries.day >= start.date(), SeatSeries.day <= end.date())
+    counts = db.session.query(SeatSeries.day, SeatSeries.count).filter(*in_range).order_by(SeatSeries.day).all()
+    days = {day: _day(product_id, day, count) for day, count in counts}
+    missing = [day for day, decoded in days.items() if decoded is None]
+    if missing:
+        for day, count, blob in db.session.query(SeatSeries.day, SeatSeries.count, SeatSeries.samples). \
+                filter(*in_range).filter(SeatSeries.day.in_(missing)):
+            days[day] = _day(product_id, day, count, blob)
+    for day, _ in counts:
+        day_times, day_values = days[day]
+        i, j = bisect.bisect_left(day_times, lo), bisect.bisect_right(day_times, hi)
+        times.extend(day_times[i:j])
+        values.extend(day_values[i:j])
+    compacted = len(times)
+    for time, value in db.session.query(SeatSample.time, SeatSample.value). \
+            filter(SeatSample.product_id == product_id, SeatSample.time >= start, SeatSample.time <= end). \
+            order_by(SeatSample.time, SeatSample.id):
+        times.append(time.timestamp())
+        values.append(value)
+    if compacted and len(times) > compacted and times[compacted] < times[compacted - 1]:
+        # samples of a compacted day that arrived after it was compacted
+        pairs = sorted(zip(times, values), key=lambda p: p[0])
+        times, values = array('d', (t for t, _ in pairs)), array('l', (v for _, v in pairs))
+    return times, values
+
+
+def _bucket(t, bucket):
+    """
+    Local time bucket of a time. Whole days start at local midnight, counted from a Monday, buckets shorter
+    than a day restart at each midnight. Other sizes are aligned to the epoch.
+    :return: (start, end) in seconds since the epoch
+    """
+    when = datetime.datetime.fromtimestamp(t)
+    day = when.date()
+    if bucket % 86400 == 0:
+        # day 1 of the proleptic calendar is a Monday
+        first = day - datetime.timedelta(days=(day.toordinal() - 1) % (bucket // 86400))
+        return _midnight(first).timestamp(), _midnight(first + datetime.timedelta(days=bucket // 86400)).timestamp()
+    if bucket < 86400:
+        midnight = _midnight(day)
+        offset = (when - midnight).total_seconds()
+        start = midnight + datetime.timedelta(seconds=offset - offset % bucket)
+        end = min(start + datetime.timedelta(seconds=bucket), _midnight(day + datetime.timedelta(days=1)))
+        return start.timestamp(), end.timestamp()
+    start = t - t % bucket
+    return start, start + bucket
+
+
+def downsample(times, values, bucket, agg='max'):
+    """
+    Reduces samples to one value per local time bucket (see _bucket).
+    :param bucket: bucket size in seconds
+    :param agg: 'max', 'min', 'mean' or 'last'
+    :return: list of (bucket start in seconds since the epoch, value)
+    """
+    out = []
+    current = end = None
+    acc = []
+    for t, v in zip(times, values):
+        if current is None or not current <= t < end:
+            b, end = _bucket(t, bucket)
+        else:
+            b = current
+        if b != current:
+            if acc:
+                out.append((current, _aggregate(acc, agg)))
+            current = b
+            acc = []
+        acc.append(v)
+    if acc:
+        out.append((current, _aggregate(acc, agg)))
+    return out
+
+
+def _aggregate(acc, agg):
+    if agg == 'max':
+        return max(acc)
+    if agg == 'min':
+        return min(acc)
+    if agg == 'mean':
+        return round(sum(acc) / float(len(acc)), 2)
+    if agg == 'last':
+        return acc[-1]
+    raise ValueError('Unknown aggregate: {}'.format(agg))
+
+
+def prune(before=None):
+    """
+    Compacts the samples of the days before today, then deletes the days before a date.
+    :param before: first day kept, defaults to SEATSERIES_RETENTION_DAYS days ago
+    :return: number of product days deleted
+    """
+    if before is None:
+        before = datetime.date.today() - datetime.timedelta(days=app.config['SEATSERIES_RETENTION_DAYS'])
+    compact()
+    deleted = db.session.query(SeatSeries).filter(SeatSeries.day < before).delete(synchronize_session=False)
+    db.session.commit()
+    return deleted
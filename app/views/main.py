@@ -1,12 +1,19 @@
-from flask import render_template, make_response, jsonify, request
+from flask import render_template, make_response, jsonify, request, url_for
 from sqlalchemy import desc, asc, func, extract, and_, case, text
 from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.orm import aliased
 from functools import wraps
-from app import app, db, cache
+from app import app, db
+from app.caching import cached_view
 from app.models import User, Product, Server, Updates, History, Workstation, AlchemyEncoder
 from app.logger_setup import logger
+from app import timeseries
+from app import sketch
+from types import SimpleNamespace
 import json
 import datetime
+import gzip
+import hashlib
 import humanize
 
 
@@ -47,6 +54,38 @@ def get_coalesce_expression(*args):
     return func.coalesce(*args)
 
 
+def session_time_sums(columns, *filters):
+    """
+    Sums session time per group of `columns`, in days.
+    Checked in sessions use the stored History.duration_minutes, so the sum reads only the covering
+    indexes. Open sessions have no duration yet; they are few (time_in IS NULL) and their time so far
+    is added in Python as a correction term.
+    :param columns: labelled columns to group by
+    :param filters: join and filter conditions
+    :return: list of rows with the group columns, time_in (None while a session is open) and time_sum
+    """
+    names = [c.key for c in columns]
+    totals = db.session.query(*columns,
+                              func.max(History.time_in).label('time_in'),
+                              func.sum(History.duration_minutes).label('minutes')). \
+        filter(*filters).group_by(*columns).all()
+
+    now = datetime.datetime.now()
+    open_minutes = {}
+    for r in db.session.query(*columns, History.time_out).filter(*filters).filter(History.time_in == None):
+        key = tuple(r[:-1])
+        open_minutes[key] = open_minutes.get(key, 0) + (now - r[-1]).total_seconds() / 60.0
+
+    rows = []
+    for r in totals:
+        key = tuple(r[:len(names)])
+        row = SimpleNamespace(**dict(zip(names, key)))
+        row.time_in = None if key in open_minutes else r.time_in
+        row.time_sum = ((r.minutes or 0) + open_minutes.get(key, 0)) / 1440.0
+        rows.append(row)
+    return rows
+
+
 def handle_errors(f):
     """Decorator to handle errors in routes with enhanced logging"""
     @wraps(f)
@@ -110,79 +149,66 @@ def handle_errors(f):
     return decorated_function
 
 
-def serialize_dashboard_data(data):
-    """serializes current license data for the dashboard"""
-    # Original structure: by server, then by product
-    obj_by_server = {}
-    # New structure: by product, then by server (for tabs)
-    obj_by_product = {}
-    
-    for d in data:
-        server_name = d[5]
-        product_name = d[2]
-        active = d[3]
-        total = d[4]
-        workstation = d[0]
-        username = d[1]
-        time_in = d[6]
-        
-        # Build server-based structure (for backward compatibility)
-        if server_name not in obj_by_server:
-            obj_by_server[server_name] = {}
-        
-        if product_name not in obj_by_server[server_name]:
-            obj_by_server[server_name][product_name] = {
-                'users': [],
-                'active': active,
-                'total': total
-            }
-        else:
-            # Update active/total if they differ (shouldn't happen, but be safe)
-            obj_by_server[server_name][product_name]['active'] = active
-            obj_by_server[server_name][product_name]['total'] = total
-        
-        if time_in is None:
-            obj_by_server[server_name][product_name]['users'].append({
-                'workstation': workstation,
-                'username': username
-            })
-        
-        # Build product-based structure (for tabs)
-        if product_name not in obj_by_product:
-            obj_by_product[product_name] = {}
-        
-        if server_name not in obj_by_product[product_name]:
-            obj_by_product[product_name][server_name] = {
-                'users': [],
-                'active': active,
-                'total': total
-            }
+class DashboardEntry(object):
+    """Seats of a product on a server and its current users as (workstation, username) pairs."""
+    __slots__ = ('active', 'total', 'users')
+
+    def __init__(self, active, total):
+        self.active = active
+        self.total = total
+        self.users = []
+
+    def __repr__(self):
+        return '<DashboardEntry {}/{} {}>'.format(self.active, self.total, self.users)
+
+
+def serialize_dashboard_data(data, products=()):
+    """
+    serializes current license data for the dashboard in a single pass. Every product/server pair
+    is one DashboardEntry shared by the 'by_server' and 'by_product' indexes.
+    :param data: (workstation, username, product, active, total, server, time_in) rows, the users of
+                 rows without a time_in are listed as current users
+    :param products: (product, active, total, server) rows of products to show even without users
+    :return: {'by_server': {server: {product: entry}}, 'by_product': {product: {server: entry}},
+              'products': product tabs, 'versions': {product: version of the tab's content}}
+    """
+    by_server = {}
+    by_product = {}
+
+    def entry(product_name, server_name, active, total):
+        e = by_product.setdefault(product_name, {}).get(server_name)
+        if e is None:
+            e = by_product[product_name][server_name] = DashboardEntry(active, total)
+            by_server.setdefault(server_name, {})[product_name] = e
         else:
-            # Update active/total if they differ (shouldn't happen, but be safe)
-            obj_by_product[product_name][server_name]['active'] = active
-            obj_by_product[product_name][server_name]['total'] = total
-        
+            e.active = active
+            e.total = total
+        return e
+
+    for product_name, active, total, server_name in products:
+        entry(product_name, server_name, active, total)
+    for workstation, username, product_name, active, total, server_name, time_in in data:
+        e = entry(product_name, server_name, active, total)
         if time_in is None:
-            obj_by_product[product_name][server_name]['users'].append({
-                'workstation': workstation,
-                'username': username
-            })
-    
-    # Filter out "ArcGIS Pro Advanced" from the products list
-    products_list = sorted(obj_by_product.keys())
-    # Filter out products with 'advanced' in the name (case-insensitive)
-    products_list = [p for p in products_list if 'advanced' not in p.lower()]
-    
+            e.users.append((workstation, username))
+
+    # Filter out products with 'advanced' in the name (case-insensitive) from the tabs
+    products_list = sorted(p for p in by_product if 'advanced' not in p.lower())
+    # The rendered tab of a product is cached until its seats or users change
+    versions = {p: hashlib.blake2b(repr([(s, e.active, e.total, e.users) for s, e in by_product[p].items()]).
+                                   encode(), digest_size=16).hexdigest()
+                for p in products_list}
     return {
-        'by_server': obj_by_server,
-        'by_product': obj_by_product,
-        'products': products_list  # Filtered list of product names for tabs
+        'by_server': by_server,
+        'by_product': by_product,
+        'products': products_list,
+        'versions': versions,
     }
 
 
 @app.route('/dashboard')
 @app.route('/')
-@cache.cached(timeout=60, key_prefix='dashboard')  # Cache for 60 seconds
+@cached_view('dashboard')
 @handle_errors
 def dashboard():
     server_count = db.session.query(Server).count()
@@ -192,21 +218,26 @@ def dashboard():
     active_user_count = db.session.query(User).join(History).filter(History.time_in == None).join(
         Product).filter( Product.type == 'core').count()
 
+    # Products that were ever checked out get a card, current users come from the open sessions only
+    used_products = db.session.query(Product.common_name, Product.license_out, Product.license_total, Server.name). \
+        filter(Product.server_id == Server.id,
+               db.session.query(History.id).filter(History.product_id == Product.id).exists()).all()
     active = db.session.query(Workstation.name, User.name, Product.common_name, Product.license_out,
                               Product.license_total, Server.name, History.time_in). \
-        filter(History.user_id == User.id,
-               History.update_id == Updates.id,
+        filter(History.time_in == None,
+               History.user_id == User.id,
                History.workstation_id == Workstation.id,
-               Product.server_id == Server.id,
+               History.server_id == Server.id,
                History.product_id == Product.id).all()
 
-    detail = serialize_dashboard_data(active)
+    detail = serialize_dashboard_data(active, used_products)
     return render_template('index.html',
                            server_count=server_count,
                            user_count=user_count,
                            active_user_count=active_user_count,
                            product_count=product_count,
                            workstation_count=workstation_count,
+                           fragment_timeout=app.config['DASHBOARD_FRAGMENT_TIMEOUT'],
                            detail=detail)
 
 @app.route('/data/server/availability')
@@ -259,7 +290,7 @@ def product_availability():
             filter(User.id == History.user_id). \
             filter(Product.id == History.product_id). \
             filter(Workstation.id == History.workstation_id). \
-            filter(Server.id == Product.server_id). \
+            filter(Server.id == History.server_id). \
             filter(Product.internal_name == pname). \
             filter(Server.name == sname). \
             filter(History.time_in == None).all()
@@ -269,6 +300,156 @@ def product_availability():
         return jsonify({'error': 'Failed to retrieve product availability'}), 500
 
 
+def _int_arg(name, default):
+    """:return: an integer query param, default when it is missing or None when it is not a number"""
+    if name not in request.args:
+        return default
+    return request.args.get(name, type=int)
+
+
+@app.route('/data/product/seats')
+@handle_errors
+def product_seats():
+    """
+    Seats in use of a product on a license server over time, from the per poll samples.
+    :return: [[time, seats in use], ...] downsampled to `bucket` seconds over the last `days` days
+    """
+    sname = request.args.get('servername')
+    pname = request.args.get('product')
+    if not sname or not pname:
+        return jsonify({'error': 'servername and product parameters are required'}), 400
+    if not all(c.isalnum() or c in '-_. /' for c in sname):
+        return jsonify({'error': 'Invalid servername format'}), 400
+    if not all(c.isalnum() or c in '-_. /' for c in pname):
+        return jsonify({'error': 'Invalid product name format'}), 400
+    days = _int_arg('days', 90)
+    bucket = _int_arg('bucket', 3600)
+    agg = request.args.get('agg', 'max')
+    if days is None or not 1 <= days <= 3660:
+        return jsonify({'error': 'days must be between 1 and 3660'}), 400
+    if bucket is None or not 1 <= bucket <= days * 86400:
+        return jsonify({'error': 'bucket must be between 1 second and the days requested'}), 400
+    if agg not in ('max', 'min', 'mean', 'last'):
+        return jsonify({'error': 'agg must be max, min, mean or last'}), 400
+
+    product = db.session.query(Product.id, Product.license_total). \
+        filter(Product.server_id == Server.id). \
+        filter(Product.internal_name == pname). \
+        filter(Server.name == sname).first()
+    if product is None:
+        return jsonify({'error': 'Product not found'}), 404
+    end = datetime.datetime.now()
+    times, values = timeseries.series(product.id, end - datetime.timedelta(days=days), end)
+    points = timeseries.downsample(times, values, bucket, agg)
+    return jsonify(total=product.license_total, bucket=bucket, agg=agg,
+                   results=[[datetime.datetime.fromtimestamp(t).isoformat(), v] for t, v in points])
+
+
+def _parse_time(value):
+    return datetime.datetime.fromisoformat(value) if value else None
+
+
+def _sessions_held(start, end=None):
+    """Sessions of the product/server in the request args checked out at start, or between start and end."""
+    pname = request.args.get('product')
+    sname = request.args.get('server')
+    if not pname:
+        return jsonify({'error': 'product parameter is required'}), 400
+    products = db.session.query(Product.id).filter((Product.internal_name == pname) | (Product.common_name == pname))
+    if sname:
+        products = products.filter(Product.server_id == Server.id, Server.name == sname)
+    product_ids = [p.id for p in products]
+    if not product_ids:
+        return jsonify({'error': 'Product not found'}), 404
+    held = aliased(History, History.held_between(product_ids, start, end).subquery())
+    rows = db.session.query(User.name, Workstation.name, Server.name, held.time_out, held.time_in). \
+        filter(User.id == held.user_id,
+               Workstation.id == held.workstation_id,
+               Server.id == held.server_id).order_by(held.time_out).all()
+    return jsonify(product=pname, server=sname, start=start.isoformat(), end=(end or start).isoformat(),
+                   results=[{'username': r[0], 'workstation': r[1], 'server': r[2],
+                             'time_out': r[3].isoformat(), 'time_in': r[4].isoformat() if r[4] else None}
+                            for r in rows])
+
+
+@app.route('/data/asof')
+@handle_errors
+def asof():
+    """
+    Who held a product at a point in time.
+    :param product: internal or common product name
+    :param server: optional license server name
+    :param t: ISO time, defaults to now
+    """
+    try:
+        t = _parse_time(request.args.get('t')) or datetime.datetime.now()
+    except ValueError:
+        return jsonify({'error': 'Invalid t, expected an ISO time'}), 400
+    return _sessions_held(t)
+
+
+@app.route('/data/asof/range')
+@handle_errors
+def asof_range():
+    """
+    Who held a product at any time between start and end.
+    :param product: internal or common product name
+    :param server: optional license server name
+    :param start: ISO time
+    :param end: ISO time, defaults to now
+    """
+    try:
+        start = _parse_time(request.args.get('start'))
+        end = _parse_time(request.args.get('end')) or datetime.datetime.now()
+    except ValueError:
+        return jsonify({'error': 'Invalid start or end, expected an ISO time'}), 400
+    if start is None or start > end:
+        return jsonify({'error': 'start is required and must be before end'}), 400
+    return _sessions_held(start, end)
+
+
+@app.route('/data/unique-users')
+@handle_errors
+def unique_users():
+    """
+    Distinct users of a product per period, estimated from the daily sketches (see app/sketch.py).
+    :param product: internal or common product name
+    :param server: optional license server name
+    :param from: ISO date, defaults to the first day of this year
+    :param to: ISO date, defaults to today
+    :param group: day, week, month (default), year or all
+    :param exact: 1 to count the users from History instead
+    """
+    pname = request.args.get('product')
+    sname = request.args.get('server')
+    group = request.args.get('group', 'month')
+    exact = request.args.get('exact') in ('1', 'true')
+    if not pname:
+        return jsonify({'error': 'product parameter is required'}), 400
+    if group not in sketch.GROUPS:
+        return jsonify({'error': 'group must be one of {}'.format(', '.join(sketch.GROUPS))}), 400
+    today = datetime.date.today()
+    try:
+        start = datetime.date.fromisoformat(request.args.get('from') or today.replace(month=1, day=1).isoformat())
+        end = datetime.date.fromisoformat(request.args.get('to') or today.isoformat())
+    except ValueError:
+        return jsonify({'error': 'Invalid from or to, expected an ISO date'}), 400
+    if start > end:
+        return jsonify({'error': 'from must be before to'}), 400
+    if len(sketch.periods(start, end, group)) > 1000:
+        return jsonify({'error': 'Too many periods, use a larger group or a shorter range'}), 400
+    products = db.session.query(Product.id).filter((Product.internal_name == pname) | (Product.common_name == pname))
+    if sname:
+        products = products.filter(Product.server_id == Server.id, Server.name == sname)
+    product_ids = [p.id for p in products]
+    if not product_ids:
+        return jsonify({'error': 'Product not found'}), 404
+    count = sketch.exact_unique_users if exact else sketch.unique_users
+    return jsonify(product=pname, server=sname, start=start.isoformat(), end=end.isoformat(), group=group,
+                   exact=exact, results=[{'period': first.isoformat(), 'users': users}
+                                         for first, users in count(product_ids, start, end, group)])
+
+
 @app.route('/data/active_users')
 @handle_errors
 def active_users():
@@ -283,7 +464,66 @@ def active_users():
         return jsonify({'error': 'Failed to retrieve active users'}), 500
 
 
+@app.route('/data/search')
+@handle_errors
+def search():
+    """
+    Autocomplete over user, workstation, product and server names.
+    :param q: start of a name or of any word in a name
+    :param type: optional comma separated kinds to return (user, workstation, product, server)
+    :param limit: number of matches, default 10 (max 50)
+    :return: {'results': [{'type', 'name', 'url'}]}
+    """
+    from app.search import index, KINDS
+    q = request.args.get('q', '').strip()
+    if not q:
+        return jsonify({'error': 'q parameter is required'}), 400
+    limit = min(request.args.get('limit', 10, type=int), 50)
+    kinds = None
+    if request.args.get('type'):
+        kinds = set(request.args['type'].split(','))
+        if not kinds <= set(KINDS):
+            return jsonify({'error': 'type must be one of {}'.format(', '.join(KINDS))}), 400
+    index.ensure_current()
+    endpoints = {'user': ('username', 'username'), 'workstation': ('workstationname', 'workstationname'),
+                 'product': ('productname', 'product_name'), 'server': ('servername', 'servername')}
+    results = []
+    for kind, name in index.search(q, limit, kinds):
+        endpoint, arg = endpoints[kind]
+        results.append({'type': kind, 'name': name, 'url': url_for(endpoint, **{arg: name})})
+    return jsonify({'results': results})
+
+
+@app.route('/data/changes')
+@handle_errors
+def changes():
+    """
+    Sessions and seat counts changed after a watermark, pulled by 'manage.py federate' (see app/federation.py).
+    :param since: watermark of the last record applied, default 0
+    :param limit: number of change log entries read, default 1000 (max 10000)
+    :return: NDJSON, one record per line and a last {"kind": "watermark", "seq", "more"} line, or 410 when
+        entries after the watermark were pruned and the caller has to resync
+    """
+    from app import federation
+    from app.models import ChangeLog
+    since = request.args.get('since', 0, type=int)
+    limit = min(max(request.args.get('limit', 1000, type=int), 1), 10000)
+    pruned = ChangeLog.pruned()
+    if since < pruned:
+        return jsonify({'error': 'Changes after {} were pruned, resync needed'.format(since), 'resync': True,
+                        'pruned': pruned}), 410
+    body = federation.ndjson(*federation.changes(since, limit)).encode('utf-8')
+    response = make_response(body)
+    response.mimetype = 'application/x-ndjson'
+    response.vary.add('Accept-Encoding')
+    if 'gzip' in request.accept_encodings:
+        response.set_data(gzip.compress(body, compresslevel=6))
+        response.headers['Content-Encoding'] = 'gzip'
+    return response
+
+
 @app.route('/products')
+@cached_view('products')
 @handle_errors
 def products():
     all_products = db.session.query(Product.common_name, Product.license_out, Product.license_total, Server.name).filter(Product.server_id==Server.id).all()
@@ -299,18 +539,11 @@ def productname(product_name):
         return render_template('error.html', 
                              message='Invalid Product Name', 
                              detail='The product name provided is invalid.'), 400
-    # Use database-agnostic date calculation
-    time_in_expr = get_coalesce_expression(History.time_in, datetime.datetime.now())
-    time_diff = get_date_diff_expression(History.time_out, time_in_expr)
-    
-    users = db.session.query(User.name, History.time_in,
-                             Server.name.label('servername'),
-                             func.sum(time_diff).label('time_sum')). \
-        filter(User.id == History.user_id). \
-        filter(History.product_id == Product.id). \
-        filter(Product.server_id == Server.id). \
-        filter(Product.common_name == product_name). \
-        distinct(User.name).group_by(User.name).all()
+    users = session_time_sums((User.name, Server.name.label('servername')),
+                              User.id == History.user_id,
+                              History.product_id == Product.id,
+                              History.server_id == Server.id,
+                              Product.common_name == product_name)
 
     # days = datetime.datetime.utcnow() - datetime.timedelta(days=days)
 
@@ -362,18 +595,13 @@ def productname(product_name):
 
 
 @app.route('/users')
+@cached_view('users')
 @handle_errors
 def users():
-    # Use database-agnostic date calculation
-    time_in_expr = get_coalesce_expression(History.time_in, datetime.datetime.now())
-    time_diff = get_date_diff_expression(History.time_out, time_in_expr)
-    
-    all_users = db.session.query(User.name, History.time_in,
-                                 func.sum(time_diff).label('time_sum')). \
-        filter(User.id == History.user_id). \
-        filter(History.product_id == Product.id). \
-        filter(Product.type == 'core'). \
-        distinct(User.name).group_by(User.name).all()
+    all_users = session_time_sums((User.name,),
+                                  User.id == History.user_id,
+                                  History.product_id == Product.id,
+                                  Product.type == 'core')
     return render_template('pages/users.html',
                            users=all_users)
 
@@ -394,21 +622,14 @@ def username(username):
 
     servers = db.session.query(Server, History). \
         filter(User.id == History.user_id). \
-        filter(Updates.id == History.update_id). \
-        filter(Server.id == Updates.server_id). \
+        filter(Server.id == History.server_id). \
         filter(User.name == username). \
         group_by(Server.name).distinct(Server.name).all()
 
-    # Use database-agnostic date calculation
-    time_in_expr = get_coalesce_expression(History.time_in, datetime.datetime.now())
-    time_diff = get_date_diff_expression(History.time_out, time_in_expr)
-    
-    products = db.session.query(Product.common_name, Product.type, History.time_in,
-                                func.sum(time_diff).label('time_sum')). \
-        filter(User.id == History.user_id). \
-        filter(User.name == username). \
-        filter(History.product_id == Product.id). \
-        group_by(Product.common_name).distinct(Product.common_name).all()
+    products = session_time_sums((Product.common_name, Product.type),
+                                 User.id == History.user_id,
+                                 User.name == username,
+                                 History.product_id == Product.id)
     return render_template('pages/username.html',
                            workstations=workstations,
                            servers=servers,
@@ -416,18 +637,26 @@ def username(username):
 
 
 @app.route('/servers')
+@cached_view('servers')
 @handle_errors
 def servers():
+    # the latest status interval of each server
+    latest = db.session.query(func.max(Updates.id)).group_by(Updates.server_id)
     query = db.session.query(
         Server.name.label("name"),
         Updates.info.label("info"),
         Updates.status.label("status"),
-        Server.id == Updates.server_id,
-        func.max(Updates.time_complete).label('maxdate')
-    ).filter(Server.id == Updates.server_id).group_by(Server.name).all()
+        Updates.time_complete.label('maxdate')
+    ).filter(Server.id == Updates.server_id, Updates.id.in_(latest)).order_by(Server.name).all()
     return render_template('pages/servers.html', servers=query)
 
 
+def parse_page_key(value):
+    """Parses the '<time_start>_<id>' key of a history page, raises ValueError if it is invalid."""
+    time_start, _, update_id = value.rpartition('_')
+    return datetime.datetime.fromisoformat(time_start), int(update_id)
+
+
 @app.route('/servers/<servername>')
 @handle_errors
 def servername(servername):
@@ -439,17 +668,18 @@ def servername(servername):
     status = db.session.query(Server, Updates). \
         filter(Server.id == Updates.server_id). \
         filter(Server.name == servername). \
-        order_by(desc(Updates.time_start)).limit(1).first()
-    history = db.session.query(Server, Updates). \
-        filter(Server.id == Updates.server_id). \
-        filter(Server.name == servername). \
-        filter(Updates.status != 'UP'). \
-        order_by(desc(Updates.time_start)).all()
-    users = db.session.query(User, History, Server, Updates, Product). \
+        order_by(desc(Updates.time_start), desc(Updates.id)).limit(1).first()
+    history, next_page, uptime = [], None, None
+    if status:
+        before = request.args.get('before')
+        history, next_page = Updates.history_page(status.Server.id, parse_page_key(before) if before else None,
+                                                  app.config['SERVER_HISTORY_PAGE_SIZE'])
+        now = datetime.datetime.now()
+        uptime = Updates.uptime(status.Server.id, now - datetime.timedelta(days=app.config['UPTIME_DAYS']), now)[1]
+    users = db.session.query(User, History, Server, Product). \
         filter(User.id == History.user_id). \
-        filter(Updates.id == History.update_id). \
         filter(Product.id == History.product_id). \
-        filter(Server.id == Updates.server_id). \
+        filter(Server.id == History.server_id). \
         filter(Product.type == 'core'). \
         filter(Server.name == servername). \
         distinct(User.name).group_by(User.name).all()
@@ -461,9 +691,33 @@ def servername(servername):
                            chart_data=None,
                            status=status,
                            history=history,
+                           next_page='{}_{}'.format(next_page[0].isoformat(), next_page[1]) if next_page else None,
+                           uptime=uptime,
+                           uptime_days=app.config['UPTIME_DAYS'],
                            users=users,
                            start_date=first_update)
 
+
+@app.route('/data/server/uptime')
+@handle_errors
+def server_uptime():
+    """
+    :return: Seconds a license server spent in each status and its uptime over the last 'days' days.
+    """
+    s = request.args.get('servername')
+    if not s:
+        return jsonify({'error': 'servername parameter is required'}), 400
+    days = _int_arg('days', app.config['UPTIME_DAYS'])
+    if days is None or not 1 <= days <= 3660:
+        return jsonify({'error': 'days must be between 1 and 3660'}), 400
+    server = db.session.query(Server.id).filter(Server.name == s).first()
+    if server is None:
+        return jsonify({'error': 'Unknown server'}), 404
+    end = datetime.datetime.now()
+    start = end - datetime.timedelta(days=days)
+    seconds, uptime = Updates.uptime(server.id, start, end)
+    return jsonify(servername=s, start=start.isoformat(), end=end.isoformat(), seconds=seconds, uptime=uptime)
+
 #TODO: clear log for updates on server
 def clear_log(servername):
     try:
@@ -474,18 +728,13 @@ def clear_log(servername):
 
 
 @app.route('/workstations')
+@cached_view('workstations')
 @handle_errors
 def workstations():
-    # Use database-agnostic date calculation
-    time_in_expr = get_coalesce_expression(History.time_in, datetime.datetime.now())
-    time_diff = get_date_diff_expression(History.time_out, time_in_expr)
-    
-    all_ws = db.session.query(Workstation.name, History.time_in,
-                              func.sum(time_diff).label('time_sum')). \
-        filter(Workstation.id == History.workstation_id). \
-        filter(History.product_id == Product.id). \
-        filter(Product.type == 'core'). \
-        distinct(Workstation.name).group_by(Workstation.name).all()
+    all_ws = session_time_sums((Workstation.name,),
+                               Workstation.id == History.workstation_id,
+                               History.product_id == Product.id,
+                               Product.type == 'core')
     return render_template('pages/workstations.html',
                            ws=all_ws)
 
@@ -506,21 +755,14 @@ def workstationname(workstationname):
 
     servers = db.session.query(Server, History.time_in). \
         filter(Workstation.id == History.workstation_id). \
-        filter(Updates.id == History.update_id). \
-        filter(Server.id == Updates.server_id). \
+        filter(Server.id == History.server_id). \
         filter(Workstation.name == workstationname). \
         group_by(Server.name).distinct(Server.name).all()
 
-    # Use database-agnostic date calculation
-    time_in_expr = get_coalesce_expression(History.time_in, datetime.datetime.now())
-    time_diff = get_date_diff_expression(History.time_out, time_in_expr)
-    
-    products = db.session.query(Product.common_name, Product.type, History.time_in,
-                                func.sum(time_diff).label('time_sum')). \
-        filter(Workstation.id == History.workstation_id). \
-        filter(Workstation.name == workstationname). \
-        filter(History.product_id == Product.id). \
-        group_by(Product.common_name).distinct(Product.common_name).all()
+    products = session_time_sums((Product.common_name, Product.type),
+                                 Workstation.id == History.workstation_id,
+                                 Workstation.name == workstationname,
+                                 History.product_id == Product.id)
     return render_template('pages/workstationname.html',
                            users=users,
                            servers=servers,
@@ -1,3 +1,4 @@
+import os
 import unittest
 import click
 from flask import Flask
@@ -23,95 +24,140 @@ def recreate_db():
 
 @cli.command()
 def add_indexes():
-    """Add database indexes to improve query performance (safe for existing databases)."""
-    from sqlalchemy import text
-    with app.app_context():
-        try:
-            # Get the database dialect
-            dialect = db.engine.dialect.name
-            
-            print(f"Detected database: {dialect}")
-            print("Adding indexes to improve query performance...")
-            
-            # SQLite uses CREATE INDEX IF NOT EXISTS
-            if dialect == 'sqlite':
-                indexes = [
-                    ("idx_server_name", "CREATE INDEX IF NOT EXISTS idx_server_name ON server(name)"),
-                    ("idx_updates_server_id", "CREATE INDEX IF NOT EXISTS idx_updates_server_id ON updates(server_id)"),
-                    ("idx_updates_status", "CREATE INDEX IF NOT EXISTS idx_updates_status ON updates(status)"),
-                    ("idx_updates_time_start", "CREATE INDEX IF NOT EXISTS idx_updates_time_start ON updates(time_start)"),
-                    ("idx_updates_time_complete", "CREATE INDEX IF NOT EXISTS idx_updates_time_complete ON updates(time_complete)"),
-                    ("idx_updates_server_time", "CREATE INDEX IF NOT EXISTS idx_updates_server_time ON updates(server_id, time_start)"),
-                    ("idx_product_server_id", "CREATE INDEX IF NOT EXISTS idx_product_server_id ON product(server_id)"),
-                    ("idx_product_common_name", "CREATE INDEX IF NOT EXISTS idx_product_common_name ON product(common_name)"),
-                    ("idx_product_internal_name", "CREATE INDEX IF NOT EXISTS idx_product_internal_name ON product(internal_name)"),
-                    ("idx_product_type", "CREATE INDEX IF NOT EXISTS idx_product_type ON product(type)"),
-                    ("idx_product_server_type", "CREATE INDEX IF NOT EXISTS idx_product_server_type ON product(server_id, type)"),
-                    ("idx_workstation_name", "CREATE INDEX IF NOT EXISTS idx_workstation_name ON workstation(name)"),
-                    ("idx_user_name", "CREATE INDEX IF NOT EXISTS idx_user_name ON user(name)"),
-                    ("idx_history_user_id", "CREATE INDEX IF NOT EXISTS idx_history_user_id ON history(user_id)"),
-                    ("idx_history_workstation_id", "CREATE INDEX IF NOT EXISTS idx_history_workstation_id ON history(workstation_id)"),
-                    ("idx_history_product_id", "CREATE INDEX IF NOT EXISTS idx_history_product_id ON history(product_id)"),
-                    ("idx_history_update_id", "CREATE INDEX IF NOT EXISTS idx_history_update_id ON history(update_id)"),
-                    ("idx_history_time_out", "CREATE INDEX IF NOT EXISTS idx_history_time_out ON history(time_out)"),
-                    ("idx_history_time_in", "CREATE INDEX IF NOT EXISTS idx_history_time_in ON history(time_in)"),
-                    ("idx_history_user_timein", "CREATE INDEX IF NOT EXISTS idx_history_user_timein ON history(user_id, time_in)"),
-                    ("idx_history_product_timein", "CREATE INDEX IF NOT EXISTS idx_history_product_timein ON history(product_id, time_in)"),
-                    ("idx_history_workstation_timein", "CREATE INDEX IF NOT EXISTS idx_history_workstation_timein ON history(workstation_id, time_in)"),
-                ]
-            else:
-                # SQL Server, PostgreSQL, MySQL use IF NOT EXISTS or similar
-                indexes = [
-                    ("idx_server_name", f"CREATE INDEX idx_server_name ON server(name)"),
-                    ("idx_updates_server_id", f"CREATE INDEX idx_updates_server_id ON updates(server_id)"),
-                    ("idx_updates_status", f"CREATE INDEX idx_updates_status ON updates(status)"),
-                    ("idx_updates_time_start", f"CREATE INDEX idx_updates_time_start ON updates(time_start)"),
-                    ("idx_updates_time_complete", f"CREATE INDEX idx_updates_time_complete ON updates(time_complete)"),
-                    ("idx_updates_server_time", f"CREATE INDEX idx_updates_server_time ON updates(server_id, time_start)"),
-                    ("idx_product_server_id", f"CREATE INDEX idx_product_server_id ON product(server_id)"),
-                    ("idx_product_common_name", f"CREATE INDEX idx_product_common_name ON product(common_name)"),
-                    ("idx_product_internal_name", f"CREATE INDEX idx_product_internal_name ON product(internal_name)"),
-                    ("idx_product_type", f"CREATE INDEX idx_product_type ON product(type)"),
-                    ("idx_product_server_type", f"CREATE INDEX idx_product_server_type ON product(server_id, type)"),
-                    ("idx_workstation_name", f"CREATE INDEX idx_workstation_name ON workstation(name)"),
-                    ("idx_user_name", f"CREATE INDEX idx_user_name ON [user](name)" if dialect == 'mssql' else f"CREATE INDEX idx_user_name ON user(name)"),
-                    ("idx_history_user_id", f"CREATE INDEX idx_history_user_id ON history(user_id)"),
-                    ("idx_history_workstation_id", f"CREATE INDEX idx_history_workstation_id ON history(workstation_id)"),
-                    ("idx_history_product_id", f"CREATE INDEX idx_history_product_id ON history(product_id)"),
-                    ("idx_history_update_id", f"CREATE INDEX idx_history_update_id ON history(update_id)"),
-                    ("idx_history_time_out", f"CREATE INDEX idx_history_time_out ON history(time_out)"),
-                    ("idx_history_time_in", f"CREATE INDEX idx_history_time_in ON history(time_in)"),
-                    ("idx_history_user_timein", f"CREATE INDEX idx_history_user_timein ON history(user_id, time_in)"),
-                    ("idx_history_product_timein", f"CREATE INDEX idx_history_product_timein ON history(product_id, time_in)"),
-                    ("idx_history_workstation_timein", f"CREATE INDEX idx_history_workstation_timein ON history(workstation_id, time_in)"),
-                ]
-            
-            created = 0
-            skipped = 0
-            for idx_name, sql in indexes:
-                try:
-                    db.session.execute(text(sql))
-                    created += 1
-                    print(f"  ✓ Created index: {idx_name}")
-                except Exception as e:
-                    # Index might already exist
-                    if 'already exists' in str(e).lower() or 'duplicate' in str(e).lower():
-                        skipped += 1
-                        print(f"  - Index already exists: {idx_name}")
-                    else:
-                        print(f"  ✗ Error creating {idx_name}: {str(e)}")
-            
-            db.session.commit()
-            print(f"\n✓ Index creation complete!")
-            print(f"  Created: {created} indexes")
-            if skipped > 0:
-                print(f"  Skipped (already exist): {skipped} indexes")
-            print("\nNote: Indexes will be automatically created when using 'recreate_db' command.")
-            
-        except Exception as e:
-            db.session.rollback()
-            print(f"Error adding indexes: {str(e)}")
-            print("You may need to add indexes manually or recreate the database.")
+    """Create the indexes declared on the models that are missing from the database."""
+    from app.explain import ensure_indexes
+    with app.app_context():
+        print(f"Detected database: {db.engine.dialect.name}")
+        created = ensure_indexes()
+        for name in created:
+            print(f"  ✓ Created index: {name}")
+        print(f"✓ Index creation complete, created {len(created)} indexes")
+
+
+@cli.command()
+@click.option('--verbose', '-v', is_flag=True, help='Print every statement and its plan')
+@click.option('--no-create', is_flag=True, help='Do not create missing indexes before explaining')
+@click.option('--strict', is_flag=True, help='Exit with status 1 when a plan is flagged')
+def explain(verbose, no_create, strict):
+    """Explain the queries of every route and flag full scans and temp B-trees."""
+    from app.explain import ensure_indexes, audit
+    with app.app_context():
+        if not no_create:
+            for name in ensure_indexes():
+                print(f"  ✓ Created index: {name}")
+        flagged = 0
+        for entry in audit():
+            print(f"GET {entry['url']} [{entry['status']}] {len(entry['queries'])} queries")
+            for q in entry['queries']:
+                if not q['problems'] and not verbose:
+                    continue
+                statement = ' '.join(q['statement'].split())
+                print(f"  {'✗' if q['problems'] else '✓'} {statement[:120]}")
+                for problem, detail in q['problems']:
+                    print(f"      {problem}: {detail}")
+                if verbose:
+                    for line in q['plan']:
+                        print(f"      | {line}")
+                flagged += bool(q['problems'])
+        print(f"{flagged} flagged queries")
+        if strict and flagged:
+            raise SystemExit(1)
+
+
+@cli.command()
+def migrate():
+    """Bring an existing database up to date with the models (new tables, columns and indexes)."""
+    from sqlalchemy import inspect, text
+    from app.models import History, SessionBucket, ChangeLog
+    from app.explain import ensure_indexes
+    with app.app_context():
+        db.create_all()
+        inspector = inspect(db.engine)
+        dialect = db.engine.dialect
+        preparer = dialect.identifier_preparer
+        for table in db.metadata.sorted_tables:
+            existing = {c['name'] for c in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name not in existing:
+                    db.session.execute(text(f"ALTER TABLE {preparer.format_table(table)} "
+                                            f"ADD {preparer.format_column(column)} "
+                                            f"{column.type.compile(dialect=dialect)}"))
+                    print(f"  ✓ Added column: {table.name}.{column.name}")
+        db.session.commit()
+        print(f"✓ Checked in {History.close_duplicates()} duplicate open sessions")
+        for name in ensure_indexes():
+            print(f"  ✓ Created index: {name}")
+        print(f"✓ Backfilled server of {History.backfill_server_ids()} sessions")
+        print(f"✓ Backfilled duration of {History.backfill_durations()} sessions")
+        print(f"✓ Indexed {SessionBucket.backfill()} sessions by day")
+        print(f"✓ Seeded the change log with {ChangeLog.backfill()} rows")
+        print("✓ Database is up to date")
+
+
+@cli.command()
+@click.option('--batch-size', default=1000, help='Number of sessions updated per transaction')
+def backfill_durations(batch_size):
+    """Fill in the stored duration of checked in sessions."""
+    from app.models import History
+    with app.app_context():
+        print(f"Backfilled duration of {History.backfill_durations(batch_size)} sessions")
+
+
+@cli.command()
+@click.option('--gap', default=None, type=int, help='Minutes between a check in and the next check out that are '
+                                                    'merged, defaults to SESSION_GAP_MINUTES')
+@click.option('--batch-size', default=500, help='Number of users/workstations/products merged per transaction')
+def merge_sessions(gap, batch_size):
+    """Merge the History rows of sessions that were checked in and out again within a few minutes."""
+    from app.models import History
+    with app.app_context():
+        gap = app.config['SESSION_GAP_MINUTES'] if gap is None else gap
+        print(f"Merged {History.merge_gaps(gap, batch_size)} session fragments")
+
+
+@cli.command()
+@click.option('--batch-size', default=10000, help='Number of update rows read per transaction')
+def compact_updates(batch_size):
+    """Merge consecutive updates of a server with the same status into one interval."""
+    from app.models import Updates
+    with app.app_context():
+        print(f"Merged {Updates.compact(batch_size)} update rows")
+
+
+@cli.command()
+@click.option('--days', default=None, type=int, help='Days of samples kept, defaults to SEATSERIES_RETENTION_DAYS')
+def prune_seats(days):
+    """Fold the per poll seats in use samples of past days into daily rows and delete old days (run daily)."""
+    import datetime
+    from app import timeseries
+    with app.app_context():
+        before = datetime.date.today() - datetime.timedelta(days=days) if days is not None else None
+        print(f"Deleted {timeseries.prune(before)} product days of seat samples")
+
+
+@cli.command()
+@click.option('--interval', default=None, type=int, help='Seconds between runs (default: apply once and exit)')
+@click.option('--batch-size', default=None, type=int, help='Entries applied per run (default: all)')
+def apply_journal(interval, batch_size):
+    """Write the polls in the journal (JOURNAL_DIR) to the database."""
+    from app import journal
+    with app.app_context():
+        if not app.config['JOURNAL_DIR']:
+            raise click.UsageError('JOURNAL_DIR is not set')
+        journal.run(interval, batch_size)
+
+
+@cli.command()
+@click.option('--start', required=True, help='First day, YYYY-MM-DD')
+@click.option('--end', default=None, help='Last day, YYYY-MM-DD, defaults to today')
+def rebuild_sketches(start, end):
+    """Write the daily unique user sketches of a range of days again from the session history."""
+    import datetime
+    from app import sketch
+    with app.app_context():
+        start = datetime.date.fromisoformat(start)
+        end = datetime.date.fromisoformat(end) if end else datetime.date.today()
+        print(f"Wrote {sketch.rebuild(start, end)} sketches")
 
 
 @cli.command()
@@ -136,14 +182,250 @@ def test():
 
 
 @cli.command()
-def read_once():
+@click.option('--totals-only', is_flag=True, help='Only update the seats in use, skip the per-user checkouts')
+def read_once(totals_only):
     """A one-time read from the license server."""
-    from app.read_licenses import read
+    from app.read_licenses import read, read_totals
     with app.app_context():
-        read()
+        if totals_only:
+            read_totals()
+        else:
+            read()
         print('Read completed.')
 
 
+@cli.command()
+@click.option('--worker-id', default=None, help='Unique worker id, defaults to <hostname>-<pid>')
+@click.option('--processes', default=1, help='Number of local worker processes to start')
+@click.option('--interval', default=None, type=int, help='Seconds between cycles, defaults to the fastest tier')
+@click.option('--ttl', default=None, type=int, help='Lease duration in seconds, defaults to POLL_LEASE_TTL')
+@click.option('--cycles', default=None, type=int, help='Stop after this many cycles (default: run forever)')
+def poll(worker_id, processes, interval, ttl, cycles):
+    """Poll the license servers continuously, sharing them with other workers."""
+    from app.poller import run_workers
+    run_workers(processes, cycles=cycles, worker_id=worker_id, interval=interval, ttl=ttl)
+
+
+@cli.command()
+@click.argument('urls', nargs=-1, required=True)
+@click.option('--limit', default=1000, help='Change log entries requested per batch')
+@click.option('--interval', default=None, type=int, help='Pull again every this many seconds (default: pull once)')
+def federate(urls, limit, interval):
+    """Pull the /data/changes feeds of other tracker instances into this database."""
+    import time
+    from app.federation import pull
+    from app.logger_setup import logger
+    with app.app_context():
+        db.create_all()
+        while True:
+            for url in urls:
+                try:
+                    products, sessions = pull(url, limit=limit)
+                    print(f"{url}: applied {products} product and {sessions} session changes")
+                except Exception as e:
+                    logger.error(f"Federation pull from {url} failed: {e}")
+                    print(f"{url}: failed: {e}")
+            if interval is None:
+                break
+            time.sleep(interval)
+
+
+@cli.command()
+@click.option('--days', default=None, type=int, help='Days of entries kept, defaults to CHANGELOG_RETENTION_DAYS')
+def prune_changes(days):
+    """Delete old entries of the change log served to other instances at /data/changes (run daily)."""
+    import datetime
+    from app.models import ChangeLog
+    with app.app_context():
+        days = app.config['CHANGELOG_RETENTION_DAYS'] if days is None else days
+        print(f"Deleted {ChangeLog.prune(datetime.datetime.now() - datetime.timedelta(days=days))} change log entries")
+
+
+@cli.command()
+@click.option('--dir', 'directory', default=None, help='Directory to write to, defaults to PUBLISH_DIR')
+def publish(directory):
+    """Write the dashboard, listing and server pages as static files."""
+    from app.publish import publish as publish_pages
+    directory = directory or app.config['PUBLISH_DIR']
+    if not directory:
+        raise click.UsageError('Pass --dir or set PUBLISH_DIR')
+    with app.app_context():
+        written, removed = publish_pages(directory)
+    print(f"Published to {directory}: {written} files written, {removed} removed")
+
+
+@cli.command()
+@click.option('--interval', default=None, type=int, help='Copy again every this many seconds (default: copy once)')
+def sync_replica(interval):
+    """Copy the primary SQLite database into the read replica (REPLICA_DATABASE_URL)."""
+    import time
+    from app.replica import sync
+    with app.app_context():
+        if 'replica' not in db.engines:
+            raise click.UsageError('REPLICA_DATABASE_URL is not set')
+        primary, replica = db.engine, db.engines['replica']
+        if primary.dialect.name != 'sqlite' or replica.dialect.name != 'sqlite':
+            raise click.UsageError('sync-replica copies SQLite files, use the replication of your database server')
+        while True:
+            sync(primary.url.database, replica.url.database)
+            print(f"Copied {primary.url.database} to {replica.url.database}")
+            if interval is None:
+                break
+            time.sleep(interval)
+
+
+@cli.command()
+@click.argument('route')
+@click.option('--repeat', default=1, help='Number of times to request the route')
+@click.option('--mode', type=click.Choice(['cprofile', 'sampling']), default=None,
+              help='Profiler mode, defaults to PROFILER_MODE')
+def profile_route(route, repeat, mode):
+    """Profile a route (eg. /users) and write the reports to PROFILER_DIR."""
+    from app.profiler import load_report
+    app.config['PROFILER_ENABLED'] = True
+    if mode:
+        app.config['PROFILER_MODE'] = mode
+    headers = {'X-Profile': app.config.get('PROFILER_TOKEN') or '1'}
+    client = app.test_client()
+    for i in range(repeat):
+        response = client.get(route, headers=headers)
+        report_id = response.headers.get('X-Profile-Report')
+        if not report_id:
+            print(f"{route} returned {response.status_code} without a profile report")
+            continue
+        report = load_report(report_id)
+        print(f"{route} [{response.status_code}] total: {report['total_ms']:.1f}ms | "
+              f"sql: {report['sql_ms']:.1f}ms ({report['sql_count']} queries) | "
+              f"render: {report['render_ms']:.1f}ms | python: {report['python_ms']:.1f}ms")
+        print(f"  report: {os.path.join(app.config['PROFILER_DIR'], report.get('profile', report_id + '.json'))}")
+
+
+@cli.command()
+@click.option('--url', default=None, help='Load test a running instance instead of a scratch database')
+@click.option('--routes', default=None, help="Weighted route mix, eg. '/:5,/users:2,/servers/gis-license-1:1'")
+@click.option('--threads', default=16, help='Number of concurrent clients')
+@click.option('--requests', 'total', default=2000, help='Total number of requests')
+@click.option('--duration', default=None, type=float, help='Run for this many seconds instead of a request count')
+@click.option('--port', default=5050, help='Port of the scratch server')
+@click.option('--servers', default=2, help='License servers generated in the scratch database')
+@click.option('--users', default=300, help='Users generated in the scratch database')
+@click.option('--days', default=60, help='Days of history generated in the scratch database')
+@click.option('--json', 'json_path', default=None, help="Write the report as JSON to this file ('-' for stdout)")
+def loadtest(url, routes, threads, total, duration, port, servers, users, days, json_path):
+    """Load test the app and report throughput and latency per route."""
+    import json
+    import subprocess
+    import sys
+    import tempfile
+    import time
+    import urllib.request
+    from app import loadtest as lt
+
+    scratch = server = None
+    if url is None:
+        scratch = tempfile.mkdtemp(prefix='loadtest-')
+        env = dict(os.environ, FLASK_ENV='production', FLASK_DEBUG='0', SERVER_TIMING='1',
+                   DATABASE_URL='sqlite:///' + os.path.join(scratch, 'loadtest.db'))
+        print(f"Generating {days} days of history for {users} users on a scratch database in {scratch}")
+        server = subprocess.Popen([sys.executable, os.path.abspath(__file__), 'loadtest-server', '--port', str(port),
+                                   '--servers', str(servers), '--users', str(users), '--days', str(days)],
+                                  cwd=scratch, env=env)
+        url = f"http://127.0.0.1:{port}"
+        while True:
+            if server.poll() is not None:
+                raise click.ClickException('The scratch server exited before it was ready')
+            try:
+                urllib.request.urlopen(url + '/servers', timeout=5).read()
+                break
+            except OSError:
+                time.sleep(0.5)
+    try:
+        mix = lt.parse_mix(routes or lt.DEFAULT_MIX)
+        print(f"Sending {f'{duration}s of' if duration else total} requests from {threads} threads to {url}")
+        results, elapsed = lt.run(url, mix, threads=threads, requests=None if duration else total, duration=duration)
+        report = lt.report(results, elapsed, threads)
+        print(lt.format_report(report))
+        if json_path == '-':
+            print(json.dumps(report, indent=2))
+        elif json_path:
+            with open(json_path, 'w') as f:
+                json.dump(report, f, indent=2)
+            print(f"Report written to {json_path}")
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+        if scratch:
+            import shutil
+            shutil.rmtree(scratch, ignore_errors=True)
+
+
+@cli.command(hidden=True)
+@click.option('--port', default=5050)
+@click.option('--servers', default=2)
+@click.option('--users', default=300)
+@click.option('--days', default=60)
+def loadtest_server(port, servers, users, days):
+    """Fill the configured database with generated data and serve the app without the debugger."""
+    from werkzeug.serving import make_server, WSGIRequestHandler
+    from app.fake_populate import populate_large
+
+    class QuietHandler(WSGIRequestHandler):
+        def log_request(self, *args, **kwargs):
+            pass
+
+    with app.app_context():
+        db.create_all()
+        print(f"Generated {populate_large(servers=servers, users=users, workstations=users, days=days)} sessions")
+    make_server('127.0.0.1', port, app, threaded=True, request_handler=QuietHandler).serve_forever()
+
+
+@cli.command()
+@click.argument('names', nargs=-1)
+@click.option('--repeat', default=5, help='Number of timed repeats per benchmark')
+@click.option('--min-time', default=0.05, help='Minimum seconds per repeat, fast benchmarks are called in a loop')
+@click.option('--threshold', default=0.2, help='Slowdown of the median (0.2 = 20%) flagged as a regression')
+@click.option('--baseline', 'baseline_path', default=None, help='Baseline file, defaults to benchmarks/baseline.json')
+@click.option('--save', is_flag=True, help='Save the results as the new baseline')
+@click.option('--json', 'json_path', default=None, help="Write the results as JSON to this file ('-' for stdout)")
+def bench(names, repeat, min_time, threshold, baseline_path, save, json_path):
+    """Run the benchmarks (optionally only those starting with NAMES, eg. parse ingest) against an in-memory database."""
+    import json
+    import subprocess
+    import sys
+    from app import bench as b
+    if app.config['SQLALCHEMY_DATABASE_URI'] != 'sqlite://':
+        env = dict(os.environ, DATABASE_URL='sqlite://', FLASK_ENV='production', FLASK_DEBUG='0')
+        raise SystemExit(subprocess.call([sys.executable, os.path.abspath(__file__)] + sys.argv[1:], env=env))
+
+    baseline_path = baseline_path or b.BASELINE_PATH
+    results = b.run(names, repeat=repeat, min_time=min_time,
+                    progress=lambda name, r: print(f"  {name:<40} {r['median_us']:>14,.1f}us  (x{r['number']})"))
+    regressions = 0
+    baseline = b.load_baseline(baseline_path)
+    if baseline:
+        print(f"\nCompared to {baseline_path} (threshold {threshold:.0%}):")
+        for name, before, after, ratio, status in b.compare(results, baseline, threshold):
+            if status == 'new':
+                print(f"  {name:<40} new")
+                continue
+            mark = {'regression': '✗', 'improvement': '✓'}.get(status, ' ')
+            print(f"  {mark} {name:<38} {before:>14,.1f}us -> {after:>14,.1f}us  x{ratio}  {status}")
+            regressions += status == 'regression'
+    if json_path == '-':
+        print(json.dumps(results, indent=2))
+    elif json_path:
+        with open(json_path, 'w') as f:
+            json.dump(results, f, indent=2)
+    if save:
+        with app.app_context():
+            b.save_baseline(results, baseline_path)
+        print(f"Baseline saved to {baseline_path}")
+    if regressions and not save:
+        print(f"{regressions} regressions")
+        raise SystemExit(1)
+
+
 @cli.command()
 @click.option('--host', default='127.0.0.1', help='The host to bind to')
 @click.option('--port', default=5001, help='The port to bind to')
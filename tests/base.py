@@ -1,6 +1,6 @@
 from flask_testing import TestCase
 import os
-from app import app, db
+from app import app, db, cache
 
 dir_path = os.path.dirname(os.path.realpath(__file__))
 
@@ -12,6 +12,7 @@ class BaseTestCase(TestCase):
     def setUp(self):
         db.create_all()
         db.session.commit()
+        cache.clear()
 
         with open(os.path.join(dir_path, 'data', 'prod-license.txt')) as data:
             self.prod_server_data = data.read()
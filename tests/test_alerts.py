@@ -0,0 +1,154 @@
+import datetime
+import json
+import os
+import socketserver
+import tempfile
+import threading
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from tests.base import BaseTestCase, dir_path
+from app import app, db
+from app import alerts
+from app.alerts import Snapshot, evaluate, SINKS
+from app.models import AlertState, ServerState
+from app.read_licenses import read_server
+
+
+class WebhookStub(BaseHTTPRequestHandler):
+    received = []
+
+    def do_POST(self):
+        self.received.append(json.loads(self.rfile.read(int(self.headers['Content-Length']))))
+        self.send_response(204)
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+class SMTPStub(socketserver.StreamRequestHandler):
+    """Just enough SMTP to accept a message."""
+    received = []
+
+    def handle(self):
+        self.wfile.write(b'220 stub\r\n')
+        while True:
+            line = self.rfile.readline().decode().strip()
+            command = line.split(' ', 1)[0].upper()
+            if command == 'DATA':
+                self.wfile.write(b'354 go ahead\r\n')
+                data = []
+                for body in iter(self.rfile.readline, b'.\r\n'):
+                    data.append(body.decode())
+                self.received.append(''.join(data))
+                self.wfile.write(b'250 ok\r\n')
+            elif command == 'QUIT' or not line:
+                self.wfile.write(b'221 bye\r\n')
+                return
+            else:
+                self.wfile.write(b'250 ok\r\n')
+
+
+class TestAlerts(BaseTestCase):
+    def setUp(self):
+        super(TestAlerts, self).setUp()
+        alerts._states.clear()
+        self.sent = []
+        SINKS['memory'] = self.sent.append
+        self.sinks = app.config['ALERT_SINKS']
+        app.config['ALERT_SINKS'] = ['memory']
+        self.start = datetime.datetime(2024, 5, 6, 9, 0)
+
+    def tearDown(self):
+        app.config['ALERT_SINKS'] = self.sinks
+        del SINKS['memory']
+        super(TestAlerts, self).tearDown()
+
+    def snapshot(self, minutes, out, total=10, failures=0, sessions=None):
+        s = Snapshot('lic-1', 1, time=self.start + datetime.timedelta(minutes=minutes))
+        s.add_product('ARC/INFO', out, total)
+        s.failures = failures
+        for user, time_out in sessions or ():
+            s.add_session('ARC/INFO', user, user.upper() + '-PC', time_out)
+        return s
+
+    def states(self, rule=None):
+        return [(a['rule'], a['state']) for a in self.sent if rule is None or a['rule'] == rule]
+
+    def test_hysteresis(self):
+        rules = [{'name': 'high', 'type': 'seats', 'above': 0.9, 'below': 0.7}]
+        for minute, out in enumerate([5, 9, 10, 8, 9, 6, 9]):
+            evaluate(self.snapshot(minute, out), rules)
+        # fires at 9, stays firing at 8 (above 'below'), clears at 6 and fires again
+        self.assertEqual(self.states(), [('high', 'firing'), ('high', 'resolved'), ('high', 'firing')])
+        self.assertEqual(db.session.get(AlertState, ('high', 'lic-1/ARC/INFO')).state, 'FIRING')
+
+    def test_saturation_duration(self):
+        rules = [{'name': 'saturated', 'type': 'seats', 'above': 1.0, 'for': 15}]
+        evaluate(self.snapshot(0, 10), rules)
+        evaluate(self.snapshot(10, 10), rules)
+        self.assertEqual(self.sent, [])
+        # the pending state survives a restart of the process
+        alerts._states.clear()
+        evaluate(self.snapshot(15, 10), rules)
+        self.assertEqual(self.states(), [('saturated', 'firing')])
+        self.assertEqual(self.sent[0]['since'], self.start.isoformat())
+        evaluate(self.snapshot(16, 10), rules)
+        self.assertEqual(len(self.sent), 1)
+        # a dip resets the duration
+        evaluate(self.snapshot(20, 9), rules)
+        evaluate(self.snapshot(21, 10), rules)
+        evaluate(self.snapshot(30, 10), rules)
+        self.assertEqual(self.states(), [('saturated', 'firing'), ('saturated', 'resolved')])
+
+    def test_long_sessions(self):
+        rules = [{'name': 'long', 'type': 'long_session', 'hours': 24}]
+        old = self.start - datetime.timedelta(days=2)
+        evaluate(self.snapshot(0, 2, sessions=[('ann', old), ('bob', self.start)]), rules)
+        self.assertEqual([a['key'] for a in self.sent], ['lic-1/ARC/INFO/ann/ANN-PC'])
+        evaluate(self.snapshot(1, 2, sessions=[('ann', old), ('bob', self.start)]), rules)
+        # a totals-only poll does not know the sessions
+        evaluate(self.snapshot(2, 1), rules)
+        self.assertEqual(len(self.sent), 1)
+        evaluate(self.snapshot(3, 1, sessions=[('bob', self.start)]), rules)
+        self.assertEqual(self.states(), [('long', 'firing'), ('long', 'resolved')])
+
+    def test_server_down(self):
+        server = {'hostname': 'prod-license', 'port': '27000'}
+        fd, error_file = tempfile.mkstemp()
+        with os.fdopen(fd, 'w') as f:
+            f.write('Error getting status: Cannot connect to license server system.\n')
+        try:
+            for i in range(3):
+                read_server(server, license_file=error_file)
+            self.assertEqual(self.states('server-down'), [('server-down', 'firing')])
+            state = ServerState.query.first()
+            state.next_attempt = datetime.datetime.now() - datetime.timedelta(seconds=1)
+            db.session.commit()
+            read_server(server, license_file=os.path.join(dir_path, 'data', 'prod-license.txt'))
+            self.assertEqual(self.states('server-down'), [('server-down', 'firing'), ('server-down', 'resolved')])
+        finally:
+            os.remove(error_file)
+
+    def test_webhook_and_email_sinks(self):
+        WebhookStub.received, SMTPStub.received = [], []
+        web = HTTPServer(('127.0.0.1', 0), WebhookStub)
+        smtp = socketserver.ThreadingTCPServer(('127.0.0.1', 0), SMTPStub)
+        for server in (web, smtp):
+            threading.Thread(target=server.serve_forever, daemon=True).start()
+        config = {'ALERT_SINKS': ['webhook', 'email'],
+                  'ALERT_WEBHOOK_URL': 'http://127.0.0.1:{}/alerts'.format(web.server_address[1]),
+                  'ALERT_SMTP_HOST': '127.0.0.1', 'ALERT_SMTP_PORT': smtp.server_address[1],
+                  'ALERT_EMAIL_TO': ['gis-admins@localhost']}
+        previous = {k: app.config[k] for k in config}
+        app.config.update(config)
+        try:
+            evaluate(self.snapshot(0, 10), [{'name': 'saturated', 'type': 'seats', 'above': 1.0}])
+        finally:
+            app.config.update(previous)
+            web.shutdown()
+            smtp.shutdown()
+            web.server_close()
+            smtp.server_close()
+        self.assertEqual(WebhookStub.received[0]['rule'], 'saturated')
+        self.assertEqual(WebhookStub.received[0]['state'], 'firing')
+        self.assertIn('Subject: [FIRING] saturated:', SMTPStub.received[0])
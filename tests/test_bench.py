@@ -0,0 +1,29 @@
+import os
+import shutil
+import tempfile
+from tests.base import BaseTestCase
+from app import bench
+
+
+class TestBench(BaseTestCase):
+    def test_measure(self):
+        calls = []
+        r = bench.measure(lambda: calls.append(1), repeat=3, min_time=0.001)
+        self.assertGreaterEqual(len(calls), r['number'] * 3)
+        self.assertLessEqual(r['min_us'], r['median_us'])
+
+    def test_run_parse_benchmark(self):
+        results = bench.run(['parse.split_license_data'], repeat=2, min_time=0.001)
+        self.assertEqual(list(results), ['parse.split_license_data'])
+
+    def test_baseline_compare(self):
+        directory = tempfile.mkdtemp()
+        path = os.path.join(directory, 'baseline.json')
+        try:
+            bench.save_baseline({'a': {'median_us': 100.0}, 'b': {'median_us': 100.0}}, path)
+            baseline = bench.load_baseline(path)
+            results = {'a': {'median_us': 130.0}, 'b': {'median_us': 105.0}, 'c': {'median_us': 1.0}}
+            status = {name: s for name, before, after, ratio, s in bench.compare(results, baseline, threshold=0.2)}
+            self.assertEqual(status, {'a': 'regression', 'b': 'ok', 'c': 'new'})
+        finally:
+            shutil.rmtree(directory)
@@ -0,0 +1,84 @@
+import threading
+import time
+from tests.base import BaseTestCase
+from app import app, cache
+from app import caching
+
+
+class TestCaching(BaseTestCase):
+    def setUp(self):
+        super(TestCaching, self).setUp()
+        self.renders = 0
+
+        @caching.cached_view('test-page')
+        def page():
+            time.sleep(0.2)
+            self.renders += 1
+            return 'page {}'.format(self.renders)
+        self.page = page
+
+    def tearDown(self):
+        caching.VIEWS.pop('test-page', None)
+        super(TestCaching, self).tearDown()
+
+    def get(self, results=None):
+        with app.test_request_context('/test-page'):
+            value = self.page()
+        if results is not None:
+            results.append(value)
+        return value
+
+    def test_single_flight(self):
+        results = []
+        threads = [threading.Thread(target=self.get, args=(results,)) for _ in range(8)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(self.renders, 1)
+        self.assertEqual(results, ['page 1'] * 8)
+        self.assertIsNone(cache.get('view-lock:test-page'))
+
+    def test_stale_while_revalidate(self):
+        self.assertEqual(self.get(), 'page 1')
+        caching.invalidate('test-page')
+        # the stale copy is served while one background render runs
+        self.assertEqual(self.get(), 'page 1')
+        self.assertEqual(self.get(), 'page 1')
+        deadline = time.monotonic() + 5
+        while self.get() == 'page 1' and time.monotonic() < deadline:
+            time.sleep(0.05)
+        self.assertEqual(self.get(), 'page 2')
+        self.assertEqual(self.renders, 2)
+
+    def test_refresh_ahead_of_expiry(self):
+        self.get()
+        stale_at, value = cache.get('view:test-page')
+        cache.set('view:test-page', (time.time() + app.config['CACHE_REFRESH_AHEAD'] - 1, value))
+        self.assertEqual(self.get(), 'page 1')
+        deadline = time.monotonic() + 5
+        while self.renders < 2 and time.monotonic() < deadline:
+            time.sleep(0.05)
+        self.assertEqual(self.renders, 2)
+
+    def test_warm(self):
+        self.assertEqual(caching.warm(['dashboard']), ['dashboard'])
+        stale_at, page = cache.get('view:dashboard')
+        self.assertGreater(stale_at, time.time())
+        self.assertEqual(self.client.get('/').data.decode('utf-8'), page)
+
+    def test_warm_after_poll(self):
+        # the test page has no URL to render it at
+        caching.VIEWS.pop('test-page')
+        caching.invalidate()
+        # a SimpleCache is not seen by the web workers
+        self.assertEqual(caching.warm_after_poll(), [])
+        cache_type = app.config['CACHE_TYPE']
+        app.config['CACHE_TYPE'] = 'RedisCache'
+        try:
+            caching.invalidate()
+            self.assertIn('dashboard', caching.warm_after_poll())
+            # nothing changed since
+            self.assertEqual(caching.warm_after_poll(), [])
+        finally:
+            app.config['CACHE_TYPE'] = cache_type
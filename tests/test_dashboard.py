@@ -0,0 +1,42 @@
+import datetime
+from flask_caching import make_template_fragment_key
+from tests.base import BaseTestCase
+from app import cache
+from app.models import Server, Product, User, Workstation, Updates, History
+from app.arcgis_config import products
+from app.views.main import serialize_dashboard_data
+
+
+class TestDashboard(BaseTestCase):
+    def test_serialize_single_pass(self):
+        rows = [('WS-1', 'ann', 'Viewer', 1, 5, 'lic-1', None),
+                ('WS-2', 'bob', 'Viewer', 1, 5, 'lic-1', '2020-01-01'),
+                ('WS-3', 'cal', 'Viewer', 0, 2, 'lic-2', '2020-01-01'),
+                ('WS-4', 'dee', 'Pro Advanced', 1, 1, 'lic-1', None)]
+        detail = serialize_dashboard_data(rows, [('Editor', 0, 3, 'lic-2')])
+        self.assertEqual(detail['products'], ['Editor', 'Viewer'])
+        viewer = detail['by_product']['Viewer']['lic-1']
+        self.assertIs(detail['by_server']['lic-1']['Viewer'], viewer)
+        self.assertEqual(viewer.users, [('WS-1', 'ann')])
+        self.assertEqual(detail['by_product']['Viewer']['lic-2'].users, [])
+        self.assertEqual(detail['by_server']['lic-2']['Editor'].total, 3)
+
+        changed = serialize_dashboard_data(rows[1:], [('Editor', 0, 3, 'lic-2')])
+        self.assertNotEqual(changed['versions']['Viewer'], detail['versions']['Viewer'])
+        self.assertEqual(changed['versions']['Editor'], detail['versions']['Editor'])
+
+    def test_product_tab_fragments(self):
+        server_id = Server.upsert('lic-1', 27000)
+        update_id = Updates.record(server_id, 'UP')
+        product_id = Product.upsert(server_id, 'VIEWER', common_name=products['VIEWER']['common_name'],
+                                    category=products['VIEWER']['category'], type=products['VIEWER']['type'],
+                                    license_out=1, license_total=5)
+        History.add(update_id, server_id, user_id=User.add('ann'), workstation_id=Workstation.add('WS-1'),
+                    product_id=product_id, time_out=datetime.datetime.now())
+        cache.clear()
+        response = self.client.get('/')
+        self.assertIn(b'ann', response.data)
+        name = products['VIEWER']['common_name']
+        detail = serialize_dashboard_data([('WS-1', 'ann', name, 1, 5, 'lic-1', None)])
+        fragment = cache.get(make_template_fragment_key('dashboard-tab', vary_on=[name, detail['versions'][name]]))
+        self.assertIn('ann', fragment)
@@ -0,0 +1,46 @@
+import os
+import tempfile
+from sqlalchemy import create_engine, inspect
+from tests.base import BaseTestCase
+from app import db, replica
+from app.explain import ensure_indexes, audit, problems, capture_queries
+
+
+class TestExplain(BaseTestCase):
+    def test_ensure_indexes_creates_missing(self):
+        self.assertEqual(ensure_indexes(), [])
+        db.session.execute(db.text('DROP INDEX idx_history_server_timein'))
+        db.session.commit()
+        self.assertEqual(ensure_indexes(), ['idx_history_server_timein'])
+        names = {i['name'] for i in inspect(db.engine).get_indexes('history')}
+        self.assertIn('idx_history_server_timein', names)
+
+    def test_problems(self):
+        self.assertEqual(problems(['SCAN history']), [('full scan', 'SCAN history')])
+        self.assertEqual(problems(['SCAN history USING COVERING INDEX idx_history_user_product_duration']), [])
+        self.assertEqual(problems(['USE TEMP B-TREE FOR GROUP BY']),
+                         [('temp b-tree', 'USE TEMP B-TREE FOR GROUP BY')])
+
+    def test_audit_captures_route_queries(self):
+        report = audit({'users': '/users'})
+        self.assertEqual(report[0]['status'], 200)
+        self.assertTrue(report[0]['queries'])
+        self.assertTrue(all(q['plan'] for q in report[0]['queries']))
+
+    def test_capture_queries_on_replica(self):
+        fd, path = tempfile.mkstemp(suffix='.db')
+        os.close(fd)
+        db.session.commit()
+        replica.sync(db.engine.url.database, path)
+        db.engines['replica'] = create_engine('sqlite:///' + path)
+        replica._freshness = (None, False)
+        try:
+            status, statements = capture_queries('/servers')
+            self.assertEqual(status, 200)
+            self.assertTrue(statements)
+            # the listing itself is read from the replica
+            self.assertTrue(any('FROM server' in s for s, _ in statements))
+        finally:
+            db.engines.pop('replica').dispose()
+            replica._freshness = (None, False)
+            os.remove(path)
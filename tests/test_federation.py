@@ -0,0 +1,113 @@
+import datetime
+import gzip
+import json
+import os
+from tests.base import BaseTestCase, dir_path
+from app import db
+from app.models import Server, Product, History, User, Workstation, ChangeLog, FederationSource
+from app.federation import apply
+from app.read_licenses import read_server
+
+
+class TestFederation(BaseTestCase):
+    def setUp(self):
+        super(TestFederation, self).setUp()
+        self.server = {'hostname': 'prod-license', 'port': '27000'}
+        self.v1 = os.path.join(dir_path, 'data', 'prod-license.txt')
+        self.v2 = os.path.join(dir_path, 'data', 'prod-license-v2.txt')
+
+    def feed(self, since):
+        response = self.client.get('/data/changes?since={}'.format(since))
+        self.assertEqual(response.status_code, 200)
+        lines = response.data.decode('utf-8').splitlines()
+        return lines, json.loads(lines[-1])['seq']
+
+    def snapshot(self):
+        products = db.session.query(Server.name, Product.internal_name, Product.license_out, Product.license_total). \
+            filter(Server.id == Product.server_id).order_by(Product.internal_name).all()
+        sessions = db.session.query(Product.internal_name, User.name, Workstation.name, History.time_out,
+                                    History.time_in). \
+            filter(Product.id == History.product_id, User.id == History.user_id,
+                   Workstation.id == History.workstation_id).all()
+        return products, sorted(sessions, key=str)
+
+    def test_change_log(self):
+        read_server(self.server, license_file=self.v1)
+        self.assertEqual(db.session.query(ChangeLog).filter_by(kind='history').count(), History.query.count())
+        self.assertEqual(db.session.query(ChangeLog).filter_by(kind='product').count(), db.session.query(Product).count())
+        logged = ChangeLog.query.count()
+        # an unchanged poll logs nothing
+        read_server(self.server, license_file=self.v1)
+        self.assertEqual(ChangeLog.query.count(), logged)
+        read_server(self.server, license_file=self.v2)
+        checked_in = History.query.filter(History.time_in != None).count()
+        self.assertGreater(checked_in, 0)
+        self.assertGreaterEqual(ChangeLog.query.count(), logged + checked_in)
+
+    def test_feed_batches(self):
+        read_server(self.server, license_file=self.v1)
+        lines = self.client.get('/data/changes?limit=5').data.decode('utf-8').splitlines()
+        self.assertEqual(len(lines), 6)
+        self.assertEqual(json.loads(lines[-1]), {'seq': 5, 'kind': 'watermark', 'more': True})
+        response = self.client.get('/data/changes', headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(gzip.decompress(response.data), self.client.get('/data/changes').data)
+
+    def test_apply_is_idempotent(self):
+        read_server(self.server, license_file=self.v1)
+        first, watermark = self.feed(0)
+        read_server(self.server, license_file=self.v2)
+        second, last = self.feed(watermark)
+        self.assertEqual(self.feed(last)[0], [json.dumps({'seq': last, 'kind': 'watermark', 'more': False},
+                                                         separators=(',', ':'))])
+        expected = self.snapshot()
+
+        db.session.remove()
+        db.drop_all()
+        db.create_all()
+        source = FederationSource.get('http://site-b:5000')
+        apply(source, first)
+        apply(source, second)
+        apply(source, second)
+        self.assertEqual(self.snapshot(), expected)
+        self.assertEqual(source.watermark, last)
+        with self.assertRaises(ValueError):
+            apply(source, second[:-1])
+
+    def test_apply_merged_sessions(self):
+        read_server(self.server, license_file=self.v1)
+        h = History.query.order_by(History.id).first()
+        h.check_in(h.time_out + datetime.timedelta(minutes=10))
+        db.session.add(History(update_id=h.update_id, server_id=h.server_id, product_id=h.product_id,
+                               user_id=h.user_id, workstation_id=h.workstation_id,
+                               time_out=h.time_out + datetime.timedelta(minutes=12), time_in=None))
+        db.session.commit()
+        first, watermark = self.feed(0)
+        self.assertEqual(History.merge_gaps(5), 1)
+        second, _ = self.feed(watermark)
+        self.assertIn('"deleted":true', second[0])
+        expected = self.snapshot()
+
+        db.session.remove()
+        db.drop_all()
+        db.create_all()
+        source = FederationSource.get('http://site-b:5000')
+        apply(source, first)
+        apply(source, second)
+        apply(source, second)
+        self.assertEqual(self.snapshot(), expected)
+
+    def test_prune(self):
+        read_server(self.server, license_file=self.v1)
+        logged = ChangeLog.query.count()
+        _, watermark = self.feed(0)
+        self.assertEqual(ChangeLog.prune(datetime.datetime.now() + datetime.timedelta(seconds=1)), logged)
+        self.assertEqual(ChangeLog.pruned(), watermark)
+        # a caller behind the pruned entries is told to resync instead of missing them
+        response = self.client.get('/data/changes?since=0')
+        self.assertEqual(response.status_code, 410)
+        self.assertTrue(response.json['resync'])
+        self.assertEqual(self.feed(watermark)[0][-1], json.dumps({'seq': watermark, 'kind': 'watermark',
+                                                                  'more': False}, separators=(',', ':')))
+        read_server(self.server, license_file=self.v2)
+        self.assertGreater(self.feed(watermark)[1], watermark)
@@ -0,0 +1,108 @@
+import datetime
+import os
+import shutil
+import tempfile
+from sqlalchemy import event
+from sqlalchemy.exc import OperationalError
+from tests.base import BaseTestCase, dir_path
+from app import app, db, journal
+from app.models import History, JournalCursor, Product, Updates
+from app.poller import Poller
+from app.read_licenses import poll_server
+
+
+class TestJournal(BaseTestCase):
+    def setUp(self):
+        super(TestJournal, self).setUp()
+        self.dir = tempfile.mkdtemp()
+        app.config['JOURNAL_DIR'] = self.dir
+        self.server = {'hostname': 'prod-license', 'port': '27000'}
+        self.good_file = os.path.join(dir_path, 'data', 'prod-license.txt')
+
+    def tearDown(self):
+        app.config['JOURNAL_DIR'] = None
+        shutil.rmtree(self.dir)
+        super(TestJournal, self).tearDown()
+
+    def entry(self, minutes_ago, license_file=None):
+        entry = poll_server(self.server, license_file=license_file or self.good_file)
+        entry['time'] = (datetime.datetime.now() - datetime.timedelta(minutes=minutes_ago)).isoformat()
+        return entry
+
+    def test_append(self):
+        journal.append([{'id': 1}, {'id': 2}])
+        path = os.path.join(self.dir, journal.segment_name())
+        with open(path, 'ab') as f:
+            # a corrupt record and a write cut short by a crash
+            f.write(b'00000000 {"id":3}\n' + journal.encode({'id': 4})[:-5])
+        self.assertEqual([e for e, _ in journal.read_segment(path)], [{'id': 1}, {'id': 2}, None])
+        journal.append([{'id': 5}])
+        self.assertEqual([e for e, _ in journal.read_segment(path)], [{'id': 1}, {'id': 2}, None, None, {'id': 5}])
+
+    def test_apply(self):
+        first = self.entry(10)
+        journal.append([first])
+        self.assertEqual(journal.apply(), 1)
+        self.assertGreater(History.query.filter(History.time_in == None).count(), 0)
+        self.assertEqual(Updates.query.first().time_start, datetime.datetime.fromisoformat(first['time']))
+        self.assertEqual(journal.apply(), 0)
+
+        # an entry applied twice changes nothing
+        journal.append([first])
+        journal.apply()
+        self.assertEqual(Updates.query.first().polls, 1)
+
+        # sessions are checked in at the time of the failed poll, not when it is applied
+        fd, error_file = tempfile.mkstemp()
+        with os.fdopen(fd, 'w') as f:
+            f.write('Error getting status: Cannot connect to license server system.\n')
+        failed = self.entry(5, error_file)
+        os.remove(error_file)
+        journal.append([failed])
+        journal.apply()
+        self.assertEqual(History.query.filter(History.time_in == None).count(), 0)
+        self.assertEqual({h.time_in for h in History.query},
+                         {datetime.datetime.fromisoformat(failed['time']).replace(second=0, microsecond=0)})
+
+    def test_truncated_old_segment(self):
+        path = os.path.join(self.dir, journal.segment_name(datetime.datetime.now() - datetime.timedelta(hours=3)))
+        with open(path, 'wb') as f:
+            # the poller crashed during the last write of the hour
+            f.write(journal.encode(self.entry(200)) + journal.encode(self.entry(190))[:-5])
+        self.assertEqual(journal.apply(), 1)
+        self.assertFalse(os.path.exists(path))
+        self.assertEqual(JournalCursor.query.count(), 0)
+
+    def test_retry(self):
+        journal.append([self.entry(10), self.entry(5)])
+        apply_entry = journal.apply_entry
+
+        def unavailable(entry):
+            raise OperationalError('INSERT', {}, Exception('database is locked'))
+        journal.apply_entry = unavailable
+        try:
+            with self.assertRaises(OperationalError):
+                journal.apply()
+        finally:
+            journal.apply_entry = apply_entry
+        db.session.rollback()
+        self.assertEqual(JournalCursor.query.first().offset, 0)
+        self.assertEqual(journal.apply(), 2)
+        self.assertEqual(Updates.query.first().polls, 2)
+
+    def test_poller_without_database(self):
+        poller = Poller(servers=[dict(self.server, totals_interval=1)], license_file=self.good_file, shard=(0, 1))
+
+        def unavailable(*args):
+            raise OperationalError('SELECT', {}, Exception('database is down'))
+        event.listen(db.engine, 'before_cursor_execute', unavailable)
+        try:
+            self.assertEqual(poller.run_cycle()[0][1], 'detail')
+            poller.last_totals = {}
+            self.assertEqual(poller.run_cycle()[0][1], 'totals')
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', unavailable)
+        self.assertEqual(journal.apply(), 2)
+        self.assertEqual(db.session.query(Product).filter_by(internal_name='ARC/INFO').first().license_out, 4)
+        # a shard only polls its own servers
+        self.assertEqual(Poller(servers=[self.server], shard=(1, 2)).journal_servers(), {})
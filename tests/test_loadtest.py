@@ -0,0 +1,39 @@
+from tests.base import BaseTestCase
+from app import app, db
+from app.models import History, Product
+from app.fake_populate import populate_large
+from app import loadtest
+
+
+class TestLoadTest(BaseTestCase):
+    def test_parse_mix(self):
+        self.assertEqual(loadtest.parse_mix('/:5, /users:2,/servers/a:b'),
+                         [('/', 5), ('/users', 2), ('/servers/a:b', 1)])
+
+    def test_report(self):
+        results = [('/', 200, float(ms), {'db': 1.0, 'render': 2.0}) for ms in range(1, 101)]
+        results.append(('/users', 500, 5.0, {}))
+        report = loadtest.report(results, 2.0)
+        self.assertEqual(report['routes']['/']['p50_ms'], 50)
+        self.assertEqual(report['routes']['/']['p99_ms'], 99)
+        self.assertEqual(report['routes']['/']['db_ms'], 1.0)
+        self.assertEqual(report['routes']['/users']['errors'], 1)
+        self.assertIsNone(report['routes']['/users']['db_ms'])
+        self.assertEqual(report['total']['requests'], 101)
+
+    def test_server_timing_header(self):
+        app.config['SERVER_TIMING'] = True
+        try:
+            response = self.client.get('/users')
+        finally:
+            app.config['SERVER_TIMING'] = False
+        timing = loadtest.parse_server_timing(response.headers['Server-Timing'])
+        self.assertEqual(set(timing), {'db', 'render', 'app', 'total'})
+        self.assertNotIn('Server-Timing', self.client.get('/users').headers)
+
+    def test_populate_large(self):
+        inserted = populate_large(servers=1, users=5, workstations=5, days=7)
+        self.assertEqual(db.session.query(History).count(), inserted)
+        self.assertGreater(inserted, 0)
+        open_sessions = db.session.query(History).filter(History.time_in == None).count()
+        self.assertEqual(sum(p.license_out for p in db.session.query(Product)), open_sessions)
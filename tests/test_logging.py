@@ -0,0 +1,66 @@
+import datetime as dt
+import logging
+import os
+import random
+import tempfile
+
+from structlog import DropEvent
+from tests.base import BaseTestCase
+from app.logger_setup import TZ, utc_timestamp, sample_events, BatchingFileHandler
+
+
+class TestLogging(BaseTestCase):
+    def test_utc_timestamp(self):
+        # around the DST change the cached hourly offset must match a full pytz conversion
+        start = dt.datetime(2024, 3, 9, 22, 30)
+        for hours in range(0, 48, 3):
+            local = start + dt.timedelta(hours=hours, minutes=7)
+            expected = TZ.localize(local, True).astimezone(dt.timezone.utc).isoformat()
+            self.assertEqual(utc_timestamp(local), expected)
+
+    def test_sample_events(self):
+        random.seed(0)
+        kept = 0
+        for _ in range(1000):
+            try:
+                event = sample_events(None, 'info', {'event': 'polled', 'sample': 0.1})
+            except DropEvent:
+                continue
+            kept += 1
+            self.assertEqual(event, {'event': 'polled', 'sample_rate': 0.1})
+        self.assertTrue(50 < kept < 150)
+        # warnings and errors are never sampled
+        self.assertEqual(sample_events(None, 'error', {'event': 'failed', 'sample': 0.0}), {'event': 'failed'})
+        # LOG_SAMPLE_RATES
+        random.seed(0)
+        results = []
+        for _ in range(100):
+            try:
+                results.append(sample_events(None, 'info', {'event': 'Cached pages marked stale after license update'}))
+            except DropEvent:
+                pass
+        self.assertLess(len(results), 30)
+
+    def test_batching_file_handler(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'test.log')
+            handler = BatchingFileHandler(path, maxBytes=0, batch_size=3, encoding='utf-8')
+
+            def log(msg, level=logging.INFO):
+                handler.handle(logging.LogRecord('test', level, __file__, 1, msg, None, None))
+
+            def lines():
+                with open(path) as f:
+                    return f.read().splitlines()
+
+            log('a')
+            log('b')
+            self.assertEqual(lines(), [])
+            log('c')
+            self.assertEqual(lines(), ['a', 'b', 'c'])
+            log('d')
+            log('e', logging.ERROR)
+            self.assertEqual(lines(), ['a', 'b', 'c', 'd', 'e'])
+            log('f')
+            handler.close()
+            self.assertEqual(lines(), ['a', 'b', 'c', 'd', 'e', 'f'])
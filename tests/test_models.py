@@ -1,6 +1,8 @@
+import datetime
 from tests.base import BaseTestCase
 from app.arcgis_config import products
-from app.models import Server, Product, Updates, History, User, Workstation
+from app import db
+from app.models import Server, Product, Updates, History, User, Workstation, SessionBucket
 
 class TestProduct(BaseTestCase):
     def test_upsert(self):
@@ -56,20 +58,221 @@ class TestServer(BaseTestCase):
 
 class TestUpdates(BaseTestCase):
 
-    def test_end(self):
-        # test start update
-        start_id = Updates.start(server_id=1)
-        self.assertEqual(start_id, 1)
+    def test_record(self):
+        t = datetime.datetime(2024, 1, 1)
+        first = Updates.record(1, 'UP', now=t)
+        self.assertEqual(Updates.record(1, 'UP', now=t + datetime.timedelta(minutes=1)), first)
+        down = Updates.record(1, 'DOWN', 'no response', now=t + datetime.timedelta(minutes=2))
+        self.assertNotEqual(down, first)
+        Updates.record(1, 'UP', now=t + datetime.timedelta(minutes=5))
+        db.session.commit()
+        self.assertEqual(Updates.query.count(), 3)
+        self.assertEqual(db.session.get(Updates, first).polls, 2)
 
-        # test end update
-        Updates.end(start_id, 'UP', 'test-message')
-        query = Updates.query.order_by(Updates.id.desc()).limit(1).first()
-        self.assertEqual(query.id, 1)
-        self.assertEqual(query.status, 'UP')
-        self.assertEqual(query.info, 'test-message')
+        # 2 minutes UP, 3 minutes DOWN until the server came back, then UP until the end
+        seconds, uptime = Updates.uptime(1, t, t + datetime.timedelta(minutes=10))
+        self.assertEqual(seconds, {'UP': 120, 'DOWN': 180})
+        self.assertAlmostEqual(uptime, 0.4)
+
+    def test_history_page(self):
+        t = datetime.datetime(2024, 1, 1)
+        for i in range(5):
+            Updates.record(1, 'DOWN', now=t + datetime.timedelta(minutes=2 * i))
+            Updates.record(1, 'UP', now=t + datetime.timedelta(minutes=2 * i + 1))
+        db.session.commit()
+        page, key = Updates.history_page(1, limit=3)
+        self.assertEqual([u.time_start.minute for u in page], [8, 6, 4])
+        page, key = Updates.history_page(1, key, limit=3)
+        self.assertEqual([u.time_start.minute for u in page], [2, 0])
+        self.assertIsNone(key)
+
+    def test_compact(self):
+        t = datetime.datetime(2024, 1, 1)
+        for i, status in enumerate(['UP', 'UP', 'UP', 'DOWN', 'UP']):
+            db.session.add(Updates(server_id=1, status=status, time_start=t + datetime.timedelta(minutes=i),
+                                   time_complete=t + datetime.timedelta(minutes=i)))
+        db.session.commit()
+        h = History(update_id=2, server_id=1, product_id=1, user_id=1, workstation_id=1, time_out=t)
+        db.session.add(h)
+        db.session.commit()
+        self.assertEqual(Updates.compact(batch_size=2), 2)
+        self.assertEqual([(u.status, u.polls) for u in Updates.query.order_by(Updates.time_start)],
+                         [('UP', 3), ('DOWN', 1), ('UP', 1)])
+        self.assertEqual(History.query.first().update_id, 1)
+
+    def test_uptime_endpoint(self):
+        Updates.record(Server.upsert('lic-1', 27000), 'UP')
+        db.session.commit()
+        self.assertEqual(self.client.get('/data/server/uptime?servername=lic-1&days=7').status_code, 200)
+        for days in ('abc', '0', '-3', '99999'):
+            response = self.client.get('/data/server/uptime?servername=lic-1&days=' + days)
+            self.assertEqual(response.status_code, 400)
+            self.assertIn('error', response.json)
 
 
 # class TestMultipleServer(BaseTestCase):
 #     for key, val in products.items():
 #         Product.upsert(1, )
 
+
+
+class TestHistory(BaseTestCase):
+    def add_session(self, time_out):
+        server_id = Server.upsert('test1', 27000)
+        product_id = Product.upsert(server_id, 'VIEWER', common_name='Desktop Basic', category='ArcGIS Desktop',
+                                    type='core', license_out=1, license_total=2)
+        return server_id, History.add(update_id=Updates.record(server_id, 'UP'), server_id=server_id,
+                                      user_id=User.add('gus'), workstation_id=Workstation.add('gus-pc'),
+                                      product_id=product_id, time_out=time_out)
+
+    def test_update_stores_duration(self):
+        time_out = datetime.datetime(2020, 1, 2, 9, 0)
+        server_id, history_id = self.add_session(time_out)
+        History.update(history_id, time_out + datetime.timedelta(hours=2, minutes=5), server_id)
+        db.session.commit()
+        self.assertEqual(db.session.get(History, history_id).duration_minutes, 125)
+
+    def test_reset_stores_duration(self):
+        server_id, history_id = self.add_session(datetime.datetime.now() - datetime.timedelta(minutes=30))
+        History.reset(server_id)
+        db.session.commit()
+        self.assertIn(db.session.get(History, history_id).duration_minutes, (29, 30, 31))
+
+    def test_backfill_durations(self):
+        time_out = datetime.datetime(2020, 1, 2, 9, 0)
+        server_id, history_id = self.add_session(time_out)
+        h = db.session.get(History, history_id)
+        h.time_in = time_out + datetime.timedelta(minutes=90)
+        db.session.commit()
+        self.assertEqual(History.backfill_durations(), 1)
+        self.assertEqual(db.session.get(History, history_id).duration_minutes, 90)
+
+    def test_session_time_sums(self):
+        from app.views.main import session_time_sums
+        server_id, closed_id = self.add_session(datetime.datetime(2020, 1, 2, 9, 0))
+        History.update(closed_id, datetime.datetime(2020, 1, 2, 21, 0), server_id)
+        db.session.commit()
+        rows = session_time_sums((User.name,), User.id == History.user_id)
+        self.assertEqual(rows[0].time_sum, 0.5)
+        self.assertIsNotNone(rows[0].time_in)
+
+        # open sessions are added up to now
+        self.add_session(datetime.datetime.now() - datetime.timedelta(hours=12))
+        rows = session_time_sums((User.name,), User.id == History.user_id)
+        self.assertAlmostEqual(rows[0].time_sum, 1.0, places=2)
+        self.assertIsNone(rows[0].time_in)
+
+    def test_backfill_server_ids(self):
+        server_id, history_id = self.add_session(datetime.datetime(2020, 1, 2, 9, 0))
+        self.assertEqual(db.session.get(History, history_id).server_id, server_id)
+        db.session.query(History).update({'server_id': None})
+        db.session.commit()
+        self.assertEqual(History.time_in_none(server_id), [])
+        self.assertEqual(History.backfill_server_ids(), 1)
+        self.assertEqual([h.id for h in History.time_in_none(server_id)], [history_id])
+
+    def test_held_between(self):
+        server_id, history_id = self.add_session(datetime.datetime(2020, 1, 2, 22, 0))
+        History.update(history_id, datetime.datetime(2020, 1, 4, 1, 0), server_id)
+        db.session.commit()
+        self.assertEqual(db.session.query(SessionBucket).filter_by(history_id=history_id).count(), 3)
+        product_id = db.session.get(History, history_id).product_id
+        _, open_id = self.add_session(datetime.datetime(2020, 1, 3, 12, 0))
+
+        def held(start, end=None):
+            return sorted(h.id for h in History.held_between([product_id], start, end))
+        self.assertEqual(held(datetime.datetime(2020, 1, 3, 11, 0)), [history_id])
+        self.assertEqual(held(datetime.datetime(2020, 1, 3, 12, 0)), [history_id, open_id])
+        self.assertEqual(held(datetime.datetime(2020, 1, 4, 1, 0)), [open_id])
+        self.assertEqual(held(datetime.datetime(2020, 1, 1), datetime.datetime(2020, 1, 2, 22, 0)), [history_id])
+
+        response = self.client.get('/data/asof?product=VIEWER&server=test1&t=2020-01-03T12:30')
+        self.assertEqual([(r['username'], r['time_in']) for r in response.json['results']],
+                         [('gus', '2020-01-04T01:00:00'), ('gus', None)])
+        response = self.client.get('/data/asof/range?product=Desktop Basic&start=2020-01-01&end=2020-01-02T23:00')
+        self.assertEqual(len(response.json['results']), 1)
+        self.assertEqual(self.client.get('/data/asof?product=VIEWER&t=yesterday').status_code, 400)
+        self.assertEqual(self.client.get('/data/asof?product=NOPE').status_code, 404)
+
+    def test_backfill_session_buckets(self):
+        server_id, history_id = self.add_session(datetime.datetime(2020, 1, 2, 9, 0))
+        h = db.session.get(History, history_id)
+        h.time_in = datetime.datetime(2020, 1, 3, 9, 0)
+        db.session.commit()
+        self.assertEqual(SessionBucket.backfill(), 1)
+        self.assertEqual(SessionBucket.backfill(), 0)
+        self.assertEqual(db.session.query(SessionBucket).count(), 2)
+
+    def test_add_many_opens_each_session_once(self):
+        server_id, history_id = self.add_session(datetime.datetime(2020, 1, 2, 9, 0))
+        h = db.session.get(History, history_id)
+        session = {'user_id': h.user_id, 'workstation_id': h.workstation_id, 'product_id': h.product_id,
+                   'time_out': datetime.datetime(2020, 1, 2, 9, 0)}
+        update_id = Updates.record(server_id, 'UP')
+        other = dict(session, user_id=User.add('ann'))
+        self.assertEqual(len(History.add_many(update_id, server_id, [session, other, dict(other)])), 1)
+        self.assertEqual(History.add_many(update_id, server_id, [session, other]), [])
+        self.assertEqual(db.session.query(History).filter(History.time_in == None).count(), 2)
+        # the partial unique index only covers open sessions
+        h.check_in(datetime.datetime(2020, 1, 2, 10, 0))
+        db.session.commit()
+        self.assertEqual(len(History.add_many(update_id, server_id, [session])), 1)
+        self.assertEqual(db.session.query(History).count(), 3)
+
+    def test_close_duplicates(self):
+        server_id, history_id = self.add_session(datetime.datetime(2020, 1, 2, 9, 0))
+        db.session.execute(db.text('DROP INDEX uq_history_open_session'))
+        h = db.session.get(History, history_id)
+        db.session.add(History(update_id=h.update_id, server_id=server_id, user_id=h.user_id,
+                               workstation_id=h.workstation_id, product_id=h.product_id, time_out=h.time_out))
+        db.session.commit()
+        self.assertEqual(History.close_duplicates(), 1)
+        self.assertEqual(db.session.query(History).filter(History.time_in == None).one().id, history_id)
+
+    def test_add_many_reopens_recent_session(self):
+        server_id, history_id = self.add_session(datetime.datetime(2020, 1, 2, 9, 0))
+        h = db.session.get(History, history_id)
+        h.check_in(datetime.datetime(2020, 1, 2, 11, 0))
+        db.session.commit()
+        session = {'user_id': h.user_id, 'workstation_id': h.workstation_id, 'product_id': h.product_id,
+                   'time_out': datetime.datetime(2020, 1, 2, 11, 4)}
+        update_id = Updates.record(server_id, 'UP')
+        # seen again 4 minutes after its check in: the row is reopened and its buckets removed
+        self.assertEqual(History.add_many(update_id, server_id, [session], gap_minutes=5), [history_id])
+        self.assertEqual(db.session.query(History).count(), 1)
+        self.assertIsNone(db.session.get(History, history_id).time_in)
+        self.assertEqual(db.session.query(SessionBucket).count(), 0)
+        self.assertEqual(History.add_many(update_id, server_id, [session], gap_minutes=5), [])
+
+        h.check_in(datetime.datetime(2020, 1, 2, 12, 0))
+        db.session.commit()
+        later = dict(session, time_out=datetime.datetime(2020, 1, 2, 12, 6))
+        self.assertNotEqual(History.add_many(update_id, server_id, [later], gap_minutes=5), [history_id])
+        self.assertEqual(db.session.query(History).count(), 2)
+
+    def test_merge_gaps(self):
+        server_id, history_id = self.add_session(datetime.datetime(2020, 1, 2, 9, 0))
+        h = db.session.get(History, history_id)
+        key = {'user_id': h.user_id, 'workstation_id': h.workstation_id, 'product_id': h.product_id,
+               'update_id': h.update_id, 'server_id': server_id}
+        h.check_in(datetime.datetime(2020, 1, 2, 10, 0))
+        fragments = []
+        for time_out, time_in in ((datetime.datetime(2020, 1, 2, 10, 3), datetime.datetime(2020, 1, 2, 23, 50)),
+                                  (datetime.datetime(2020, 1, 3, 8, 0), datetime.datetime(2020, 1, 3, 9, 0)),
+                                  (datetime.datetime(2020, 1, 3, 9, 2), None)):
+            fragments.append(History(time_out=time_out, **key))
+            db.session.add(fragments[-1])
+            if time_in:
+                fragments[-1].check_in(time_in)
+        db.session.commit()
+        fragment_ids = [f.id for f in fragments]
+
+        self.assertEqual(History.merge_gaps(5), 2)
+        rows = db.session.query(History).order_by(History.time_out).all()
+        self.assertEqual([(r.id, r.time_out, r.time_in) for r in rows],
+                         [(history_id, datetime.datetime(2020, 1, 2, 9, 0), datetime.datetime(2020, 1, 2, 23, 50)),
+                          (fragment_ids[1], datetime.datetime(2020, 1, 3, 8, 0), None)])
+        self.assertEqual(rows[0].duration_minutes, 14 * 60 + 50)
+        self.assertEqual({(b.history_id, b.bucket) for b in db.session.query(SessionBucket)},
+                         {(history_id, datetime.date(2020, 1, 2).toordinal())})
+        self.assertEqual(History.merge_gaps(5), 0)
@@ -0,0 +1,74 @@
+import datetime
+import os
+from sqlalchemy.dialects import mssql, postgresql
+from tests.base import BaseTestCase, dir_path
+from app import db
+from app.models import ServerLease, PollerWorker, Updates
+from app.poller import Poller
+
+servers = [{'hostname': 'license-{}'.format(i), 'port': '27000'} for i in range(4)]
+
+
+class TestPoller(BaseTestCase):
+    def test_lock_free_sql(self):
+        free = Poller.lock_free(db.session.query(ServerLease), 2)
+        sql = str(free.statement.compile(dialect=mssql.dialect()))
+        self.assertIn('WITH (UPDLOCK, READPAST, ROWLOCK)', sql)
+        sql = str(free.statement.compile(dialect=postgresql.dialect()))
+        self.assertIn('FOR UPDATE SKIP LOCKED', sql)
+        self.assertNotIn('READPAST', sql)
+
+    def test_single_worker_claims_all(self):
+        a = Poller(worker_id='a', ttl=60, servers=servers)
+        self.assertEqual(len(a.claim()), 4)
+        # renewing keeps the same leases
+        self.assertEqual(len(a.claim()), 4)
+
+    def test_rebalance_when_worker_joins(self):
+        a = Poller(worker_id='a', ttl=60, servers=servers)
+        b = Poller(worker_id='b', ttl=60, servers=servers)
+        self.assertEqual(len(a.claim()), 4)
+        # b joins, all leases are held by a
+        self.assertEqual(b.claim(), [])
+        # a gives up the servers above its share, b picks them up
+        held_a = a.claim()
+        held_b = b.claim()
+        self.assertEqual(len(held_a), 2)
+        self.assertEqual(len(held_b), 2)
+        self.assertFalse(set(held_a) & set(held_b))
+
+    def test_rebalance_when_worker_dies(self):
+        a = Poller(worker_id='a', ttl=60, servers=servers)
+        b = Poller(worker_id='b', ttl=60, servers=servers)
+        a.claim()
+        b.claim()
+        a.claim()
+        b.claim()
+        # a stops heartbeating and its leases expire
+        past = datetime.datetime.now() - datetime.timedelta(minutes=5)
+        PollerWorker.beat('a', past)
+        db.session.query(ServerLease).filter_by(worker_id='a').update({'expires': past})
+        db.session.commit()
+        self.assertEqual(len(b.claim()), 4)
+        self.assertFalse(a.renew(b.claim()[0]))
+
+    def test_run_cycle(self):
+        a = Poller(worker_id='a', ttl=60, servers=[{'hostname': 'prod-license', 'port': '27000'}],
+                   license_file=os.path.join(dir_path, 'data', 'prod-license.txt'))
+        a.run(cycles=1)
+        self.assertEqual(Updates.query.count(), 1)
+        # leases and the worker are released on exit
+        self.assertEqual(ServerLease.query.filter(ServerLease.worker_id != None).count(), 0)
+        self.assertEqual(PollerWorker.query.count(), 0)
+
+    def test_tiers(self):
+        a = Poller(worker_id='a', ttl=60, servers=[{'hostname': 'prod-license', 'port': '27000',
+                                                     'totals_interval': 5, 'detail_interval': 60}],
+                   license_file=os.path.join(dir_path, 'data', 'prod-license.txt'))
+        self.assertEqual(a.interval, 5)
+        self.assertEqual(a.run_cycle()[0][1], 'detail')
+        server_id = list(a.servers)[0]
+        now = datetime.datetime.now()
+        self.assertIsNone(a.tier(server_id, now))
+        self.assertEqual(a.tier(server_id, now + datetime.timedelta(seconds=5)), 'totals')
+        self.assertEqual(a.tier(server_id, now + datetime.timedelta(seconds=60)), 'detail')
@@ -0,0 +1,41 @@
+import os
+import shutil
+import tempfile
+from tests.base import BaseTestCase
+from app import app
+from app.profiler import load_report
+
+
+class TestProfiler(BaseTestCase):
+    def setUp(self):
+        super(TestProfiler, self).setUp()
+        self.profile_dir = tempfile.mkdtemp()
+        app.config['PROFILER_ENABLED'] = True
+        app.config['PROFILER_TOKEN'] = 'secret'
+        app.config['PROFILER_DIR'] = self.profile_dir
+
+    def tearDown(self):
+        app.config['PROFILER_ENABLED'] = False
+        app.config['PROFILER_TOKEN'] = None
+        app.config['PROFILER_MODE'] = 'cprofile'
+        shutil.rmtree(self.profile_dir)
+        super(TestProfiler, self).tearDown()
+
+    def test_unauthorized_request_is_not_profiled(self):
+        response = self.client.get('/users', headers={'X-Profile': 'wrong'})
+        self.assertNotIn('X-Profile-Report', response.headers)
+        self.assertEqual(os.listdir(self.profile_dir), [])
+
+    def test_cprofile_report(self):
+        response = self.client.get('/users?profile=secret')
+        report = load_report(response.headers['X-Profile-Report'])
+        self.assertEqual(report['endpoint'], 'users')
+        self.assertGreater(report['sql_count'], 0)
+        self.assertGreater(report['render_ms'], 0)
+        self.assertTrue(os.path.exists(os.path.join(self.profile_dir, report['profile'])))
+
+    def test_sampling_report(self):
+        app.config['PROFILER_MODE'] = 'sampling'
+        response = self.client.get('/workstations', headers={'X-Profile': 'secret'})
+        report = load_report(response.headers['X-Profile-Report'])
+        self.assertTrue(report['profile'].endswith('.folded'))
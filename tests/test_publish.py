@@ -0,0 +1,73 @@
+import gzip
+import json
+import os
+import shutil
+import tempfile
+from tests.base import BaseTestCase
+from app import app, caching, db
+from app.models import Server, Updates
+from app.publish import publish, publish_after_poll, load_manifest
+
+
+class TestPublish(BaseTestCase):
+    def setUp(self):
+        super(TestPublish, self).setUp()
+        self.dir = tempfile.mkdtemp()
+        for name in ('lic-1', 'lic-2'):
+            Updates.record(Server.upsert(name, 27000), 'UP')
+        db.session.commit()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+        super(TestPublish, self).tearDown()
+
+    def test_publish(self):
+        written, removed = publish(self.dir)
+        self.assertEqual((written, removed), (8, 0))
+        files = load_manifest(self.dir)['files']
+        self.assertEqual(files['servers/lic-1/index.html']['url'], '/servers/lic-1')
+        page = os.path.join(self.dir, 'servers', 'index.html')
+        with open(page, 'rb') as f:
+            html = f.read()
+        self.assertIn(b'lic-2', html)
+        with gzip.open(page + '.gz') as f:
+            self.assertEqual(f.read(), html)
+        with open(os.path.join(self.dir, 'servers', 'lic-1', 'availability.json')) as f:
+            self.assertEqual(json.load(f), [])
+        self.assertFalse([f for _, _, names in os.walk(self.dir) for f in names if f.startswith('.publish-')])
+
+        # unchanged pages are not written again, pages of servers that are gone are removed
+        unchanged = os.path.join(self.dir, 'servers', 'lic-1', 'availability.json')
+        mtime = os.stat(unchanged).st_mtime_ns
+        server = db.session.query(Server).filter_by(name='lic-2').one()
+        db.session.query(Updates).filter_by(server_id=server.id).delete()
+        db.session.delete(server)
+        db.session.commit()
+        written, removed = publish(self.dir)
+        self.assertEqual(removed, 2)
+        self.assertFalse(os.path.exists(os.path.join(self.dir, 'servers', 'lic-2', 'index.html')))
+        self.assertNotIn('servers/lic-2/index.html', load_manifest(self.dir)['files'])
+        self.assertEqual(os.stat(unchanged).st_mtime_ns, mtime)
+        self.assertLess(written, 6)
+
+    def test_publish_after_changed_poll(self):
+        publish(self.dir)
+        # the page cache and a read replica still hold the listing from before the poll
+        self.assertNotIn(b'lic-3', self.client.get('/servers').data)
+        Updates.record(Server.upsert('lic-3', 27000), 'UP')
+        db.session.commit()
+        publish(self.dir)
+        with open(os.path.join(self.dir, 'servers', 'index.html'), 'rb') as f:
+            self.assertIn(b'lic-3', f.read())
+
+    def test_publish_after_poll(self):
+        app.config['PUBLISH_DIR'] = self.dir
+        try:
+            caching.changed('publish')
+            # a cycle that changed nothing renders nothing
+            self.assertIsNone(publish_after_poll())
+            caching.invalidate()
+            self.assertEqual(publish_after_poll(), (8, 0))
+            self.assertIsNone(publish_after_poll())
+        finally:
+            app.config['PUBLISH_DIR'] = None
@@ -1,7 +1,12 @@
 import datetime
-from tests.base import BaseTestCase
+import os
+import tempfile
+from tests.base import BaseTestCase, dir_path
+from app import app, db
+from app.models import ServerState, Updates, History, Product, ChangeLog
 from app.read_licenses import split_license_data, parse_server_info, add_product, add_users_and_workstations, \
-    map_product_id, parse_product_info, parse_version_info, parse_users_and_workstations, parse_error_info
+    map_product_id, parse_product_info, parse_version_info, parse_users_and_workstations, parse_error_info, \
+    read_server, read_server_totals, parse_totals, fingerprint, feature_fingerprints
 
 
 class TestFunctions(BaseTestCase):
@@ -18,6 +23,15 @@ class TestFunctions(BaseTestCase):
     def test_reset_year(self):
         pass
 
+    def test_fingerprint(self):
+        later = self.prod_server_data.replace('status on Mon 12/23/2019 14:56', 'status on Tue 12/24/2019 02:10')
+        self.assertEqual(fingerprint(later), fingerprint(self.prod_server_data + '\n\n'))
+        self.assertNotEqual(fingerprint(self.prod_server_data), fingerprint(self.prod_server_data_v2))
+        features = feature_fingerprints(split_license_data(self.prod_server_data))
+        changed = feature_fingerprints(split_license_data(later.replace('Total of 4 licenses in use',
+                                                                        'Total of 3 licenses in use')))
+        self.assertEqual({name for name in features if features[name] != changed[name]}, {'ARC/INFO'})
+
     def test_split_license_data(self):
         result = split_license_data(self.prod_server_data)
         self.assertEqual(len(result), 21)
@@ -64,6 +78,12 @@ class TestFunctions(BaseTestCase):
     def test_parse_version_info(self):
         pass
 
+    def test_parse_totals(self):
+        result = parse_totals(self.prod_server_data)
+        self.assertEqual(result['ARC/INFO'], (4, 13))
+        self.assertEqual(result['DESKTOPBASICP'], (7, 10))
+        self.assertNotIn('ACT', result)
+
     def test_add_users_and_workstations(self):
         line = '  VIEWER:  (TOTAL OF 14 LICENSES ISSUED;  TOTAL OF 1 LICENSE IN USE)\n' \
                '  "VIEWER" V10.1, VENDOR: ARCGIS, EXPIRY: PERMANENT(NO EXPIRATION DATE)\n' \
@@ -91,3 +111,113 @@ class TestFunctions(BaseTestCase):
         self.assertEqual(result[0]['product_id'], 2)
         self.assertEqual(result[1]['product_id'], 2)
         self.assertEqual(result[2]['product_id'], 2)
+
+
+class TestReadServer(BaseTestCase):
+    def setUp(self):
+        super(TestReadServer, self).setUp()
+        self.server = {'hostname': 'prod-license', 'port': '27000'}
+        self.good_file = os.path.join(dir_path, 'data', 'prod-license.txt')
+        fd, self.error_file = tempfile.mkstemp()
+        with os.fdopen(fd, 'w') as f:
+            f.write('lmutil - Copyright (c) 1989-2018 Flexera. All Rights Reserved.\n'
+                    'Flexible License Manager status on Thu 1/9/2020 14:08\n\n'
+                    '[Detecting lmgrd processes...]\n'
+                    'Error getting status: Cannot connect to license server system.\n')
+
+    def tearDown(self):
+        os.remove(self.error_file)
+        super(TestReadServer, self).tearDown()
+
+    def test_circuit_opens_and_closes(self):
+        for i in range(app.config['CIRCUIT_FAILURE_THRESHOLD']):
+            read_server(self.server, license_file=self.error_file)
+        state = ServerState.query.first()
+        self.assertEqual(state.circuit, 'OPEN')
+        # the failed polls are one interval
+        self.assertEqual(Updates.query.count(), 1)
+        self.assertEqual(Updates.query.first().polls, app.config['CIRCUIT_FAILURE_THRESHOLD'])
+
+        # skipped while the circuit is open
+        read_server(self.server, license_file=self.good_file)
+        self.assertEqual(Updates.query.first().polls, app.config['CIRCUIT_FAILURE_THRESHOLD'])
+
+        # a successful probe after the backoff closes the circuit
+        state.next_attempt = datetime.datetime.now() - datetime.timedelta(seconds=1)
+        db.session.commit()
+        read_server(self.server, license_file=self.good_file)
+        state = ServerState.query.first()
+        self.assertEqual(state.circuit, 'CLOSED')
+        self.assertEqual(state.consecutive_failures, 0)
+
+    def test_checkin_only_on_first_failure(self):
+        read_server(self.server, license_file=self.good_file)
+        self.assertGreater(History.query.filter(History.time_in == None).count(), 0)
+        read_server(self.server, license_file=self.error_file)
+        self.assertEqual(History.query.filter(History.time_in == None).count(), 0)
+
+        # a session opened while the server is failing is not checked in again
+        h = History.query.first()
+        h.time_in = None
+        db.session.commit()
+        read_server(self.server, license_file=self.error_file)
+        self.assertEqual(History.query.filter(History.time_in == None).count(), 1)
+
+    def test_read_server_totals(self):
+        read_server(self.server, license_file=self.good_file)
+        p = db.session.query(Product).filter_by(internal_name='ARC/INFO').first()
+        p.license_out = 0
+        db.session.commit()
+        self.assertEqual(read_server_totals(self.server, license_file=self.good_file), 1)
+        self.assertEqual(db.session.query(Product).filter_by(internal_name='ARC/INFO').first().license_out, 4)
+        # failing servers are left to the full read
+        self.assertIsNone(read_server_totals(self.server, license_file=self.error_file))
+
+    def test_full_poll_after_totals_poll(self):
+        read_server(self.server, license_file=self.good_file)
+        fd, path = tempfile.mkstemp()
+        with os.fdopen(fd, 'w') as f:
+            f.write(self.prod_server_data.replace('Total of 4 licenses in use', 'Total of 2 licenses in use'))
+        try:
+            self.assertEqual(read_server_totals(self.server, license_file=path), 1)
+        finally:
+            os.remove(path)
+        # the full poll's output matches the one before the totals poll, its counts are written anyway
+        read_server(self.server, license_file=self.good_file)
+        self.assertEqual(db.session.query(Product).filter_by(internal_name='ARC/INFO').first().license_out, 4)
+
+    def poll(self, text):
+        fd, path = tempfile.mkstemp()
+        with os.fdopen(fd, 'w') as f:
+            f.write(text)
+        try:
+            read_server(self.server, license_file=path)
+        finally:
+            os.remove(path)
+
+    def test_unchanged_poll_skips_writes(self):
+        read_server(self.server, license_file=self.good_file)
+        logged = db.session.query(ChangeLog).count()
+        later = self.prod_server_data.replace('status on Mon 12/23/2019 14:56', 'status on Mon 12/23/2019 15:56')
+        self.poll(later)
+        self.assertEqual(Updates.query.count(), 1)
+        self.assertEqual(Updates.query.first().polls, 2)
+        self.assertEqual(db.session.query(ChangeLog).count(), logged)
+
+        # only the features whose block changed are reconciled
+        basic = db.session.query(History).join(Product).filter(Product.internal_name == 'DESKTOPBASICP',
+                                                               History.time_in == None).first()
+        basic.check_in(datetime.datetime.now())
+        db.session.commit()
+        self.poll(later.replace('    linda WIN07-COMPUTER', '    lena WIN07-COMPUTER'))
+        open_users = {h.FlexLM_user.name for h in History.query.filter(History.time_in == None)}
+        self.assertIn('LENA', open_users)
+        self.assertNotIn('LINDA', open_users)
+        self.assertNotIn(basic.FlexLM_user.name, open_users)
+
+        # after a failure everything is written again
+        read_server(self.server, license_file=self.error_file)
+        self.assertIsNone(ServerState.query.first().fingerprint)
+        read_server(self.server, license_file=self.good_file)
+        open_users = {h.FlexLM_user.name for h in History.query.filter(History.time_in == None)}
+        self.assertIn(basic.FlexLM_user.name, open_users)
@@ -0,0 +1,75 @@
+import datetime
+import os
+import tempfile
+from flask import g
+from sqlalchemy import create_engine, text
+from tests.base import BaseTestCase
+from app import app, db, cache
+from app import replica
+from app.models import Server, Updates, User
+
+
+class TestReplica(BaseTestCase):
+    def setUp(self):
+        super(TestReplica, self).setUp()
+        fd, self.replica_path = tempfile.mkstemp(suffix='.db')
+        os.close(fd)
+        db.engines['replica'] = create_engine('sqlite:///' + self.replica_path)
+        replica._freshness = (None, False)
+
+    def tearDown(self):
+        db.engines.pop('replica').dispose()
+        os.remove(self.replica_path)
+        replica._freshness = (None, False)
+        super(TestReplica, self).tearDown()
+
+    def sync(self):
+        db.session.commit()
+        replica.sync(db.engine.url.database, self.replica_path)
+        replica._freshness = (None, False)
+
+    def poll(self, time_complete, server='lic-1'):
+        Updates.record(Server.upsert(server, 27000), 'UP', now=time_complete)
+        db.session.commit()
+
+    def test_reads_go_to_fresh_replica(self):
+        now = datetime.datetime.now()
+        self.poll(now)
+        self.sync()
+        self.poll(now, 'lic-2')
+        self.assertEqual(replica.lag(), 0)
+        response = self.client.get('/servers')
+        self.assertIn(b'lic-1', response.data)
+        self.assertNotIn(b'lic-2', response.data)
+
+        # the replica falls behind the primary's last poll
+        self.poll(now + datetime.timedelta(seconds=app.config['REPLICA_MAX_LAG'] + 1))
+        replica._freshness = (None, False)
+        self.assertFalse(replica.fresh())
+        cache.clear()
+        self.assertIn(b'lic-2', self.client.get('/servers').data)
+
+    def test_writes_go_to_primary(self):
+        self.poll(datetime.datetime.now())
+        self.sync()
+        with app.test_request_context('/users'):
+            replica.route_reads()
+            self.assertTrue(g.read_replica)
+            self.assertEqual(db.session.query(User).count(), 0)
+            user_id = User.add('amy')
+            # reads after a write see it
+            self.assertFalse(g.read_replica)
+            self.assertEqual(db.session.get(User, user_id).name, 'amy')
+        with db.engines['replica'].connect() as conn:
+            self.assertEqual(conn.exec_driver_sql('SELECT count(*) FROM user').scalar(), 0)
+
+    def test_text_statements_go_to_primary(self):
+        with app.test_request_context('/users'):
+            g.read_replica = True
+            replica_engine = db.engines['replica']
+            read = text('SELECT 1').execution_options(read_only=True)
+            self.assertIs(db.session.get_bind(clause=read), replica_engine)
+            self.assertIs(db.session.get_bind(mapper=User), replica_engine)
+            # a MERGE built with text() is a write
+            self.assertIsNot(db.session.get_bind(clause=text('MERGE user AS t USING ...')), replica_engine)
+            self.assertFalse(g.read_replica)
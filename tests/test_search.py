@@ -0,0 +1,52 @@
+import time
+from tests.base import BaseTestCase
+from app import db
+from app.models import User, Workstation, Server
+from app.search import PrefixIndex, index, keys
+
+
+class TestSearch(BaseTestCase):
+    def setUp(self):
+        super(TestSearch, self).setUp()
+        index.built = None
+
+    def test_keys(self):
+        self.assertEqual(keys('ArcGIS Pro Advanced'), ['arcgis pro advanced', 'pro advanced', 'advanced'])
+        self.assertEqual(keys('WS-00012'), ['ws-00012', '00012'])
+
+    def test_prefix_search(self):
+        idx = PrefixIndex()
+        for i in range(50000):
+            idx.add('user', 'user{:05d}'.format(i))
+        idx.add('workstation', 'USER-PC')
+        start = time.perf_counter()
+        results = idx.search('user0012', limit=5)
+        self.assertLess(time.perf_counter() - start, 0.001)
+        self.assertEqual(results, [('user', 'user0012{}'.format(i)) for i in range(5)])
+        self.assertEqual(idx.search('pc'), [('workstation', 'USER-PC')])
+        self.assertEqual(idx.search('user-', kinds={'user'}), [])
+
+    def test_incremental_updates(self):
+        User.add('ann')
+        index.build()
+        User.add('anna')
+        Workstation.add('ANN-PC')
+        self.assertEqual(index.search('ann'), [('user', 'ann'), ('workstation', 'ANN-PC'), ('user', 'anna')])
+        # rows inserted without the ORM, like another process would, are picked up by refresh()
+        db.session.execute(User.__table__.insert().values(name='annie'))
+        db.session.commit()
+        self.assertNotIn(('user', 'annie'), index.search('ann'))
+        index.refresh()
+        self.assertIn(('user', 'annie'), index.search('ann'))
+
+    def test_search_endpoint(self):
+        User.add('bob')
+        Server.upsert('bob-license', 27000)
+        response = self.client.get('/data/search?q=bo')
+        self.assertEqual(response.json['results'], [
+            {'type': 'user', 'name': 'bob', 'url': '/users/bob'},
+            {'type': 'server', 'name': 'bob-license', 'url': '/servers/bob-license'}])
+        response = self.client.get('/data/search?q=bo&type=server')
+        self.assertEqual([r['name'] for r in response.json['results']], ['bob-license'])
+        self.assertEqual(self.client.get('/data/search').status_code, 400)
+        self.assertEqual(self.client.get('/data/search?q=bo&type=nope').status_code, 400)
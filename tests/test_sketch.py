@@ -0,0 +1,52 @@
+import datetime
+import os
+from tests.base import BaseTestCase, dir_path
+from app import db, sketch
+from app.models import History, UserSketch
+from app.read_licenses import read_server
+from app.sketch import HyperLogLog, periods
+
+
+class TestSketch(BaseTestCase):
+    def setUp(self):
+        super(TestSketch, self).setUp()
+        sketch._recorded.clear()
+
+    def test_count(self):
+        a, b = HyperLogLog(), HyperLogLog()
+        for i in range(20000):
+            (a if i % 2 else b).add('user-{}'.format(i))
+        self.assertFalse(a.add('user-1'))
+        self.assertAlmostEqual(HyperLogLog.from_bytes(b.to_bytes()).merge(a).count() / 20000, 1, delta=0.05)
+        small = HyperLogLog()
+        for name in ('LENA', 'LINDA', 'LENA'):
+            small.add(name)
+        self.assertEqual(small.count(), 2)
+
+    def test_periods(self):
+        self.assertEqual(periods(datetime.date(2024, 1, 15), datetime.date(2024, 3, 10), 'month'),
+                         [(datetime.date(2024, 1, 15), datetime.date(2024, 1, 31)),
+                          (datetime.date(2024, 2, 1), datetime.date(2024, 2, 29)),
+                          (datetime.date(2024, 3, 1), datetime.date(2024, 3, 10))])
+        self.assertEqual(len(periods(datetime.date(2024, 1, 1), datetime.date(2024, 1, 14), 'week')), 2)
+
+    def test_unique_users(self):
+        read_server({'hostname': 'prod-license', 'port': '27000'},
+                    license_file=os.path.join(dir_path, 'data', 'prod-license.txt'))
+        self.assertGreater(db.session.query(UserSketch).count(), 0)
+        # lmstat has no year, some checkouts of the test data are later this year
+        db.session.query(History).update({'time_out': datetime.datetime.now().replace(hour=0, minute=1)})
+        db.session.commit()
+        today = datetime.date.today().isoformat()
+        url = '/data/unique-users?product=ARC/INFO&from={0}&to={0}&group=day'.format(today)
+        estimate = self.client.get(url).json['results']
+        exact = self.client.get(url + '&exact=1').json['results']
+        self.assertEqual(estimate, exact)
+        self.assertEqual(exact[0]['users'], 4)
+
+        # rebuilt from History
+        db.session.query(UserSketch).delete()
+        db.session.commit()
+        self.assertGreater(sketch.rebuild(datetime.date.today(), datetime.date.today()), 0)
+        self.assertEqual(self.client.get(url).json['results'], exact)
+        self.assertEqual(self.client.get('/data/unique-users?product=ARC/INFO&group=hour').status_code, 400)
@@ -0,0 +1,92 @@
+import datetime
+import os
+import time
+from tests.base import BaseTestCase
+from app import db
+from app.models import Server, Product, SeatSample, SeatSeries
+from app.arcgis_config import products
+from app import timeseries
+
+
+class TestTimeSeries(BaseTestCase):
+    def setUp(self):
+        super(TestTimeSeries, self).setUp()
+        timeseries._decoded.clear()
+
+    def test_encode_decode(self):
+        pairs = [(0, 3), (60, 3), (120, 1), (150000, 400), (150060, 0)]
+        offsets, values = timeseries.decode(timeseries.encode(pairs))
+        self.assertEqual(list(zip(offsets, values)), pairs)
+        # appending to an encoded day continues from the last sample
+        blob = timeseries.encode(pairs[:2]) + timeseries.encode(pairs[2:], *pairs[1])
+        self.assertEqual(list(zip(*timeseries.decode(blob))), pairs)
+
+    def test_record_and_series(self):
+        day = datetime.datetime(2020, 1, 2)
+        for minute, seats in enumerate([1, 2, 2, 5, 3]):
+            timeseries.record({1: seats}, day + datetime.timedelta(minutes=minute * 30))
+        times, values = timeseries.series(1, day, day + datetime.timedelta(days=1))
+        self.assertEqual(list(values), [1, 2, 2, 5, 3])
+        self.assertEqual(timeseries.downsample(times, values, 3600, 'max'),
+                         [(times[0], 2), (times[2], 5), (times[4], 3)])
+        self.assertEqual(timeseries.downsample(times, values, 86400, 'last')[0][1], 3)
+
+        # past days are folded into one row per product per day and decoded once
+        self.assertEqual(timeseries.compact(), 1)
+        self.assertEqual(db.session.query(SeatSample).count(), 0)
+        self.assertEqual(db.session.get(SeatSeries, (1, day.date())).count, 5)
+        self.assertEqual(timeseries.series(1, day, day + datetime.timedelta(days=1)), (times, values))
+        self.assertIn((1, day.date()), timeseries._decoded)
+        # a sample that arrives after its day was compacted
+        timeseries.record({1: 4}, day + datetime.timedelta(minutes=45))
+        self.assertEqual(list(timeseries.series(1, day, day + datetime.timedelta(days=1))[1]), [1, 2, 4, 2, 5, 3])
+        timeseries.compact()
+        self.assertEqual(list(timeseries.series(1, day, day + datetime.timedelta(days=1))[1]), [1, 2, 4, 2, 5, 3])
+
+    def test_local_buckets(self):
+        tz = os.environ.get('TZ')
+        os.environ['TZ'] = 'Europe/Berlin'
+        time.tzset()
+        try:
+            # clocks went forward on 2024-03-31, a Sunday
+            times = [datetime.datetime(2024, 3, 30, 23, 30).timestamp(),
+                     datetime.datetime(2024, 3, 31, 0, 30).timestamp(),
+                     datetime.datetime(2024, 3, 31, 23, 30).timestamp(),
+                     datetime.datetime(2024, 4, 1, 0, 30).timestamp()]
+            values = [1, 2, 3, 4]
+            self.assertEqual(timeseries.downsample(times, values, 86400, 'max'),
+                             [(datetime.datetime(2024, 3, 30).timestamp(), 1),
+                              (datetime.datetime(2024, 3, 31).timestamp(), 3),
+                              (datetime.datetime(2024, 4, 1).timestamp(), 4)])
+            self.assertEqual(timeseries.downsample(times, values, 7 * 86400, 'max'),
+                             [(datetime.datetime(2024, 3, 25).timestamp(), 3),
+                              (datetime.datetime(2024, 4, 1).timestamp(), 4)])
+            self.assertEqual(timeseries.downsample(times, values, 3600, 'max')[1][0],
+                             datetime.datetime(2024, 3, 31, 0, 0).timestamp())
+        finally:
+            if tz is None:
+                del os.environ['TZ']
+            else:
+                os.environ['TZ'] = tz
+            time.tzset()
+
+    def test_prune(self):
+        for day in (1, 2, 3):
+            timeseries.record({1: day}, datetime.datetime(2020, 1, day, 12))
+        self.assertEqual(timeseries.prune(datetime.date(2020, 1, 3)), 2)
+        self.assertEqual([r.day for r in db.session.query(SeatSeries)], [datetime.date(2020, 1, 3)])
+        self.assertEqual(timeseries.prune(), 1)
+
+    def test_product_seats_endpoint(self):
+        server_id = Server.upsert('test1', 27000)
+        product_id = Product.upsert(server_id, 'VIEWER', common_name=products['VIEWER']['common_name'],
+                                    category=products['VIEWER']['category'], type=products['VIEWER']['type'],
+                                    license_out=2, license_total=4)
+        timeseries.record({product_id: 2})
+        response = self.client.get('/data/product/seats?servername=test1&product=VIEWER&bucket=60')
+        self.assertEqual(response.json['total'], 4)
+        self.assertEqual(response.json['results'][0][1], 2)
+        for query in ('agg=median', 'bucket=0', 'bucket=-60', 'days=abc', 'bucket=1h'):
+            response = self.client.get('/data/product/seats?servername=test1&product=VIEWER&' + query)
+            self.assertEqual(response.status_code, 400)
+            self.assertIn('error', response.json)